@@ -0,0 +1,318 @@
+"""
+Benchmarks of the perturbation functions on synthetic AIFS-shaped grib files (see synthetic_grib.py).
+
+Every benchmark runs in its own process, so that its peak RSS is its own: the entry point is
+called `--repeat` times end to end, then its phases (validate, decode, mask, perturb, encode,
+write) are timed one after the other with the building blocks it uses. The results of a grid
+are written to `<results dir>/<commit>_<grid>.json`, to be compared across commits.
+
+usage:
+    python3 benchmarks/run_benchmarks.py --grids O96 N320 --repeat 3
+    python3 benchmarks/run_benchmarks.py --compare ./benchmarks/results/<baseline>.json ./benchmarks/results/<current>.json
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SYNTHETIC_GRIB_PATH = os.path.join(BENCHMARKS_PATH, '_synthetic_grib_files')
+RESULTS_PATH = os.path.join(BENCHMARKS_PATH, 'results')
+
+BENCHMARKS = ["validate_grib_file", "perturbation_by_factor", "perturb_regionally", "perturb_by_polygons", "perturbation_phase"]
+PHASES = ["validate", "decode", "mask", "perturb", "encode", "write"]
+DEFAULT_GRIDS = ["O96"]
+
+# a benchmark slower than its baseline by more than this ratio is reported as a regression
+REGRESSION_RATIO = 1.1
+
+# perturbations of the benchmarks
+REGION = {"lat_s": 40., "lat_n": 60., "lon_w": 0., "lon_e": 10.}
+POLYGONS = {
+    "lonw_list": [0., 20., -80.], "lone_list": [10., 30., -60.], "lats_list": [40., 40., -20.], "latn_list": [60., 60., 0.],
+    "zmul_list": [1., 1., 1.1], "zadd_list": [2., -2., 0.],
+}
+
+def _peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024
+
+def _git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_PATH, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT_PATH, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, bool(dirty)
+
+def synthetic_grib_file(grid, data_times="0,1800"):
+    """
+    Path of the synthetic grib file of a grid, written (by synthetic_grib.py, in another process) if needed.
+    """
+    os.makedirs(SYNTHETIC_GRIB_PATH, exist_ok=True)
+    grib_file = os.path.join(SYNTHETIC_GRIB_PATH, f"{grid}.grib")
+    if not os.path.exists(grib_file):
+        subprocess.run([
+            sys.executable, os.path.join(BENCHMARKS_PATH, "synthetic_grib.py"),
+            "--grid", grid, "--output_grib_file", grib_file, "--data_times", data_times], check=True)
+    return grib_file
+
+def _benchmark_cases(grib_file, output_grib_file, use_index):
+    """
+    Entry point of every benchmark and the (keys, mask, perturb) of its phases, run in the benchmark process.
+    """
+    from perturbation_functions import (
+        validate_grib_file, perturbation_by_factor, perturb_regionally, perturb_by_polygons, perturbation_phase,
+        get_grib_index, box_indices, polygon_labels)
+    from perturbation_functions.perturb_regionally import perturb_region_values
+    from perturbation_functions.perturb_by_polygons import perturb_polygons_values
+    from perturbation_functions.helper_functions import scale_points
+
+    data_times = sorted({entry["dataTime"] for entry in get_grib_index(grib_file).messages})
+
+    def field_keys(variable, level):
+        return [(variable, level, data_time) for data_time in data_times]
+
+    return {
+        "validate_grib_file": (
+            lambda: validate_grib_file(grib_file, use_index=use_index),
+            None),
+        "perturbation_by_factor": (
+            lambda: perturbation_by_factor(grib_file, 't', 500, 1.1, output_grib_file=output_grib_file, use_index=use_index),
+            (field_keys('t', 500), lambda geometry: None,
+             lambda key, data, geometry, mask, fields: scale_points(data, None, zmul=1.1))),
+        "perturb_regionally": (
+            lambda: perturb_regionally(grib_file, 'msl', 0, zmul=1.1, zadd=100., output_grib_file=output_grib_file, use_index=use_index, **REGION),
+            (field_keys('msl', 0), lambda geometry: box_indices(geometry, snap=True, **REGION),
+             lambda key, data, geometry, mask, fields: perturb_region_values(data, geometry, 'msl', zmul=1.1, zadd=100., **REGION))),
+        "perturb_by_polygons": (
+            lambda: perturb_by_polygons(grib_file, 'skt', 0, output_grib_file=output_grib_file, use_index=use_index, **POLYGONS),
+            (field_keys('skt', 0), lambda geometry: polygon_labels(geometry, *[POLYGONS[key] for key in ["lonw_list", "lone_list", "lats_list", "latn_list"]]),
+             lambda key, data, geometry, mask, fields: perturb_polygons_values(data, geometry, 'skt', **POLYGONS))),
+        "perturbation_phase": (
+            lambda: perturbation_phase(grib_file, output_grib_file=output_grib_file, phase_shift="both", use_index=use_index),
+            ([(entry["shortName"], entry["level"], entry["dataTime"]) for entry in get_grib_index(grib_file).messages], lambda geometry: None,
+             lambda key, data, geometry, mask, fields: fields[(key[0], key[1], data_times[-1] if key[2] == data_times[0] else data_times[0])].copy())),
+    }
+
+def _phase_timings(grib_file, output_grib_file, validate, keys, mask, perturb):
+    """
+    Time the phases of a perturbation one after the other, with the building blocks of the perturbation functions.
+    """
+    from perturbation_functions import get_grib_index, get_grid_geometry
+    from grib_files.spatial_index import _region_indices
+    from grib_files.grib_pipeline import read_values
+
+    timings = dict.fromkeys(PHASES, 0.)
+
+    start = time.perf_counter()
+    validate()
+    timings["validate"] = time.perf_counter() - start
+
+    grib_index = get_grib_index(grib_file)
+
+    start = time.perf_counter()
+    messages, fields = dict(), dict()
+    for (key, grb) in zip(keys, grib_index.iter_messages([grib_index.select(*key)[0] for key in keys])):
+        grb.expand_grid(False)
+        messages[key] = grb
+        fields[key] = read_values(grb)
+    timings["decode"] = time.perf_counter() - start
+
+    # the regions are computed again, as by the first perturbation of a grid
+    _region_indices.clear()
+    geometry = get_grid_geometry(next(iter(messages.values())))
+    start = time.perf_counter()
+    region = mask(geometry)
+    timings["mask"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    perturbed = {key: perturb(key, fields[key].copy(), geometry, region, fields) for key in keys}
+    timings["perturb"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded = dict()
+    for key in keys:
+        messages[key].values = perturbed[key]
+        encoded[key] = messages[key].tostring()
+    timings["encode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(grib_file, "rb") as f, open(output_grib_file, "wb") as out_file:
+        for entry in grib_index.messages:
+            key = (entry["shortName"], entry["level"], entry["dataTime"])
+            out_file.write(encoded[key] if key in encoded else os.pread(f.fileno(), entry["length"], entry["offset"]))
+    timings["write"] = time.perf_counter() - start
+
+    return timings
+
+def run_benchmark(name, grib_file, repeat=3, use_index=False):
+    """
+    Run one benchmark in this process (see `run_benchmarks`, which runs each in a new process).
+
+    Returns
+    -------
+    dict
+        The wall times (s) of the repeated entry point calls, their min and median, the
+        peak RSS (MB) after the import and after the calls, and the phase timings (s).
+    """
+    start = time.perf_counter()
+    sys.path.insert(0, ROOT_PATH)
+    # pygrib, numpy and grib_files, the perturbation modules are imported by the benchmark
+    import perturbation_functions.helper_functions
+    import_time = time.perf_counter() - start
+    rss_after_import = _peak_rss_mb()
+
+    output_dir = tempfile.mkdtemp(prefix=".outputs_", dir=SYNTHETIC_GRIB_PATH)
+    output_grib_file = os.path.join(output_dir, f"{name}.grib")
+    entry_point, phases = _benchmark_cases(grib_file, output_grib_file, use_index)[name]
+
+    wall_times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        entry_point()
+        wall_times.append(time.perf_counter() - start)
+        if os.path.exists(output_grib_file):
+            os.remove(output_grib_file)
+    peak_rss = _peak_rss_mb()
+
+    result = {
+        "import_time": import_time,
+        "wall_times": wall_times,
+        "min": min(wall_times),
+        "median": statistics.median(wall_times),
+        "rss_after_import_mb": rss_after_import,
+        "peak_rss_mb": peak_rss,
+        "phases": None,
+    }
+
+    validate = lambda: perturbation_functions.validate_grib_file(grib_file, use_index=use_index)
+    if phases is None:
+        result["phases"] = {"validate": min(wall_times)}
+    else:
+        result["phases"] = _phase_timings(grib_file, output_grib_file, validate, *phases)
+
+    # outputs and the configs written next to the input
+    for output_file in glob.glob(os.path.join(output_dir, "*")) + glob.glob(os.path.join(SYNTHETIC_GRIB_PATH, "*_cfg.json")):
+        os.remove(output_file)
+    os.rmdir(output_dir)
+
+    return result
+
+def _print_results(results):
+    print(f"{'benchmark':<24} {'min (s)':>9} {'median (s)':>11} {'peak RSS (MB)':>14}  " + " ".join(f"{phase:>9}" for phase in PHASES))
+    for (name, result) in results["benchmarks"].items():
+        phases = " ".join(
+            f"{result['phases'][phase]:>9.3f}" if phase in result["phases"] else f"{'-':>9}" for phase in PHASES)
+        print(f"{name:<24} {result['min']:>9.3f} {result['median']:>11.3f} {result['peak_rss_mb']:>14.1f}  {phases}")
+
+def run_benchmarks(grids=DEFAULT_GRIDS, benchmarks=BENCHMARKS, repeat=3, use_index=False, output_dir=RESULTS_PATH):
+    """
+    Run the benchmarks on the synthetic grib file of every grid and write their results.
+
+    Returns
+    -------
+    list of str
+        The JSON result files, one per grid.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    commit, dirty = _git_commit()
+
+    result_files = list()
+    for grid in grids:
+        grib_file = synthetic_grib_file(grid)
+        results = {
+            "commit": commit,
+            "dirty": dirty,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "grid": grid,
+            "grib_file_bytes": os.path.getsize(grib_file),
+            "repeat": repeat,
+            "use_index": use_index,
+            "benchmarks": dict(),
+        }
+
+        for name in benchmarks:
+            print(f"running {name} on {grid}")
+            with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+                subprocess.run([
+                    sys.executable, os.path.abspath(__file__), "--worker", name, "--grib_file", grib_file,
+                    "--repeat", str(repeat), "--result_file", result_file.name] + (["--use_index"] if use_index else []),
+                    check=True, stdout=subprocess.DEVNULL)
+                results["benchmarks"][name] = json.load(result_file)
+
+        result_file = os.path.join(output_dir, f"{commit[:10]}{'-dirty' if dirty else ''}_{grid}.json")
+        with open(result_file, "w") as f:
+            json.dump(results, f, indent=4)
+
+        _print_results(results)
+        print(f"results saved as: {result_file}")
+        result_files.append(result_file)
+
+    return result_files
+
+def compare_results(baseline_file, current_file, ratio=REGRESSION_RATIO):
+    """
+    Print the median time and peak RSS of every benchmark against a baseline.
+
+    Returns
+    -------
+    list of str
+        The benchmarks slower than their baseline by more than `ratio`.
+    """
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    with open(current_file, "r") as f:
+        current = json.load(f)
+
+    if baseline["grid"] != current["grid"]:
+        print(f"comparing results on different grids: {baseline['grid']} and {current['grid']}")
+
+    regressions = list()
+    print(f"{'benchmark':<24} {'baseline (s)':>13} {'current (s)':>12} {'ratio':>7} {'RSS ratio':>10}")
+    for (name, result) in current["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        reference = baseline["benchmarks"][name]
+        time_ratio = result["median"] / reference["median"]
+        rss_ratio = result["peak_rss_mb"] / reference["peak_rss_mb"]
+        flag = "  slower" if time_ratio > ratio else ""
+        print(f"{name:<24} {reference['median']:>13.3f} {result['median']:>12.3f} {time_ratio:>7.2f} {rss_ratio:>10.2f}{flag}")
+        if time_ratio > ratio:
+            regressions.append(name)
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the perturbation functions on synthetic AIFS-shaped grib files.")
+    parser.add_argument('--grids', type=str, nargs='+', default=DEFAULT_GRIDS, help='Reduced Gaussian grids, O<N> or N<N> (e.g. O96 N320)')
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=BENCHMARKS, choices=BENCHMARKS, help='Benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of calls of every entry point')
+    parser.add_argument('--use_index', action='store_true', help='Run the entry points with the grib file index')
+    parser.add_argument('--output_dir', type=str, default=RESULTS_PATH, help='Directory of the JSON results')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('BASELINE', 'CURRENT'), help='Compare two JSON results instead')
+    # a single benchmark, in the process started by run_benchmarks
+    parser.add_argument('--worker', type=str, choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument('--grib_file', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare_results(*args.compare) else 0)
+    elif args.worker:
+        result = run_benchmark(args.worker, args.grib_file, repeat=args.repeat, use_index=args.use_index)
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+    else:
+        run_benchmarks(args.grids, args.benchmarks, repeat=args.repeat, use_index=args.use_index, output_dir=args.output_dir)
@@ -0,0 +1,140 @@
+"""
+Synthetic AIFS-shaped grib files for the benchmarks: every VARIABLES x LEVELS field, for two
+dataTimes, on a reduced Gaussian grid.
+
+Written with the eccodes python module, which must not be imported in the same process as
+pygrib: run this module as a script (`run_benchmarks.py` does it in a subprocess).
+
+usage:
+    python3 benchmarks/synthetic_grib.py --grid O96 --output_grib_file ./benchmarks/_synthetic_grib_files/O96.grib
+"""
+import os
+import sys
+import argparse
+import importlib.util
+
+import numpy as np
+import eccodes
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# grib_file_config is loaded from its file, importing the grib_files package would import pygrib
+_spec = importlib.util.spec_from_file_location("grib_file_config", os.path.join(ROOT_PATH, "grib_files", "grib_file_config.py"))
+grib_file_config = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(grib_file_config)
+
+# ECMWF paramId of every variable
+PARAM_IDS = {
+    '10u': 165, '10v': 166, '2d': 168, '2t': 167, 'lsm': 172, 'msl': 151, 'sdor': 160, 'skt': 235,
+    'slor': 163, 'sp': 134, 'tcw': 136, 'q': 133, 't': 130, 'w': 135, 'z': 129, 'u': 131, 'v': 132,
+}
+
+# (mean, amplitude) of the large scale pattern of the surface fields
+SURFACE_FIELDS = {
+    '10u': (0., 8.), '10v': (0., 8.), '2d': (275., 15.), '2t': (285., 20.), 'lsm': (0.5, 0.5), 'msl': (101325., 1500.),
+    'sdor': (50., 50.), 'skt': (285., 20.), 'slor': (0.01, 0.01), 'sp': (98000., 3000.), 'tcw': (25., 15.),
+}
+
+DEFAULT_DATA_TIMES = [0, 1800]
+
+def parse_grid(grid):
+    """
+    Truncation and pl of a reduced Gaussian grid: "O<N>" for an octahedral grid, "N<N>" for the classic one (eccodes sample).
+    """
+    kind, n = grid[0].upper(), int(grid[1:])
+    if kind == "O":
+        rows = [4 * i + 16 for i in range(1, n + 1)]
+        return n, np.array(rows + rows[::-1], dtype=np.int64)
+    if kind == "N":
+        return n, None
+    raise ValueError(f"unknown grid {grid}, expected O<N> or N<N> (e.g. O96, N320)")
+
+def field_values(variable, level, data_time, lats, lons, rng):
+    """
+    Smooth large scale pattern of a field plus a little noise, within the usual range of the variable.
+    """
+    pattern = np.sin(np.radians(lats) * 2.) * np.cos(np.radians(lons + data_time / 100.))
+    noise = rng.standard_normal(lats.size) * 0.05
+
+    if variable in SURFACE_FIELDS:
+        mean, amplitude = SURFACE_FIELDS[variable]
+        values = mean + amplitude * (pattern + noise)
+        return np.clip(values, 0., 1.) if variable == 'lsm' else values
+
+    if level == 0:
+        # z on the surface, the orography
+        return 9.80665 * np.maximum(1000. * (pattern + noise), 0.)
+
+    pressure = level / 1000.
+    if variable == 't':
+        return 200. + 80. * pressure + 20. * (pattern + noise)
+    if variable == 'z':
+        return 9.80665 * (7000. * np.log(1. / pressure) + 100. * (pattern + noise))
+    if variable == 'q':
+        return np.maximum(0.01 * pressure ** 3 * (1. + pattern + noise), 0.)
+    if variable == 'w':
+        return 0.1 * (pattern + noise)
+    # u, v
+    return 10. * (1. - pressure) * 2. * (pattern + noise)
+
+def write_synthetic_grib(output_grib_file, grid="O96", data_times=DEFAULT_DATA_TIMES, bits_per_value=16, seed=0):
+    """
+    Write a synthetic grib file with every field of VALID_VARIABLES_DICT for every dataTime.
+
+    Returns
+    -------
+    int
+        The number of messages written.
+    """
+    n, pl = parse_grid(grid)
+    rng = np.random.default_rng(seed)
+
+    sample = eccodes.codes_grib_new_from_samples(f"reduced_gg_pl_{n}_grib1")
+    if pl is not None:
+        # the longest rows of the octahedral grid are longer than those of the sample
+        eccodes.codes_set(sample, 'longitudeOfLastGridPointInDegrees', 360. - 360. / pl.max())
+        eccodes.codes_set_array(sample, 'pl', pl)
+        eccodes.codes_set_values(sample, np.zeros(int(pl.sum())))
+    lats = eccodes.codes_get_array(sample, 'latitudes')
+    lons = eccodes.codes_get_array(sample, 'longitudes')
+
+    n_messages = 0
+    tmp_grib_file = f"{output_grib_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_grib_file, "wb") as f:
+            for data_time in data_times:
+                for (variable, levels) in grib_file_config.VALID_VARIABLES_DICT.items():
+                    for level in levels:
+                        h = eccodes.codes_clone(sample)
+                        eccodes.codes_set(h, 'paramId', PARAM_IDS[variable])
+                        eccodes.codes_set(h, 'typeOfLevel', 'isobaricInhPa' if level else 'surface')
+                        eccodes.codes_set(h, 'level', level)
+                        eccodes.codes_set(h, 'dataDate', 20240302)
+                        eccodes.codes_set(h, 'dataTime', data_time)
+                        eccodes.codes_set(h, 'bitsPerValue', bits_per_value)
+                        eccodes.codes_set_values(h, field_values(variable, level, data_time, lats, lons, rng))
+                        f.write(eccodes.codes_get_message(h))
+                        eccodes.codes_release(h)
+                        n_messages += 1
+    except BaseException:
+        os.remove(tmp_grib_file)
+        raise
+    finally:
+        eccodes.codes_release(sample)
+    os.replace(tmp_grib_file, output_grib_file)
+
+    return n_messages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic AIFS-shaped grib file on a reduced Gaussian grid.")
+    parser.add_argument('--grid', type=str, default="O96", help='O<N> (octahedral) or N<N> reduced Gaussian grid, e.g. O96, N320')
+    parser.add_argument('--output_grib_file', type=str, required=True, help='Path to the GRIB file to write')
+    parser.add_argument('--data_times', type=str, default="0,1800", help='Comma-separated dataTimes of the fields')
+    parser.add_argument('--bits_per_value', type=int, default=16, help='Packing precision of the fields')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the noise added to the fields')
+    args = parser.parse_args()
+
+    n_messages = write_synthetic_grib(
+        args.output_grib_file, grid=args.grid, data_times=[int(t) for t in args.data_times.split(",")],
+        bits_per_value=args.bits_per_value, seed=args.seed)
+    print(f"wrote {n_messages} messages on the {args.grid} grid to {args.output_grib_file}")
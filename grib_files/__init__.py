@@ -8,23 +8,22 @@ sys.path.append(ROOT_PATH)
 import logger
 from .grib_file_config import *
 from .validate_grib_file import *
-
-# grib files list
-GRIB_ROOT_DIR_PATH = os.path.dirname(os.path.abspath(__file__))
-GRIB_DIR_PATH = os.path.join(GRIB_ROOT_DIR_PATH, 'experiments_grib_files')
-TEST_GRIB_DIR_PATH = os.path.join(GRIB_ROOT_DIR_PATH, '_test_grib_file')
-
-grib_files_paths = dict()
-grib_pert_cfgs = dict()
-
-for file in os.listdir(GRIB_DIR_PATH):
-    filename = os.path.splitext(file)
-    if filename[1] in [".grib", ".grb"]:
-        grib_files_paths[filename[0]] = os.path.join(GRIB_DIR_PATH, file)
-    
-    if filename[1] in [".json"] and "_cfg" in filename[0]:
-        with open(os.path.join(GRIB_DIR_PATH, file), "r") as f:
-            grib_pert_cfgs[filename[0]] = json.load(f)
+from .grib_index import *
+from .grid_geometry import *
+from .spatial_index import *
+from .grid_derivatives import *
+from .grib_pipeline import *
+from .array_store import *
+
+from .experiment_registry import *
+
+def __getattr__(name):
+    # the experiments are only listed when first used, see ExperimentRegistry
+    if name == "grib_files_paths":
+        return get_experiment_registry().grib_files_paths()
+    if name == "grib_pert_cfgs":
+        return get_experiment_registry().pert_cfgs()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 test_grib_files = list()
 
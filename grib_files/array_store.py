@@ -0,0 +1,284 @@
+import os
+import json
+import shutil
+from uuid import uuid4
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .grib_index import get_grib_index, _grib_file_fingerprint
+from .grid_geometry import get_grid_geometry
+from .grib_pipeline import read_values, FIELD_DTYPE
+from logger import logger
+
+ARRAY_STORE_VERSION = 1
+ARRAY_STORE_BACKENDS = ["auto", "zarr", "npy"]
+
+# extension of the store written next to a grib file, per backend
+ARRAY_STORE_EXTENSIONS = {"zarr": ".zarr", "npy": ".arrays"}
+
+ARRAY_STORE_META_FILE = "store.json"
+
+# points per chunk of a time slice in a zarr store
+ARRAY_STORE_CHUNK_POINTS = 1 << 20
+
+def _zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("zarr is required for zarr array stores, use the npy backend instead")
+    return zarr
+
+def _backend(backend):
+    if backend not in ARRAY_STORE_BACKENDS:
+        raise ValueError(f"unknown array store backend {backend}, expected one of {ARRAY_STORE_BACKENDS}")
+    if backend != "auto":
+        return backend
+    try:
+        import zarr
+    except ImportError:
+        return "npy"
+    return "zarr"
+
+def _field_name(variable, level):
+    return f"{variable}_{level}"
+
+def valid_time(data_date, data_time, step):
+    """
+    Valid time of a message from its dataDate (YYYYMMDD), dataTime (HHMM) and step (hours).
+    """
+    return (
+        datetime.strptime(str(data_date), "%Y%m%d")
+        + timedelta(hours=data_time // 100, minutes=data_time % 100)
+        + timedelta(hours=step)
+    )
+
+def default_array_store_path(grib_file, backend="auto"):
+    return f"{os.path.abspath(grib_file)}{ARRAY_STORE_EXTENSIONS[_backend(backend)]}"
+
+def _read_meta(store_path):
+    try:
+        with open(os.path.join(store_path, ARRAY_STORE_META_FILE), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != ARRAY_STORE_VERSION:
+        return None
+    return meta
+
+def grib_to_array_store(grib_file, store_path=None, backend="auto", dtype=FIELD_DTYPE, overwrite=False):
+    """
+    Write the fields of a grib file to a chunked on-disk array store, to be read with `open_array_store`.
+
+    Every (variable, level) of the grib file is stored as one (time, points) array,
+    time being the valid times of its messages in order and points the points of the
+    grid in the order of the reduced grid, with the latitudes and longitudes of the
+    points alongside. The messages are decoded once, in a single pass over the file
+    through its message index.
+
+    Two backends are available:
+
+    - "zarr": compressed zarr arrays chunked on single time slices (zarr is optional),
+    - "npy": uncompressed .npy files that are memory-mapped when read, so a time
+      slice is read straight from the page cache without decompression.
+
+    The store is written next to a temporary name and moved into place once
+    complete. An existing store of the same grib file, unchanged since (same size
+    and modification time), is reused as is unless `overwrite`.
+
+    Parameters
+    ----------
+    grib_file : str
+        The grib file, e.g. the init or prediction file of an experiment.
+    store_path : str, optional
+        Directory of the store. Default is the grib file path with ".zarr" or ".arrays" appended.
+    backend : str, optional
+        "zarr", "npy" or "auto" (zarr if installed, npy otherwise). Default is "auto".
+    dtype : numpy.dtype, optional
+        Type of the stored values. Default is FIELD_DTYPE (float32).
+    overwrite : bool, optional
+        Rewrite the store even if it is up to date. Default is False.
+
+    Returns
+    -------
+    str
+        The path of the store.
+    """
+    grib_file = os.path.abspath(grib_file)
+    backend = _backend(backend)
+    store_path = os.path.abspath(store_path) if store_path else default_array_store_path(grib_file, backend)
+    fingerprint = _grib_file_fingerprint(grib_file)
+
+    meta = _read_meta(store_path)
+    if not overwrite and meta is not None and meta["fingerprint"] == fingerprint and meta["backend"] == backend:
+        logger.info(f"array store of {grib_file} is up to date: {store_path}")
+        return store_path
+
+    grib_index = get_grib_index(grib_file)
+    times = sorted({(entry["dataDate"], entry["dataTime"], entry["step"]) for entry in grib_index.messages})
+    time_index = {time: i for (i, time) in enumerate(times)}
+    fields = sorted({(entry["shortName"], entry["level"]) for entry in grib_index.messages})
+
+    tmp_store_path = os.path.join(os.path.dirname(store_path), f".{os.path.basename(store_path)}.{uuid4().hex[-8:]}.tmp")
+    os.makedirs(tmp_store_path)
+
+    try:
+        arrays = dict()
+        written = {field: np.zeros(len(times), dtype=bool) for field in fields}
+        geometry = None
+
+        for (entry, grb) in zip(grib_index.messages, grib_index.iter_messages(grib_index.messages)):
+            if geometry is None:
+                geometry = get_grid_geometry(grb)
+                np.save(os.path.join(tmp_store_path, "lats.npy"), geometry.lats)
+                np.save(os.path.join(tmp_store_path, "lons.npy"), geometry.lons)
+                if geometry.pl is not None:
+                    np.save(os.path.join(tmp_store_path, "pl.npy"), geometry.pl)
+            grb.expand_grid(False)
+
+            field = (entry["shortName"], entry["level"])
+            if field not in arrays:
+                path = os.path.join(tmp_store_path, _field_name(*field))
+                shape = (len(times), geometry.n_points)
+                if backend == "zarr":
+                    arrays[field] = _zarr().open_array(
+                        path, mode="w", shape=shape, dtype=dtype,
+                        chunks=(1, min(geometry.n_points, ARRAY_STORE_CHUNK_POINTS)), fill_value=np.nan)
+                else:
+                    arrays[field] = np.lib.format.open_memmap(f"{path}.npy", mode="w+", dtype=dtype, shape=shape)
+
+            t = time_index[(entry["dataDate"], entry["dataTime"], entry["step"])]
+            # missing values (bitmap) are stored as NaN
+            arrays[field][t, :] = np.ma.filled(read_values(grb, dtype=dtype, reuse=True), np.nan)
+            written[field][t] = True
+
+        for (field, array) in arrays.items():
+            if backend == "npy":
+                # times without a message of the field
+                array[~written[field]] = np.nan
+                array.flush()
+
+        with open(os.path.join(tmp_store_path, ARRAY_STORE_META_FILE), "w") as f:
+            json.dump({
+                "version": ARRAY_STORE_VERSION,
+                "grib_file": grib_file,
+                "fingerprint": fingerprint,
+                "backend": backend,
+                "dtype": np.dtype(dtype).name,
+                "grid": None if geometry is None else geometry.key,
+                "n_points": 0 if geometry is None else geometry.n_points,
+                "times": times,
+                "valid_times": [valid_time(*time).isoformat() for time in times],
+                "fields": fields,
+            }, f)
+
+        arrays.clear()
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+        os.replace(tmp_store_path, store_path)
+    except BaseException:
+        shutil.rmtree(tmp_store_path, ignore_errors=True)
+        raise
+
+    logger.info(f"array store of {grib_file} saved as: {store_path}")
+    return store_path
+
+class ArrayStore:
+    """
+    Fields of a grib file written by `grib_to_array_store`, read without any grib decoding.
+
+    `field(variable, level)` is a (time, points) array that is only read where it is
+    sliced: memory-mapped .npy files or lazily read zarr arrays. The time axis is
+    `valid_times` (`times` holds the (dataDate, dataTime, step) of every slice) and
+    the points those of `lats` and `lons`.
+    """
+    def __init__(self, store_path):
+        self.store_path = os.path.abspath(store_path)
+        meta = _read_meta(self.store_path)
+        if meta is None:
+            raise ValueError(f"{store_path} is not an array store (version {ARRAY_STORE_VERSION})")
+
+        self.grib_file = meta["grib_file"]
+        self.fingerprint = meta["fingerprint"]
+        self.backend = meta["backend"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.grid = meta["grid"]
+        self.n_points = meta["n_points"]
+        self.times = [tuple(time) for time in meta["times"]]
+        self.valid_times = np.array(meta["valid_times"], dtype="datetime64[s]")
+        self.fields = [(variable, level) for (variable, level) in meta["fields"]]
+        self._arrays = dict()
+        self._coordinates = dict()
+
+    def __repr__(self):
+        return f"ArrayStore({self.store_path!r}, {len(self.fields)} fields, {len(self.times)} times, {self.n_points} points)"
+
+    def __contains__(self, field):
+        return tuple(field) in self.fields
+
+    def _coordinate(self, name):
+        if name not in self._coordinates:
+            path = os.path.join(self.store_path, f"{name}.npy")
+            self._coordinates[name] = np.load(path, mmap_mode="r") if os.path.exists(path) else None
+        return self._coordinates[name]
+
+    @property
+    def lats(self):
+        return self._coordinate("lats")
+
+    @property
+    def lons(self):
+        return self._coordinate("lons")
+
+    @property
+    def pl(self):
+        return self._coordinate("pl")
+
+    def is_current(self):
+        """
+        Whether the grib file of the store is unchanged since the store was written.
+        """
+        return os.path.exists(self.grib_file) and _grib_file_fingerprint(self.grib_file) == self.fingerprint
+
+    def field(self, variable, level=0):
+        """
+        The (time, points) array of a variable and level, read only where it is sliced.
+        """
+        field = (variable, int(level))
+        if field not in self._arrays:
+            if field not in self.fields:
+                raise KeyError(f"{variable} - {level} is not in the array store {self.store_path}")
+            path = os.path.join(self.store_path, _field_name(*field))
+            if self.backend == "zarr":
+                self._arrays[field] = _zarr().open_array(path, mode="r")
+            else:
+                self._arrays[field] = np.load(f"{path}.npy", mmap_mode="r")
+        return self._arrays[field]
+
+    def values(self, variable, level=0, time=0):
+        """
+        Values of a variable and level at the time slice `time` (an index, or a valid time).
+        """
+        if not isinstance(time, (int, np.integer)):
+            matches = np.flatnonzero(self.valid_times == np.datetime64(time, "s"))
+            if not matches.size:
+                raise KeyError(f"{time} is not a valid time of the array store {self.store_path}")
+            time = int(matches[0])
+        return np.asarray(self.field(variable, level)[time])
+
+def open_array_store(store_path):
+    """
+    Open an array store written by `grib_to_array_store`.
+
+    Parameters
+    ----------
+    store_path : str
+        The store, or a grib file whose store (at the default path) is written first if needed.
+
+    Returns
+    -------
+    ArrayStore
+    """
+    if os.path.isfile(store_path):
+        store_path = grib_to_array_store(store_path)
+    return ArrayStore(store_path)
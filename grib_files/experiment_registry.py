@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import sqlite3
+
+from logger import logger
+
+GRIB_ROOT_DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+GRIB_DIR_PATH = os.path.join(GRIB_ROOT_DIR_PATH, 'experiments_grib_files')
+TEST_GRIB_DIR_PATH = os.path.join(GRIB_ROOT_DIR_PATH, '_test_grib_file')
+
+EXPERIMENT_REGISTRY_FILE = "experiments_registry.sqlite"
+EXPERIMENT_REGISTRY_VERSION = 1
+
+GRIB_EXTENSIONS = [".grib", ".grb"]
+
+# keys of the input grib file in the configs written by the different perturbation functions
+INPUT_GRIB_KEYS = ["grib_file", "input_grib", "grib_file_name"]
+
+_LEAD_TIME_PATTERN = re.compile(r"_(\d+)h_pred")
+
+_registries = dict()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS registry (version INTEGER);
+CREATE TABLE IF NOT EXISTS grib_files (
+    name TEXT PRIMARY KEY,
+    path TEXT,
+    init_date TEXT,
+    lead_time INTEGER,
+    perturbed INTEGER,
+    original INTEGER,
+    prediction INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS experiments (
+    name TEXT PRIMARY KEY,
+    cfg_file TEXT,
+    params TEXT,
+    variable TEXT,
+    level INTEGER,
+    input_grib TEXT,
+    output_grib TEXT,
+    init_date TEXT,
+    lead_time INTEGER,
+    cache_id TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS grib_files_init_date ON grib_files (init_date);
+CREATE INDEX IF NOT EXISTS experiments_variable ON experiments (variable, level);
+"""
+
+def _init_date(name):
+    date = name.split("_")[0]
+    return date if date.isdigit() and len(date) == 8 else None
+
+def _lead_time(name):
+    match = _LEAD_TIME_PATTERN.search(name)
+    return int(match.group(1)) if match else None
+
+class ExperimentRegistry:
+    """
+    SQLite index of the grib files and perturbation configs (`*_cfg.json`) of an experiments directory.
+
+    Use `get_experiment_registry` to obtain one. Nothing is read when it is
+    created: the first query brings the index up to date by listing the
+    directory once and only loading the configs added or modified since the
+    last run (the index is stored in the directory, EXPERIMENT_REGISTRY_FILE).
+    The perturbation functions register the configs they write, see
+    `register_cfg`.
+    """
+    def __init__(self, directory=GRIB_DIR_PATH):
+        self.directory = os.path.abspath(directory)
+        self.db_file = os.path.join(self.directory, EXPERIMENT_REGISTRY_FILE)
+        self._connection = None
+        self._pid = None
+        self._refreshed = False
+
+    def _connect(self):
+        # a connection can not be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            try:
+                self._connection = sqlite3.connect(self.db_file, timeout=30)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"could not open the experiment registry {self.db_file}, it is kept in memory: {e}")
+                self._connection = sqlite3.connect(":memory:")
+            self._pid = os.getpid()
+
+            version = None
+            try:
+                version = self._connection.execute("SELECT version FROM registry").fetchone()
+            except sqlite3.OperationalError:
+                pass
+            if version is None or version[0] != EXPERIMENT_REGISTRY_VERSION:
+                with self._connection:
+                    self._connection.executescript(
+                        "DROP TABLE IF EXISTS registry; DROP TABLE IF EXISTS grib_files; DROP TABLE IF EXISTS experiments;")
+                    self._connection.executescript(_SCHEMA)
+                    self._connection.execute("INSERT INTO registry VALUES (?)", (EXPERIMENT_REGISTRY_VERSION,))
+
+        return self._connection
+
+    def _query(self, sql, parameters=()):
+        if not self._refreshed:
+            self.refresh()
+        return self._connect().execute(sql, parameters).fetchall()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the directory, loading only the new and modified files.
+        """
+        connection = self._connect()
+        self._refreshed = True
+        if not os.path.isdir(self.directory):
+            return
+
+        known = {
+            table: dict(connection.execute(f"SELECT name, mtime_ns FROM {table}").fetchall())
+            for table in ["grib_files", "experiments"]
+        }
+        seen = {"grib_files": set(), "experiments": set()}
+
+        with connection:
+            for entry in os.scandir(self.directory):
+                name, extension = os.path.splitext(entry.name)
+                if extension in GRIB_EXTENSIONS:
+                    table = "grib_files"
+                elif extension == ".json" and name.endswith("_cfg"):
+                    table, name = "experiments", name[:-len("_cfg")]
+                else:
+                    continue
+
+                stat = entry.stat()
+                seen[table].add(name)
+                if known[table].get(name) == stat.st_mtime_ns:
+                    continue
+
+                if table == "grib_files":
+                    self._insert_grib_file(connection, name, entry.path, stat)
+                else:
+                    try:
+                        with open(entry.path, "r") as f:
+                            params = json.load(f)
+                    except (OSError, ValueError) as e:
+                        logger.warning(f"could not read the config {entry.path}: {e}")
+                        continue
+                    self._insert_experiment(connection, name, entry.path, params, stat.st_mtime_ns)
+
+            for table in ["grib_files", "experiments"]:
+                connection.executemany(
+                    f"DELETE FROM {table} WHERE name = ?", [(name,) for name in set(known[table]) - seen[table]])
+
+    def _insert_grib_file(self, connection, name, path, stat):
+        connection.execute(
+            "INSERT OR REPLACE INTO grib_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, path, _init_date(name), _lead_time(name), "pert" in name and "orig_init" not in name,
+             "orig_init" in name, "pred" in name, stat.st_size, stat.st_mtime_ns))
+
+    def _insert_experiment(self, connection, name, cfg_file, params, mtime_ns, output_grib=None, cache_id=None):
+        try:
+            level = int(params.get("level"))
+        except (TypeError, ValueError):
+            level = None
+        input_grib = next((params[key] for key in INPUT_GRIB_KEYS if key in params), None)
+        connection.execute(
+            "INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, cfg_file, json.dumps(params), params.get("variable"), level, input_grib, output_grib,
+             _init_date(name), _lead_time(name), cache_id, mtime_ns))
+
+    def register_cfg(self, cfg_file, params, output_grib_file=None, cache_id=None):
+        """
+        Add (or update) the config of a perturbation just written, without rescanning the directory.
+        """
+        connection = self._connect()
+        name = os.path.splitext(os.path.basename(cfg_file))[0]
+        name = name[:-len("_cfg")] if name.endswith("_cfg") else name
+        with connection:
+            self._insert_experiment(
+                connection, name, os.path.abspath(cfg_file), params, os.stat(cfg_file).st_mtime_ns,
+                output_grib=output_grib_file, cache_id=cache_id)
+
+    def grib_files_paths(self):
+        """
+        Path of every grib file of the directory, keyed on its name without extension.
+        """
+        return dict(self._query("SELECT name, path FROM grib_files ORDER BY name"))
+
+    def pert_cfgs(self):
+        """
+        Parameters of every config of the directory, keyed on its name without extension (`<name>_cfg`).
+        """
+        return {f"{name}_cfg": json.loads(params) for (name, params) in self._query("SELECT name, params FROM experiments ORDER BY name")}
+
+    def init_dates(self):
+        return [date for (date,) in self._query(
+            "SELECT DISTINCT init_date FROM grib_files WHERE init_date IS NOT NULL ORDER BY init_date")]
+
+    def grib_files(self, init_date=None, original=None, perturbed=None, prediction=None, lead_time=None):
+        """
+        Paths of the grib files matching all the given criteria, keyed on their names.
+        """
+        conditions, parameters = list(), list()
+        for (column, value) in [("init_date", init_date), ("original", original), ("perturbed", perturbed),
+                                ("prediction", prediction), ("lead_time", lead_time)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return dict(self._query(f"SELECT name, path FROM grib_files {where} ORDER BY name", parameters))
+
+    def experiments(self, variable=None, level=None, init_date=None):
+        """
+        Parameters of the configs matching all the given criteria, keyed on their names.
+        """
+        conditions, parameters = list(), list()
+        for (column, value) in [("variable", variable), ("level", level), ("init_date", init_date)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return {name: json.loads(params) for (name, params) in self._query(f"SELECT name, params FROM experiments {where} ORDER BY name", parameters)}
+
+    def experiment_params(self, name):
+        """
+        Parameters of the perturbation of a grib file: its own config, or for a prediction
+        (`<name>_<lead>h_pred`) the config of the perturbed file it was run from.
+        """
+        for candidate in [name, _LEAD_TIME_PATTERN.split(name)[0]]:
+            rows = self._query("SELECT params FROM experiments WHERE name = ?", (candidate,))
+            if rows:
+                return json.loads(rows[0][0])
+        return {}
+
+def get_experiment_registry(directory=GRIB_DIR_PATH):
+    """
+    The (lazily loaded) experiment registry of a directory, see `ExperimentRegistry`.
+    """
+    directory = os.path.abspath(directory)
+    if directory not in _registries:
+        _registries[directory] = ExperimentRegistry(directory)
+    return _registries[directory]
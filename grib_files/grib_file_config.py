@@ -51,4 +51,6 @@ VALID_VARIABLES_DICT['z'] = [0] + LEVELS
 
 # grid limits
 LAT_MIN_LIM, LAT_MAX_LIM = -90, 90
-LON_MIN_LIM, LON_MAX_LIM = -180, 180
\ No newline at end of file
+LON_MIN_LIM, LON_MAX_LIM = -180, 180
+# longitudes of the grid points, the bounds of a box covering the whole grid
+GRID_LON_MIN, GRID_LON_MAX = 0, 360
\ No newline at end of file
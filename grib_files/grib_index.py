@@ -0,0 +1,221 @@
+import os
+import json
+import mmap
+import hashlib
+
+import pygrib
+
+from .validate_grib_file import GribInventory
+from logger import logger
+
+GRIB_INDEX_EXTENSION = ".idx"
+GRIB_INDEX_VERSION = 1
+
+# keys stored for every message in the index, on top of its byte offset and length
+GRIB_INDEX_KEYS = ["shortName", "level", "dataDate", "dataTime", "step"]
+
+# in-memory cache of the loaded indexes, keyed on (path, size, mtime)
+_grib_indexes = dict()
+
+# size of the blocks read when hashing the content of a grib file
+CONTENT_HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+def _grib_file_fingerprint(grib_file):
+    stat = os.stat(grib_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _message_length(header):
+    """
+    Total length in bytes of a grib message, read from its indicator section.
+    """
+    edition = header[7]
+    if edition == 1:
+        length = int.from_bytes(header[4:7], "big")
+        if length & 0x800000:
+            raise ValueError("large GRIB1 messages (> 8 MB) are not supported by the grib index")
+        return length
+    if edition == 2:
+        return int.from_bytes(header[8:16], "big")
+    raise ValueError(f"unknown grib edition {edition}")
+
+def scan_grib_messages(grib_file):
+    """
+    Yield the (offset, length) of every message in a grib file without decoding it.
+    """
+    with open(grib_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = mm.find(b"GRIB")
+            while offset != -1 and offset + 16 <= len(mm):
+                length = _message_length(mm[offset:offset + 16])
+                yield offset, length
+                offset = mm.find(b"GRIB", offset + length)
+
+def build_grib_index(grib_file):
+    """
+    Build the message index of a grib file.
+
+    The file is walked once: messages are located from their indicator section and
+    only their header keys are decoded.
+
+    Returns
+    -------
+    list of dict
+        One entry per message, in file order, with the GRIB_INDEX_KEYS plus the
+        `offset` and `length` of the message in bytes.
+    """
+    messages = list()
+    with open(grib_file, "rb") as f:
+        for (offset, length) in scan_grib_messages(grib_file):
+            f.seek(offset)
+            grb = pygrib.fromstring(f.read(length))
+            entry = {key: grb[key] if key == "shortName" else int(grb[key]) for key in GRIB_INDEX_KEYS}
+            entry["offset"] = offset
+            entry["length"] = length
+            messages.append(entry)
+    return messages
+
+class GribIndex:
+    """
+    Byte offsets of the messages of a grib file, keyed on shortName, level and dataTime.
+
+    Use `get_grib_index` to obtain one: the index is built once and stored in a
+    sidecar file next to the grib file (`<grib_file>.idx`), which is reused as
+    long as the size and modification time of the grib file do not change.
+    """
+    def __init__(self, grib_file, messages, fingerprint=None, content_hash=None):
+        self.grib_file = grib_file
+        self.messages = messages
+        self.fingerprint = fingerprint
+        self._content_hash = content_hash
+
+        self._keys = dict()
+        for entry in messages:
+            key = (entry["shortName"], entry["level"], entry["dataTime"])
+            self._keys.setdefault(key, list()).append(entry)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def select(self, short_name=None, level=None, data_time=None):
+        """
+        Index entries matching the given shortName, level and dataTime (None matches all), in file order.
+        """
+        if short_name is not None and level is not None and data_time is not None:
+            return list(self._keys.get((short_name, int(level), int(data_time)), []))
+
+        return [
+            entry for entry in self.messages
+            if (short_name is None or entry["shortName"] == short_name)
+            and (level is None or entry["level"] == int(level))
+            and (data_time is None or entry["dataTime"] == int(data_time))
+        ]
+
+    def content_hash(self):
+        """
+        Hash (blake2b) of the bytes of the grib file, computed once and stored with the index.
+        """
+        if self._content_hash is None:
+            digest = hashlib.blake2b(digest_size=20)
+            with open(self.grib_file, "rb") as f:
+                for block in iter(lambda: f.read(CONTENT_HASH_BLOCK_SIZE), b""):
+                    digest.update(block)
+            self._content_hash = digest.hexdigest()
+
+            if self.fingerprint is not None:
+                _write_grib_index_file(self.grib_file, self.fingerprint, self.messages, self._content_hash)
+
+        return self._content_hash
+
+    def inventory(self):
+        inventory = GribInventory()
+        for entry in self.messages:
+            inventory.add(entry["shortName"], entry["level"], entry["dataTime"])
+        return inventory
+
+    def read_bytes(self, entry):
+        with open(self.grib_file, "rb") as f:
+            return os.pread(f.fileno(), entry["length"], entry["offset"])
+
+    def read_message(self, entry):
+        return pygrib.fromstring(self.read_bytes(entry))
+
+    def iter_messages(self, entries=None):
+        """
+        Yield the decoded grib messages of the given index entries (all of them by default).
+        """
+        entries = self.messages if entries is None else entries
+        with open(self.grib_file, "rb") as f:
+            for entry in entries:
+                yield pygrib.fromstring(os.pread(f.fileno(), entry["length"], entry["offset"]))
+
+def grib_index_path(grib_file):
+    return f"{grib_file}{GRIB_INDEX_EXTENSION}"
+
+def _load_grib_index_file(grib_file, fingerprint):
+    index_file = grib_index_path(grib_file)
+    if not os.path.exists(index_file):
+        return None
+
+    try:
+        with open(index_file, "r") as f:
+            content = json.load(f)
+    except (OSError, ValueError):
+        logger.warning(f"could not read the grib index {index_file}, it will be rebuilt")
+        return None
+
+    if content.get("version") != GRIB_INDEX_VERSION or content.get("fingerprint") != fingerprint:
+        return None
+
+    return content
+
+def _write_grib_index_file(grib_file, fingerprint, messages, content_hash=None):
+    index_file = grib_index_path(grib_file)
+    tmp_index_file = f"{index_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_index_file, "w") as f:
+            json.dump({
+                "version": GRIB_INDEX_VERSION,
+                "grib_file": os.path.basename(grib_file),
+                "fingerprint": fingerprint,
+                "content_hash": content_hash,
+                "messages": messages,
+            }, f)
+        os.replace(tmp_index_file, index_file)
+    except OSError as e:
+        logger.warning(f"could not store the grib index next to {grib_file}: {e}")
+
+def get_grib_index(grib_file, rebuild=False):
+    """
+    Load the message index of a grib file, building and storing it if needed.
+
+    Parameters
+    ----------
+    grib_file : str
+        Path to the grib file.
+    rebuild : bool, optional
+        Ignore any stored index and rebuild it. Default is False.
+
+    Returns
+    -------
+    GribIndex
+    """
+    grib_file = os.path.abspath(grib_file)
+    fingerprint = _grib_file_fingerprint(grib_file)
+    cache_key = (grib_file, fingerprint["size"], fingerprint["mtime_ns"])
+
+    if not rebuild and cache_key in _grib_indexes:
+        return _grib_indexes[cache_key]
+
+    content = None if rebuild else _load_grib_index_file(grib_file, fingerprint)
+
+    if content is None:
+        logger.debug(f"building grib index of {grib_file}")
+        content = {"messages": build_grib_index(grib_file)}
+        _write_grib_index_file(grib_file, fingerprint, content["messages"])
+
+    grib_index = GribIndex(grib_file, content["messages"], fingerprint=fingerprint, content_hash=content.get("content_hash"))
+    _grib_indexes[cache_key] = grib_index
+
+    return grib_index
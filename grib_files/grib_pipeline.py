@@ -0,0 +1,368 @@
+import os
+import threading
+from uuid import uuid4
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pygrib
+import numpy as np
+
+from .validate_grib_file import GribInventory
+from .grib_index import get_grib_index
+from logger import logger, instrumentation
+
+# size of the chunks used when the raw bytes of a message cannot be copied in kernel space
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# messages submitted to the pool ahead of the writer, per worker
+ENCODE_QUEUE_DEPTH = 2
+
+# type of the field values the perturbations work on: the values are packed on 16 to 24 bits
+# in the grib files, float32 keeps them exact to well below the packing precision
+FIELD_DTYPE = np.float32
+
+# reusable field buffers of every thread, see read_values
+_field_buffers = threading.local()
+
+def read_values(grb, dtype=FIELD_DTYPE, reuse=False):
+    """
+    Decoded values of a message as `dtype`, timed as the decoding stage of the run.
+
+    With `reuse` the values are decoded into a buffer of the calling thread that is
+    reused by its next `read_values(..., reuse=True)` on a field of the same size:
+    only for values that are perturbed in place and written back (`write_values`)
+    before the next message is read.
+
+    Parameters
+    ----------
+    grb : pygrib.gribmessage
+        The message, with `expand_grid(False)` on a reduced grid.
+    dtype : numpy.dtype, optional
+        Type of the values, FIELD_DTYPE (float32) by default, None for the float64 of pygrib.
+    reuse : bool, optional
+        Decode into the buffer of the thread. Default is False.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    with instrumentation.stage("decoding"):
+        values = grb.values
+        if dtype is None or values.dtype == dtype:
+            return values
+        if not reuse or np.ma.isMaskedArray(values):
+            return values.astype(dtype)
+
+        buffers = _field_buffers.__dict__.setdefault("buffers", dict())
+        buffer = buffers.get((values.size, np.dtype(dtype)))
+        if buffer is None:
+            buffer = buffers[(values.size, np.dtype(dtype))] = np.empty(values.size, dtype=dtype)
+        np.copyto(buffer, values.reshape(-1), casting="same_kind")
+        return buffer.reshape(values.shape)
+
+def write_values(grb, values):
+    """
+    Set the values of a message, timed as the encoding stage of the run.
+    """
+    with instrumentation.stage("encoding"):
+        grb.values = values
+
+def _write_message(out_file, message):
+    with instrumentation.stage("writing"):
+        out_file.write(message)
+    instrumentation.count("bytes_written", len(message))
+    instrumentation.count("messages_reencoded")
+
+def _copy_bytes(src_fd, out_file, offset, length):
+    with instrumentation.stage("writing"):
+        copy_grib_bytes(src_fd, out_file, offset, length)
+    instrumentation.count("bytes_copied", length)
+
+def copy_grib_bytes(src_fd, out_file, offset, length):
+    """
+    Append `length` raw bytes read at `offset` of `src_fd` to `out_file`.
+
+    The bytes are copied without being decoded, with os.copy_file_range (or
+    os.sendfile) when the platform supports it and a pread/write loop otherwise.
+    """
+    out_file.flush()
+    dst_fd = out_file.fileno()
+
+    while length > 0:
+        copied = 0
+        try:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(src_fd, dst_fd, length, offset)
+            elif hasattr(os, "sendfile"):
+                copied = os.sendfile(dst_fd, src_fd, offset, length)
+        except OSError:
+            # e.g. EXDEV across file systems on older kernels
+            copied = 0
+
+        if not copied:
+            chunk = os.pread(src_fd, min(length, COPY_CHUNK_SIZE), offset)
+            if not chunk:
+                raise EOFError(f"unexpected end of file while copying {length} bytes at offset {offset}")
+            out_file.write(chunk)
+            out_file.flush()
+            copied = len(chunk)
+
+        offset += copied
+        length -= copied
+
+def _write_sequential(grib_file, out_file, select, perturb):
+    inventory = GribInventory()
+    perturbed_messages = 0
+
+    grbs = pygrib.open(grib_file)
+    try:
+        for grb in grbs:
+            instrumentation.count("messages_read")
+            with instrumentation.stage("validation"):
+                inventory.add(grb.shortName, grb.level, grb.dataTime)
+
+            if select(grb.shortName, grb.level, grb.dataTime):
+                with instrumentation.stage("arithmetic"):
+                    perturb(grb)
+                perturbed_messages += 1
+                with instrumentation.stage("encoding"):
+                    message = grb.tostring()
+                _write_message(out_file, message)
+            else:
+                # the untouched messages are written back as read
+                with instrumentation.stage("writing"):
+                    message = grb.tostring()
+                    out_file.write(message)
+                instrumentation.count("bytes_copied", len(message))
+    finally:
+        grbs.close()
+
+    return inventory, perturbed_messages
+
+def _write_indexed(grib_index, out_file, select, perturb):
+    perturbed_messages = 0
+
+    with open(grib_index.grib_file, "rb") as in_file:
+        src_fd = in_file.fileno()
+
+        # consecutive untouched messages are copied as a single byte range
+        run_offset, run_length = 0, 0
+
+        for entry in grib_index.messages:
+            if not select(entry["shortName"], entry["level"], entry["dataTime"]):
+                if run_length and run_offset + run_length == entry["offset"]:
+                    run_length += entry["length"]
+                else:
+                    if run_length:
+                        _copy_bytes(src_fd, out_file, run_offset, run_length)
+                    run_offset, run_length = entry["offset"], entry["length"]
+                continue
+
+            if run_length:
+                _copy_bytes(src_fd, out_file, run_offset, run_length)
+                run_length = 0
+
+            with instrumentation.stage("decoding"):
+                grb = pygrib.fromstring(os.pread(src_fd, entry["length"], entry["offset"]))
+            instrumentation.count("messages_read")
+            with instrumentation.stage("arithmetic"):
+                perturb(grb)
+            perturbed_messages += 1
+
+            with instrumentation.stage("encoding"):
+                message = grb.tostring()
+            _write_message(out_file, message)
+
+        if run_length:
+            _copy_bytes(src_fd, out_file, run_offset, run_length)
+
+    return perturbed_messages
+
+def write_perturbed_grib(grib_file, output_grib_file, select, perturb, use_index=False):
+    """
+    Validate and rewrite a grib file in a single pass.
+
+    Every message is added to a GribInventory while it is being written, so the
+    input file is only opened and walked once. The output is written to a
+    temporary file next to `output_grib_file` and only renamed into place if the
+    inventory is valid; on an invalid input the temporary file is removed and
+    nothing is written.
+
+    With `use_index` the inventory comes from the message index and only the
+    selected messages are decoded, perturbed and re-encoded: all the other
+    messages are copied byte for byte from the input file, so the cost of a run
+    is roughly proportional to the size of the perturbed fields.
+
+    Parameters
+    ----------
+    grib_file : str
+        Path to the input grib file.
+    output_grib_file : str
+        Path to the output grib file.
+    select : callable
+        `select(short_name, level, data_time)` returns True for the messages that
+        have to be perturbed.
+    perturb : callable
+        `perturb(grb)` modifies the selected message in place (e.g. sets `grb.values`).
+    use_index : bool, optional
+        Use the message index of the grib file (see `get_grib_index`). The file is
+        then validated from the index before anything is written. Default is False.
+
+    Returns
+    -------
+    tuple of (bool, int)
+        Whether the input grib file is valid and the number of perturbed messages.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_grib_file))
+    os.makedirs(output_dir, exist_ok=True)
+
+    grib_index = None
+    if use_index:
+        with instrumentation.stage("validation"):
+            grib_index = get_grib_index(grib_file)
+            valid_grib = grib_index.inventory().is_valid()
+        if not valid_grib:
+            logger.error(f"{grib_file} is not a valid grib file, {output_grib_file} was not written.")
+            return False, 0
+
+    tmp_grib_file = os.path.join(
+        output_dir, f".{os.path.basename(output_grib_file)}.{uuid4().hex[-8:]}.tmp")
+
+    try:
+        with open(tmp_grib_file, 'wb') as out_file:
+            if grib_index is not None:
+                inventory = None
+                perturbed_messages = _write_indexed(grib_index, out_file, select, perturb)
+            else:
+                inventory, perturbed_messages = _write_sequential(grib_file, out_file, select, perturb)
+    except BaseException:
+        os.remove(tmp_grib_file)
+        raise
+
+    if inventory is not None and not inventory.is_valid():
+        logger.error(f"{grib_file} is not a valid grib file, {output_grib_file} was not written.")
+        os.remove(tmp_grib_file)
+        return False, perturbed_messages
+
+    os.replace(tmp_grib_file, output_grib_file)
+
+    return True, perturbed_messages
+
+def _write_encoded(grib_index, out_file, payloads, encode, executor, queue_depth):
+    """
+    Write the messages of `grib_index` in file order, the selected ones encoded by `encode`.
+
+    The queue holds, in file order, the byte ranges to copy and the messages being
+    encoded; its head is written as soon as it is ready, so the output keeps the
+    original message order while at most `queue_depth` messages are in flight.
+    """
+    queue = deque()
+    in_flight, encoded_messages = 0, 0
+
+    def write_head(src_fd):
+        item = queue.popleft()
+        if item[0] == "copy":
+            _copy_bytes(src_fd, out_file, item[1], item[2])
+            return 0
+        if executor is not None:
+            # time spent waiting for the workers
+            with instrumentation.stage("encoding"):
+                message = item[1].result()
+        else:
+            message = item[1]
+        _write_message(out_file, message)
+        return 1
+
+    with open(grib_index.grib_file, "rb") as in_file:
+        src_fd = in_file.fileno()
+
+        for entry in grib_index.messages:
+            key = (entry["shortName"], entry["level"], entry["dataTime"])
+
+            if key not in payloads:
+                # consecutive untouched messages are copied as a single byte range
+                if queue and queue[-1][0] == "copy" and queue[-1][1] + queue[-1][2] == entry["offset"]:
+                    queue[-1] = ("copy", queue[-1][1], queue[-1][2] + entry["length"])
+                else:
+                    queue.append(("copy", entry["offset"], entry["length"]))
+                continue
+
+            message = os.pread(src_fd, entry["length"], entry["offset"])
+            instrumentation.count("messages_read")
+            if executor is not None:
+                queue.append(("message", executor.submit(encode, message, payloads[key])))
+            else:
+                with instrumentation.stage("arithmetic"):
+                    queue.append(("message", encode(message, payloads[key])))
+            in_flight += 1
+            encoded_messages += 1
+
+            while in_flight > queue_depth:
+                in_flight -= write_head(src_fd)
+
+        while queue:
+            write_head(src_fd)
+
+    return encoded_messages
+
+def write_encoded_grib(grib_file, output_grib_file, payloads, encode, jobs=1):
+    """
+    Rewrite a grib file, re-encoding the selected messages in a pool of processes.
+
+    Unlike `write_perturbed_grib`, which takes closures, the work to do on a
+    message is described by picklable data: every message whose
+    (shortName, level, dataTime) is a key of `payloads` is sent to a worker as
+    raw bytes together with its payload, and `encode(message_bytes, payload)`
+    returns the bytes of the new message. The other messages are copied byte for
+    byte, and the output keeps the original message order.
+
+    The grib file is validated from its message index before anything is
+    written, and the output is renamed into place once complete.
+
+    Parameters
+    ----------
+    grib_file : str
+        Path to the input grib file.
+    output_grib_file : str
+        Path to the output grib file.
+    payloads : dict
+        Picklable payload of every message to re-encode, keyed on (shortName, level, dataTime).
+    encode : callable
+        Module-level function `encode(message_bytes, payload)` returning the encoded message.
+    jobs : int, optional
+        Number of worker processes, 1 encodes in the calling process. Default is 1.
+
+    Returns
+    -------
+    tuple of (bool, int)
+        Whether the input grib file is valid and the number of re-encoded messages.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_grib_file))
+    os.makedirs(output_dir, exist_ok=True)
+
+    with instrumentation.stage("validation"):
+        grib_index = get_grib_index(grib_file)
+        valid_grib = grib_index.inventory().is_valid()
+    if not valid_grib:
+        logger.error(f"{grib_file} is not a valid grib file, {output_grib_file} was not written.")
+        return False, 0
+
+    tmp_grib_file = os.path.join(
+        output_dir, f".{os.path.basename(output_grib_file)}.{uuid4().hex[-8:]}.tmp")
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+    try:
+        with open(tmp_grib_file, 'wb') as out_file:
+            encoded_messages = _write_encoded(
+                grib_index, out_file, payloads, encode, executor, ENCODE_QUEUE_DEPTH * max(jobs, 1))
+    except BaseException:
+        os.remove(tmp_grib_file)
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    os.replace(tmp_grib_file, output_grib_file)
+
+    return True, encoded_messages
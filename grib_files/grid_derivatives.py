@@ -0,0 +1,71 @@
+import numpy as np
+
+from .spatial_index import EARTH_RADIUS_KM, _point_rows
+
+EARTH_RADIUS_M = EARTH_RADIUS_KM * 1000.
+
+def _grid_rows(geometry):
+    pl = _point_rows(geometry)
+    if pl is None:
+        raise ValueError(f"derivatives need a grid stored row by row, {geometry.key} is not")
+
+    row_offsets = np.concatenate([[0], np.cumsum(pl)])
+    row_lats = geometry.lats[row_offsets[:-1]]
+    row_lon0 = geometry.lons[row_offsets[:-1]]
+    point_rows = np.repeat(np.arange(pl.size), pl)
+
+    return pl, row_offsets, row_lats, row_lon0, point_rows
+
+def _interpolate_in_rows(field, pl, row_offsets, row_lon0, rows, lons):
+    """
+    Values of `field` at longitudes `lons` of the rows `rows`, linearly interpolated along the rows.
+    """
+    position = ((lons - row_lon0[rows]) % 360.) / (360. / pl[rows])
+    column = np.floor(position).astype(np.int64)
+    weight = position - column
+    west = row_offsets[rows] + column % pl[rows]
+    east = row_offsets[rows] + (column + 1) % pl[rows]
+    return field[west] * (1 - weight) + field[east] * weight
+
+def grid_gradient(geometry, field):
+    """
+    Eastward and northward derivatives (per metre) of a field on a grid stored row by row.
+
+    The eastward derivative is a centred difference along the row of every point,
+    the northward one a centred difference between the rows above and below,
+    interpolated at the longitude of the point (one-sided on the first and last
+    rows), so it works on reduced Gaussian grids with a different number of
+    points per row.
+
+    Parameters
+    ----------
+    geometry : GridGeometry
+        Geometry of the grid.
+    field : numpy.ndarray
+        One value per grid point.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+    """
+    pl, row_offsets, row_lats, row_lon0, point_rows = _grid_rows(geometry)
+    field = np.asarray(field, dtype=np.float64).reshape(-1)
+
+    columns = np.arange(field.size) - row_offsets[point_rows]
+    east = row_offsets[point_rows] + (columns + 1) % pl[point_rows]
+    west = row_offsets[point_rows] + (columns - 1) % pl[point_rows]
+
+    cos_lats = np.cos(np.radians(geometry.lats))
+    dx = 2 * EARTH_RADIUS_M * cos_lats * np.radians(360. / pl[point_rows])
+    dfdx = np.divide(field[east] - field[west], dx, out=np.zeros(field.size), where=cos_lats > 1e-6)
+
+    # rows go from north to south
+    north = np.maximum(point_rows - 1, 0)
+    south = np.minimum(point_rows + 1, pl.size - 1)
+    field_north = _interpolate_in_rows(field, pl, row_offsets, row_lon0, north, geometry.lons)
+    field_south = _interpolate_in_rows(field, pl, row_offsets, row_lon0, south, geometry.lons)
+    dy = EARTH_RADIUS_M * np.radians(row_lats[north] - row_lats[south])
+
+    dfdy = (field_north - field_south) / dy
+
+    return dfdx, dfdy
@@ -0,0 +1,156 @@
+import os
+import hashlib
+
+import numpy as np
+
+from logger import logger, instrumentation
+
+GRID_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '_grid_cache')
+
+# keys that, together with the pl array, define the geometry of a grid
+GRID_DEFINITION_KEYS = [
+    "gridType",
+    "N",
+    "Ni",
+    "Nj",
+    "numberOfDataPoints",
+    "latitudeOfFirstGridPointInDegrees",
+    "longitudeOfFirstGridPointInDegrees",
+    "latitudeOfLastGridPointInDegrees",
+    "longitudeOfLastGridPointInDegrees",
+]
+
+# in-memory cache of the loaded geometries, keyed on the grid key
+_grid_geometries = dict()
+
+class GridGeometry:
+    """
+    Latitudes and longitudes of the points of a grid, shared by all the messages on that grid.
+
+    On a reduced Gaussian grid the points are stored row by row (north to south),
+    row `i` holding `pl[i]` points; `row_offsets[i]` is the index of the first point
+    of row `i` and `row_offsets[-1]` the total number of points.
+    """
+    def __init__(self, key, lats, lons, pl=None, unique_lats=None, unique_lons=None):
+        self.key = key
+        self.lats = lats
+        self.lons = lons
+        self.pl = pl
+        self.unique_lats = np.unique(lats) if unique_lats is None else unique_lats
+        self.unique_lons = np.unique(lons) if unique_lons is None else unique_lons
+        self.row_offsets = None if pl is None else np.concatenate([[0], np.cumsum(pl)])
+        self._xyz = None
+
+    @property
+    def n_points(self):
+        return self.lats.size
+
+    @property
+    def xyz(self):
+        """
+        Unit-sphere (x, y, z) coordinates of the points, an (n_points, 3) array computed on first use.
+        """
+        if self._xyz is None:
+            self._xyz = unit_vectors(self.lats, self.lons)
+            self._xyz.setflags(write=False)
+        return self._xyz
+
+def unit_vectors(lats, lons):
+    """
+    Unit-sphere (x, y, z) coordinates of latitudes and longitudes in degrees.
+    """
+    lats, lons = np.radians(lats), np.radians(lons)
+    cos_lats = np.cos(lats)
+    return np.stack([cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)], axis=-1)
+
+def grid_key(grb):
+    """
+    Key identifying the geometry of the grid of a grib message (gridType, N and a hash of the grid definition and pl array).
+    """
+    definition = hashlib.sha1()
+    for key in GRID_DEFINITION_KEYS:
+        value = grb[key] if grb.has_key(key) else None
+        definition.update(f"{key}={value};".encode())
+
+    pl = grb["pl"] if grb.has_key("pl") else None
+    if pl is not None:
+        definition.update(np.asarray(pl, dtype=np.int64).tobytes())
+
+    n = grb["N"] if grb.has_key("N") else grb["numberOfDataPoints"]
+    return f"{grb['gridType']}_{n}_{definition.hexdigest()[:16]}"
+
+def _grid_cache_path(key):
+    return os.path.join(GRID_CACHE_DIR, f"{key}.npz")
+
+def _load_grid_geometry(key):
+    cache_file = _grid_cache_path(key)
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        with np.load(cache_file) as cached:
+            pl = cached["pl"] if "pl" in cached.files else None
+            return GridGeometry(
+                key, cached["lats"], cached["lons"], pl=pl,
+                unique_lats=cached["unique_lats"], unique_lons=cached["unique_lons"])
+    except (OSError, ValueError, KeyError):
+        logger.warning(f"could not read the grid geometry {cache_file}, it will be recomputed")
+        return None
+
+def _save_grid_geometry(geometry):
+    cache_file = _grid_cache_path(geometry.key)
+    tmp_cache_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+
+    arrays = {
+        "lats": geometry.lats,
+        "lons": geometry.lons,
+        "unique_lats": geometry.unique_lats,
+        "unique_lons": geometry.unique_lons,
+    }
+    if geometry.pl is not None:
+        arrays["pl"] = geometry.pl
+
+    try:
+        os.makedirs(GRID_CACHE_DIR, exist_ok=True)
+        np.savez(tmp_cache_file, **arrays)
+        os.replace(tmp_cache_file, cache_file)
+    except OSError as e:
+        logger.warning(f"could not store the grid geometry in {GRID_CACHE_DIR}: {e}")
+
+def get_grid_geometry(grb):
+    """
+    Geometry of the grid of a grib message.
+
+    The latitudes and longitudes are computed once per grid definition and cached
+    in memory and on disk (GRID_CACHE_DIR), so they are reused across messages,
+    runs and processes. The message is left with `expand_grid(False)`, the field
+    values are then read with `grb.values` in the same (reduced) point order.
+
+    Parameters
+    ----------
+    grb : pygrib.gribmessage
+        A message on the grid.
+
+    Returns
+    -------
+    GridGeometry
+    """
+    with instrumentation.stage("geometry"):
+        grb.expand_grid(False)
+        key = grid_key(grb)
+
+        geometry = _grid_geometries.get(key)
+        if geometry is not None:
+            return geometry
+
+        geometry = _load_grid_geometry(key)
+        if geometry is None:
+            logger.debug(f"computing the grid geometry {key}")
+            lats, lons = grb.latlons()
+            pl = np.asarray(grb["pl"], dtype=np.int64) if grb.has_key("pl") else None
+            geometry = GridGeometry(key, lats.reshape(-1), lons.reshape(-1), pl=pl)
+            _save_grid_geometry(geometry)
+
+        _grid_geometries[key] = geometry
+
+        return geometry
@@ -0,0 +1,352 @@
+from collections import OrderedDict
+from functools import wraps
+
+import numpy as np
+
+from .grid_geometry import unit_vectors
+from logger import instrumentation
+
+EARTH_RADIUS_KM = 6371.0
+
+# maximum number of region index arrays kept in memory
+MAX_CACHED_REGIONS = 256
+
+_region_indices = OrderedDict()
+
+def _region_cache(function):
+    """
+    Cache the index array (or arrays) of a region on (grid, region), so that a
+    region applied to many variables, levels or times is only computed once.
+    """
+    @wraps(function)
+    def wrapper(geometry, *args, **kwargs):
+        args = tuple(tuple(np.asarray(arg).tolist()) if np.ndim(arg) else arg for arg in args)
+        key = (function.__name__, geometry.key, args, tuple(sorted(kwargs.items())))
+        indices = _region_indices.get(key)
+        if indices is None:
+            with instrumentation.stage("masking"):
+                indices = function(geometry, *args, **kwargs)
+            for array in (indices if isinstance(indices, tuple) else (indices,)):
+                array.setflags(write=False)
+            _region_indices[key] = indices
+            if len(_region_indices) > MAX_CACHED_REGIONS:
+                _region_indices.popitem(last=False)
+        else:
+            _region_indices.move_to_end(key)
+        return indices
+    return wrapper
+
+def snap_to_grid(grid_values, value):
+    """
+    Move `value` by its distance to the closest of `grid_values`, the way the box bounds have always been snapped to the grid.
+    """
+    return float(np.abs(grid_values - value).min() + value)
+
+def _row_structure(geometry):
+    """
+    Latitude, first longitude and longitude increment of every row of a reduced Gaussian grid.
+    """
+    if getattr(geometry, "_rows", None) is None:
+        starts = geometry.row_offsets[:-1]
+        pl = geometry.pl
+        geometry._rows = (geometry.lats[starts], geometry.lons[starts], 360. / pl)
+    return geometry._rows
+
+def _concatenate_ranges(starts, counts):
+    """
+    Concatenation of `np.arange(start, start + count)` for every (start, count), without a python loop.
+    """
+    counts = np.maximum(counts, 0)
+    total = counts.sum()
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    shifts = np.repeat(starts - (ends - counts), counts)
+    return np.arange(total, dtype=np.int64) + shifts
+
+def _rows_between(geometry, lat_s, lat_n):
+    row_lats, _, _ = _row_structure(geometry)
+    return np.nonzero((row_lats >= lat_s) & (row_lats <= lat_n))[0]
+
+def _great_circle_distance(lats, lons, lat, lon):
+    """
+    Great-circle distance in km between (lats, lons) and the point (lat, lon), in degrees.
+    """
+    lats, lons = np.radians(lats), np.radians(lons)
+    lat, lon = np.radians(lat), np.radians(lon)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lats) * np.cos(lat) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0., 1.)))
+
+@_region_cache
+def box_indices(geometry, lat_s, lat_n, lon_w, lon_e, snap=False):
+    """
+    Indices of the grid points with lat_s <= lat <= lat_n and lon_w <= lon <= lon_e.
+
+    On a reduced Gaussian grid only the rows inside the latitude band are visited
+    and the longitude range of every row is computed from its number of points,
+    so the cost is proportional to the size of the box, not of the grid.
+
+    Parameters
+    ----------
+    geometry : GridGeometry
+        Geometry of the grid.
+    lat_s, lat_n, lon_w, lon_e : float
+        Bounds of the box in degrees, longitudes in the convention of the grid (0 to 360).
+    snap : bool, optional
+        Snap the bounds to the grid with `snap_to_grid` first. Default is False.
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted indices of the points inside the box (read-only, cached).
+    """
+    if snap:
+        lat_s, lat_n = snap_to_grid(geometry.unique_lats, lat_s), snap_to_grid(geometry.unique_lats, lat_n)
+        lon_w, lon_e = snap_to_grid(geometry.unique_lons, lon_w), snap_to_grid(geometry.unique_lons, lon_e)
+
+    lat_s, lat_n, lon_w, lon_e = float(lat_s), float(lat_n), float(lon_w), float(lon_e)
+
+    if geometry.pl is None:
+        lats, lons = geometry.lats, geometry.lons
+        return np.nonzero((lats >= lat_s) & (lats <= lat_n) & (lons >= lon_w) & (lons <= lon_e))[0]
+
+    rows = _rows_between(geometry, lat_s, lat_n)
+    _, row_lon0, row_dlon = _row_structure(geometry)
+
+    # one point of slack on each side, the bounds are then checked exactly on the candidates
+    first = np.floor((lon_w - row_lon0[rows]) / row_dlon[rows]).astype(np.int64) - 1
+    last = np.ceil((lon_e - row_lon0[rows]) / row_dlon[rows]).astype(np.int64) + 1
+    first = np.clip(first, 0, geometry.pl[rows] - 1)
+    last = np.clip(last, -1, geometry.pl[rows] - 1)
+
+    candidates = _concatenate_ranges(geometry.row_offsets[rows] + first, last - first + 1)
+    lons = geometry.lons[candidates]
+
+    return candidates[(lons >= lon_w) & (lons <= lon_e)]
+
+@_region_cache
+def polygon_indices(geometry, polygon_lats, polygon_lons):
+    """
+    Indices of the grid points inside an arbitrary polygon.
+
+    The candidates are the points of the bounding box of the polygon (see
+    `box_indices`), which are then tested with a vectorized even-odd rule in
+    the latitude/longitude plane.
+
+    Parameters
+    ----------
+    geometry : GridGeometry
+        Geometry of the grid.
+    polygon_lats, polygon_lons : tuple of float
+        Vertices of the polygon in degrees.
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted indices of the points inside the polygon (read-only, cached).
+    """
+    vertex_lats = np.asarray(polygon_lats, dtype=np.float64)
+    vertex_lons = np.asarray(polygon_lons, dtype=np.float64)
+
+    candidates = box_indices(
+        geometry, vertex_lats.min(), vertex_lats.max(), vertex_lons.min(), vertex_lons.max())
+    lats, lons = geometry.lats[candidates], geometry.lons[candidates]
+
+    inside = np.zeros(candidates.size, dtype=bool)
+    for (lat_1, lon_1, lat_2, lon_2) in zip(
+            vertex_lats, vertex_lons, np.roll(vertex_lats, -1), np.roll(vertex_lons, -1)):
+        if lat_1 == lat_2:
+            continue
+        crosses = (lats >= min(lat_1, lat_2)) & (lats < max(lat_1, lat_2))
+        lon_cross = lon_1 + (lats - lat_1) * (lon_2 - lon_1) / (lat_2 - lat_1)
+        inside ^= crosses & (lons < lon_cross)
+
+    # points lying exactly on an edge belong to the polygon, as they do for boxes
+    return candidates[inside | _on_polygon_edges(lats, lons, vertex_lats, vertex_lons)]
+
+def _on_polygon_edges(lats, lons, vertex_lats, vertex_lons):
+    on_edges = np.zeros(lats.size, dtype=bool)
+    for (lat_1, lon_1, lat_2, lon_2) in zip(
+            vertex_lats, vertex_lons, np.roll(vertex_lats, -1), np.roll(vertex_lons, -1)):
+        cross = (lons - lon_1) * (lat_2 - lat_1) - (lats - lat_1) * (lon_2 - lon_1)
+        within = (
+            (lats >= min(lat_1, lat_2)) & (lats <= max(lat_1, lat_2))
+            & (lons >= min(lon_1, lon_2)) & (lons <= max(lon_1, lon_2))
+        )
+        on_edges |= within & np.isclose(cross, 0.)
+    return on_edges
+
+@_region_cache
+def radius_indices(geometry, lat, lon, radius_km):
+    """
+    Indices of the grid points within `radius_km` great-circle distance of (lat, lon).
+
+    Only the rows inside the latitude band covered by the radius are visited.
+    """
+    lat_band = np.degrees(radius_km / EARTH_RADIUS_KM)
+
+    if geometry.pl is None:
+        candidates = np.nonzero(np.abs(geometry.lats - lat) <= lat_band)[0]
+    else:
+        rows = _rows_between(geometry, lat - lat_band, lat + lat_band)
+        candidates = _concatenate_ranges(geometry.row_offsets[rows], geometry.pl[rows])
+
+    distance = _great_circle_distance(geometry.lats[candidates], geometry.lons[candidates], lat, lon)
+
+    return candidates[distance <= radius_km]
+
+@_region_cache
+def nearest_index(geometry, lat, lon):
+    """
+    Index of the grid point nearest (great-circle distance) to (lat, lon), as a one element array.
+
+    On a reduced Gaussian grid only the closest point of the two rows on each
+    side of `lat` are compared.
+    """
+    if geometry.pl is None:
+        distance = _great_circle_distance(geometry.lats, geometry.lons, lat, lon)
+        return np.array([np.argmin(distance)], dtype=np.int64)
+
+    row_lats, row_lon0, row_dlon = _row_structure(geometry)
+
+    # rows go from north to south
+    row = np.searchsorted(-row_lats, -lat)
+    rows = np.arange(max(row - 2, 0), min(row + 2, row_lats.size))
+
+    columns = np.round(((lon - row_lon0[rows]) % 360.) / row_dlon[rows]).astype(np.int64) % geometry.pl[rows]
+    candidates = geometry.row_offsets[rows] + columns
+
+    distance = _great_circle_distance(geometry.lats[candidates], geometry.lons[candidates], lat, lon)
+
+    return candidates[[np.argmin(distance)]]
+
+@_region_cache
+def gaussian_weights(geometry, lat, lon, sigma_km, cutoff=3.):
+    """
+    Gaussian bump of the great-circle distance to (lat, lon), `exp(-d**2 / (2 * sigma_km**2))`.
+
+    The distances are computed from the unit-sphere coordinates of the grid
+    (`GridGeometry.xyz`) for the points within `cutoff * sigma_km` only.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Sorted indices of the points within the cutoff and their weights in (0, 1] (read-only, cached).
+    """
+    indices = radius_indices(geometry, lat, lon, cutoff * sigma_km)
+
+    chord = np.linalg.norm(geometry.xyz[indices] - unit_vectors(lat, lon), axis=1)
+    distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0., 1.))
+
+    return indices, np.exp(-0.5 * (distance / sigma_km) ** 2)
+
+def _cosine_taper(distance, width):
+    if width <= 0:
+        return (distance <= 0).astype(np.float64)
+    return 0.5 * (1 + np.cos(np.pi * np.clip(distance / width, 0., 1.)))
+
+@_region_cache
+def cosine_box_weights(geometry, lat_s, lat_n, lon_w, lon_e, taper_deg):
+    """
+    Box weights equal to 1 inside the box, going down to 0 with a cosine taper `taper_deg` degrees wide around it.
+
+    The longitudes wrap around 0/360: the box goes east from `lon_w` to `lon_e` and
+    its taper continues on the other side of the 0 meridian when it crosses it.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Sorted indices of the points of the box and its taper and their weights in (0, 1] (read-only, cached).
+    """
+    lon_width = lon_e - lon_w if lon_e - lon_w >= 360. else (lon_e - lon_w) % 360.
+    start = (lon_w - taper_deg) % 360.
+    end = start + lon_width + 2 * taper_deg
+
+    if end >= start + 360.:
+        indices = box_indices(geometry, lat_s - taper_deg, lat_n + taper_deg, 0., 360.)
+    elif end > 360.:
+        indices = np.union1d(
+            box_indices(geometry, lat_s - taper_deg, lat_n + taper_deg, start, 360.),
+            box_indices(geometry, lat_s - taper_deg, lat_n + taper_deg, 0., end - 360.))
+    else:
+        indices = box_indices(geometry, lat_s - taper_deg, lat_n + taper_deg, start, end)
+    lats, lons = geometry.lats[indices], geometry.lons[indices]
+
+    lat_distance = np.maximum(np.maximum(lat_s - lats, lats - lat_n), 0.)
+    # distance east of the box, and west of it going around the 0 meridian
+    lon_offset = (lons - lon_w) % 360.
+    lon_distance = np.where(lon_offset <= lon_width, 0., np.minimum(lon_offset - lon_width, 360. - lon_offset))
+
+    weights = _cosine_taper(lat_distance, taper_deg) * _cosine_taper(lon_distance, taper_deg)
+    inside = weights > 0
+
+    return indices[inside], weights[inside]
+
+def _point_rows(geometry):
+    """
+    Number of points of every row of a grid stored row by row (reduced Gaussian `pl`, or the runs of
+    equal latitudes of a regular grid), None if the points are not on rows of equally spaced longitudes.
+    """
+    if geometry.pl is not None:
+        return geometry.pl
+
+    starts = np.concatenate([[0], np.nonzero(np.diff(geometry.lats))[0] + 1])
+    pl = np.diff(np.concatenate([starts, [geometry.n_points]]))
+    if np.any(np.diff(geometry.lats[starts]) >= 0):
+        return None
+
+    # the longitudes of every row must be lon0 + k * 360 / pl
+    row_offsets = np.concatenate([[0], np.cumsum(pl)])
+    columns = np.arange(geometry.n_points) - np.repeat(row_offsets[:-1], pl)
+    expected = np.repeat(geometry.lons[starts], pl) + columns * np.repeat(360. / pl, pl)
+    if not np.allclose(geometry.lons, expected, atol=1e-6):
+        return None
+
+    return pl
+
+def nearest_indices(geometry, lats, lons):
+    """
+    Index of the grid point of `geometry` nearest to each of the points (lats, lons), vectorized.
+
+    On grids stored row by row (reduced Gaussian or regular) only the closest point
+    of the two rows on each side of every point are compared; other point sets need
+    scipy (cKDTree on the unit-sphere coordinates).
+
+    Parameters
+    ----------
+    geometry : GridGeometry
+        Geometry of the grid to look the points up in.
+    lats, lons : numpy.ndarray
+        Coordinates of the points in degrees.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    lats = np.asarray(lats, dtype=np.float64).reshape(-1)
+    lons = np.asarray(lons, dtype=np.float64).reshape(-1)
+
+    pl = _point_rows(geometry)
+    if pl is None:
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            raise ImportError("scipy is required to look up points on a grid that is not stored row by row")
+        return cKDTree(geometry.xyz).query(unit_vectors(lats, lons))[1]
+
+    row_offsets = np.concatenate([[0], np.cumsum(pl)])
+    row_lats = geometry.lats[row_offsets[:-1]]
+    row_lon0 = geometry.lons[row_offsets[:-1]]
+    row_dlon = 360. / pl
+
+    # rows go from north to south, the 4 rows around every point are compared
+    row = np.searchsorted(-row_lats, -lats)
+    rows = np.clip(row[:, None] + np.arange(-2, 2), 0, row_lats.size - 1)
+
+    columns = np.round(((lons[:, None] - row_lon0[rows]) % 360.) / row_dlon[rows]).astype(np.int64) % pl[rows]
+    candidates = row_offsets[rows] + columns
+
+    # the nearest point on the sphere has the largest dot product with the point
+    dot = np.einsum("pcj,pj->pc", geometry.xyz[candidates], unit_vectors(lats, lons))
+
+    return candidates[np.arange(lats.size), np.argmax(dot, axis=1)]
@@ -1,73 +1,65 @@
 from .grib_file_config import VARIABLES, LEVELS, VALID_VARIABLES_DICT
-from . import logger
+from logger import logger, instrumentation
 import pygrib
 
-def validate_grib_file(grib_file_path):
-    valid_grib = True
+class GribInventory:
+    """
+    Variable/level/time inventory of a grib file, accumulated one message at a time.
 
-    grbs = pygrib.open(grib_file_path)
+    The inventory lets validation run in the same pass that reads (or rewrites)
+    the messages instead of walking the whole file a second time.
+    """
+    def __init__(self):
+        self.invalid_columns = dict()
+        self.invalid_levels = dict()
+        self.all_time_columns_levels = dict()
 
-    invalid_columns = dict()
-    invalid_levels = dict()
-    time_levels = set()
-    columns = set()
+    def add(self, column_name, column_level, column_time):
+        if column_name not in VARIABLES:
+            self.invalid_columns.setdefault(column_time, []).append(column_name)
+        elif column_level not in VALID_VARIABLES_DICT[column_name]:
+            self.invalid_levels.setdefault(column_time, []).append((column_name, column_level))
 
-    all_time_columns_levels = dict()
+        all_columns_levels = self.all_time_columns_levels.setdefault(column_time, {})
+        all_columns_levels.setdefault(column_name, list()).append(column_level)
 
-    for grb in grbs:
+    def sorted_columns_levels(self):
+        return {
+            k1: {k2: sorted(v2) for (k2, v2) in sorted(v1.items())}
+            for (k1, v1) in sorted(self.all_time_columns_levels.items())
+        }
 
-        column_name = grb.shortName
-        column_level = grb.level
-        column_time = grb.dataTime
+    def is_valid(self):
+        valid_grib = True
 
-        all_columns_levels = all_time_columns_levels.get(column_time, {})
+        if self.invalid_columns:
+            logger.info(f"invalid grib:\nextra columns found:\n{self.invalid_columns}")
+            valid_grib = False
 
-        if column_name not in VARIABLES:
-            time_invalid_columns = invalid_columns.get(column_time, [])
-            time_invalid_columns.append(column_name)
-        
-        if column_level not in LEVELS:
-            time_invalid_levels = invalid_levels.get(column_time, [])
-            time_invalid_levels.append(column_name)
-
-        time_levels.add(column_time)
-        columns.add(column_name)
-
-        col = all_columns_levels.get(grb.shortName, list())
-        col.append(grb.level)
-        all_columns_levels[grb.shortName] = col
-
-        all_time_columns_levels[column_time] = all_columns_levels
-
-    grbs.close()
-    
-    # sort dict
-    sorted_level_3 = {
-        k1: {
-            k2: sorted(v2)
-            for k2, v2 in v1.items()
-        }
-        for k1, v1 in all_time_columns_levels.items()
-    }
+        if self.invalid_levels:
+            logger.info(f"invalid grib:\nextra levels found:\n{self.invalid_levels}")
+            valid_grib = False
 
-    sorted_level_2 = {
-        k1: dict(sorted(v1.items()))
-        for k1, v1 in sorted_level_3.items()
-    }
+        for (k, v) in self.sorted_columns_levels().items():
+            if v != VALID_VARIABLES_DICT:
+                logger.info(f"{k} time does not have all the variables and levels")
+                valid_grib = False
 
-    all_time_columns_levels = dict(sorted(sorted_level_2.items()))
+        return valid_grib
 
-    if invalid_columns:
-        logger.info(f"invalid grib:\nextra columns found:\n{invalid_columns}")
-        valid_grib = False
+def validate_grib_file(grib_file_path, use_index=False):
+    with instrumentation.stage("validation"):
+        if use_index:
+            from .grib_index import get_grib_index
+            return get_grib_index(grib_file_path).inventory().is_valid()
 
-    if invalid_levels:
-        print(f"invalid grib:\nextra levels found:\n{invalid_levels}")
-        valid_grib = False
+        inventory = GribInventory()
 
-    for (k,v) in all_time_columns_levels.items():
-        if v != VALID_VARIABLES_DICT:
-            print(f"{k} time does not have all the variables and levels")
-            valid_grib = False
-    
-    return valid_grib
\ No newline at end of file
+        grbs = pygrib.open(grib_file_path)
+
+        for grb in grbs:
+            inventory.add(grb.shortName, grb.level, grb.dataTime)
+
+        grbs.close()
+
+        return inventory.is_valid()
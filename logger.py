@@ -1,21 +1,62 @@
-import logging
+import io
+import os
+import json
 import time
+import queue
+import atexit
+import pstats
+import logging
+import logging.handlers
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# change this value to "DEBUG", "ERROR", etc. to adjust the logger level, or use --log_level / log_level in a config
+LOG_LEVEL = "INFO"
+
+LOG_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+}
 
-# change this value to "INFO", "ERROR", etc. to adjust the logger level
-LOG_LEVEL = "DEBUG"  
+# stages timed on the hot path of a perturbation run, see Logger.stage
+STAGES = ["validation", "decoding", "geometry", "masking", "arithmetic", "encoding", "writing"]
+
+# counters of a perturbation run, see Logger.count
+COUNTERS = ["messages_read", "messages_reencoded", "bytes_copied", "bytes_written", "points_modified", "points_clipped"]
+
+PROFILERS = ["cprofile", "tracemalloc"]
+
+# functions (cProfile) or allocation sites (tracemalloc) listed in a run report
+PROFILE_TOP = 25
 
 # custom formatter to include UTC timestamp, function name, level and message
 class CustomFormatter(logging.Formatter):
+    _second = None
+    _utc_time = None
+
     def formatTime(self, record, datefmt=None):
-        # Convert the timestamp to UTC
-        utc_time = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(record.created))
-        return utc_time
+        # Convert the timestamp to UTC, once per second
+        second = int(record.created)
+        if second != self._second:
+            self._second, self._utc_time = second, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(second))
+        return self._utc_time
 
     def format(self, record):
         record.utc_timestamp = self.formatTime(record)
         record.func_name = record.funcName  # Function name from which the log is called
         return super().format(record)
 
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the message is formatted by the listener thread, not in the perturbation loop
+        # (the arguments of a record must therefore not be modified after it is logged)
+        return record
+
 class Logger:
     _instance = None  # Class attribute to store the Logger instance
 
@@ -27,40 +68,183 @@ class Logger:
         return cls._instance
 
     def _initialize_logger(self, level):
-        # Dictionary to map string log levels to their corresponding values
-        levels = {
-            "DEBUG": logging.DEBUG,
-            "INFO": logging.INFO,
-            "WARNING": logging.WARNING,
-            "ERROR": logging.ERROR,
-            "CRITICAL": logging.CRITICAL,
-        }
-
         # Create a logger
         self.logger = logging.getLogger("custom_logger")
 
         # Set the logger level based on the input
-        self.logger.setLevel(levels.get(level.upper(), logging.INFO))
+        self.set_level(level)
+
+        # Create a stream handler to print logs to stdout
+        self.console_handler = logging.StreamHandler()
 
-        # Check if the logger already has handlers (to avoid duplicate handlers)
-        if not self.logger.handlers:
-            # Create a stream handler to print logs to stdout
-            console_handler = logging.StreamHandler()
+        # Set the custom format for the logs
+        formatter = CustomFormatter(
+            fmt="%(utc_timestamp)s | %(func_name)s | %(levelname)s | %(message)s"
+        )
+        self.console_handler.setFormatter(formatter)
 
-            # Set the custom format for the logs
-            formatter = CustomFormatter(
-                fmt="%(utc_timestamp)s | %(func_name)s | %(levelname)s | %(message)s"
-            )
-            console_handler.setFormatter(formatter)
+        # The records are put on a queue and written by a background thread, so that the
+        # perturbation loops never wait on the console
+        self._queue = queue.Queue()
+        self.queue_handler = _QueueHandler(self._queue)
+        self.listener = logging.handlers.QueueListener(self._queue, self.console_handler)
+        self.listener.start()
+        atexit.register(self.listener.stop)
 
-            # Add the handler to the logger
-            self.logger.addHandler(console_handler)
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.queue_handler)
+
+        # a forked worker does not inherit the listener thread, and exits without running
+        # atexit: its records are written directly
+        os.register_at_fork(after_in_child=self._log_synchronously)
+
+        self.profiler = None
+        # the stages being timed, per thread (the perturbation server handles requests in threads)
+        self._local = threading.local()
+        self.reset_run()
 
     def get_logger(self):
         return self.logger
 
-logger = Logger(LOG_LEVEL)
-logger = logger.get_logger()
+    def set_level(self, level):
+        """
+        Set the logger level, "DEBUG", "INFO", "WARNING", "ERROR" or "CRITICAL" (INFO if unknown).
+        """
+        self.logger.setLevel(LOG_LEVELS.get(str(level).upper(), logging.INFO))
+
+    def flush(self):
+        """
+        Wait until every record logged so far is written.
+        """
+        if self.queue_handler in self.logger.handlers:
+            self._queue.join()
+
+    def _log_synchronously(self):
+        self.logger.removeHandler(self.queue_handler)
+        self.logger.addHandler(self.console_handler)
+
+    def reset_run(self):
+        """
+        Start the instrumentation of a new perturbation run: stage timers and counters back to zero.
+        """
+        self.run_start = time.perf_counter()
+        self.stage_times = dict.fromkeys(STAGES, 0.)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._local.stages = list()
+        self._runs = 0
+        self._profile = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the run. Stages nest: the time of an inner stage is not counted in the outer one.
+        """
+        stages = self._local.__dict__.setdefault("stages", list())
+        now = time.perf_counter()
+        if stages:
+            outer = stages[-1]
+            self.stage_times[outer[0]] = self.stage_times.get(outer[0], 0.) + now - outer[1]
+        stages.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.stage_times[name] = self.stage_times.get(name, 0.) + now - stages.pop()[1]
+            if stages:
+                stages[-1][1] = now
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def enable_profiling(self, profiler):
+        """
+        Profile the next perturbation runs with "cprofile" or "tracemalloc" (None to stop), see `run`.
+        """
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f"unknown profiler {profiler}, expected one of {PROFILERS}")
+        self.profiler = profiler
+
+    @contextmanager
+    def run(self):
+        """
+        Instrument a perturbation run: the outermost run resets the timers and counters and starts the profiler, if enabled.
+
+        Only the runs of the main thread are instrumented, the requests handled in the
+        threads of the perturbation server would otherwise reset each other's counters.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        if self._runs == 0:
+            self.reset_run()
+            if self.profiler == "cprofile":
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+            elif self.profiler == "tracemalloc":
+                tracemalloc.start()
+        self._runs += 1
+        try:
+            yield
+        finally:
+            self._runs -= 1
+            if self._runs == 0:
+                self._stop_profiling()
+
+    def _stop_profiling(self):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile = None
+        if self.profiler == "tracemalloc" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def in_run(self):
+        return self._runs > 0 and threading.current_thread() is threading.main_thread()
+
+    def run_report(self):
+        """
+        Stage times (s), counters and wall time (s) of the current run.
+        """
+        return {
+            "wall_time": time.perf_counter() - self.run_start,
+            "stages": dict(self.stage_times),
+            "counters": dict(self.counters),
+        }
+
+    def write_run_report(self, report_file, **fields):
+        """
+        Write the run report (with `fields`) as JSON, and the profile of the run if profiling is enabled.
+
+        The cProfile statistics are saved next to the report (`.prof`, for pstats or snakeviz)
+        and their top functions added to the report, tracemalloc adds the peak traced memory
+        and the top allocation sites.
+        """
+        report = dict(fields, **self.run_report())
+
+        if self.profiler == "cprofile" and self._profile is not None:
+            self._profile.disable()
+            profile_file = f"{os.path.splitext(report_file)[0]}.prof"
+            self._profile.dump_stats(profile_file)
+            stream = io.StringIO()
+            pstats.Stats(self._profile, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            report["profile"] = {"profiler": "cprofile", "stats_file": profile_file, "top": stream.getvalue().splitlines()}
+            if self._runs:
+                self._profile.enable()
+        elif self.profiler == "tracemalloc" and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            report["profile"] = {
+                "profiler": "tracemalloc",
+                "peak_bytes": tracemalloc.get_traced_memory()[1],
+                "top": [str(statistic) for statistic in snapshot.statistics("lineno")[:PROFILE_TOP]],
+            }
+
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=4)
+
+        return report
+
+instrumentation = Logger(LOG_LEVEL)
+logger = instrumentation.get_logger()
 
 # Example usage of the logger
 def example_function(logger):
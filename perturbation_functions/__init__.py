@@ -1,17 +1,80 @@
 import sys, os
+import types
+import importlib
 
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 # Add dir2 to the Python path
 sys.path.append(ROOT_PATH)
 
-from grib_files.validate_grib_file import validate_grib_file
-from grib_files import *
+# public names of the package and the module they are defined in: the modules (and pygrib, numpy, grib_files)
+# are only imported when a name is first used, so that e.g. `perturbations_aifs.py --help` starts quickly
+_LAZY_ATTRIBUTES = {
+    "apply_thresholds": "helper_functions",
+    "threshold_rules": "helper_functions",
+    "PHYSICAL_BOUNDS": "helper_functions",
+    "output_cache_id": "output_cache",
+    "cached_output": "output_cache",
+    "evict_outputs": "output_cache",
+    "OUTPUT_CACHE_MAX_BYTES": "output_cache",
+    "perturb_by_polygons": "perturb_by_polygons",
+    "perturb_polygons_values": "perturb_by_polygons",
+    "polygon_labels": "perturb_by_polygons",
+    "perturb_regionally": "perturb_regionally",
+    "perturb_specific_location": "perturb_specific_location",
+    "perturbation_by_factor_list": "perturbation_by_factor_list",
+    "perturbation_by_factor": "perturbation_by_factor",
+    "perturbation_of_variable": "perturbation_of_variable",
+    "perturbation_phase": "perturbation_phase",
+    "perturb_smoothly": "perturb_smoothly",
+    "smooth_amplitude": "perturb_smoothly",
+    "perturb_smooth_values": "perturb_smoothly",
+    "perturb_by_pattern": "perturb_by_pattern",
+    "load_pattern": "perturb_by_pattern",
+    "perturb_column": "perturb_column",
+    "CONSISTENCY_RULES": "perturbation_consistency",
+    "saturation_specific_humidity": "perturbation_consistency",
+    "apply_perturbation_plan": "perturbation_plan",
+    "load_perturbation_plan": "perturbation_plan",
+    "generate_ensemble": "perturbation_ensemble",
+    "load_ensemble": "perturbation_ensemble",
+    "ensemble_members": "perturbation_ensemble",
+    "run_batch": "perturbation_batch",
+    "config_command": "perturbation_batch",
+    "config_operations": "perturbation_batch",
+    "load_custom_config": "custom_config",
+    "PerturbationServer": "perturbation_server",
+    "serve_perturbations": "perturbation_server",
+    "send_perturbation_request": "perturbation_server",
+}
 
-from .perturb_by_polygons import perturb_by_polygons
-from .perturb_regionally import perturb_regionally
-from .perturb_specific_location import perturb_specific_location
-from .perturbation_by_factor_list import perturbation_by_factor_list
-from .perturbation_by_factor import perturbation_by_factor
-from .perturbation_of_variable import perturbation_of_variable
-from .perturbation_phase import perturbation_phase
+__all__ = list(_LAZY_ATTRIBUTES)
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(f".{_LAZY_ATTRIBUTES[name]}", __name__), name)
+    else:
+        # the names of grib_files (validate_grib_file, get_grib_index, test_grib_files, ...) are available here too
+        try:
+            value = getattr(importlib.import_module("grib_files"), name)
+        except AttributeError:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+        if name in ("grib_files_paths", "grib_pert_cfgs"):
+            # listed on every access, see grib_files.__getattr__
+            return value
+
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+class _LazyPackage(types.ModuleType):
+    def __setattr__(self, name, value):
+        # importing a submodule sets it as an attribute of the package, it must not
+        # shadow the function of the same name (perturb_regionally, perturb_column, ...)
+        if name in _LAZY_ATTRIBUTES and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _LazyPackage
@@ -0,0 +1,50 @@
+# the CLI parses its config before importing any perturbation, keep this module free of heavy imports
+
+def load_custom_config(config_file):
+    """
+    Load a custom configuration file into a dictionary.
+
+    This function reads a configuration file, parses key-value pairs, and returns
+    them as a dictionary. It ignores lines that are empty, start with comments,
+    or begin with specific characters indicating non-configuration lines.
+
+    Parameters
+    ----------
+    config_file : str
+        The path to the configuration file to be loaded. The file should contain
+        key-value pairs in the format `key = value`. Lines starting with `#` or
+        `$` in the first line are ignored, as well as any subsequent lines that
+        are empty or start with `#`.
+
+    Returns
+    -------
+    dict
+        A dictionary containing the configuration parameters as key-value pairs.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the specified `config_file` does not exist.
+    PermissionError
+        If there are insufficient permissions to read the `config_file`.
+    ValueError
+        If a line in the configuration file does not contain an `=` separator
+        for key-value pairing.
+    """
+    config_dict = {}
+    with open(config_file, 'r') as f:
+        lines = f.readlines()
+
+        # ignore the first line if it starts with # or $
+        if lines and (lines[0].startswith('#') or lines[0].startswith('$')):
+            lines = lines[1:]
+
+        # parse the remaining lines
+        for line in lines:
+            line = line.strip()
+
+            # ignore empty lines and in-line comments
+            if line and not line.startswith("#"):
+                key, value = line.split("=", 1)
+                config_dict[key.strip()] = value.strip()
+    return config_dict
@@ -7,6 +7,7 @@ import os
 import json
 
 from uuid import uuid4
+from functools import wraps
 
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 OUTPUT_GRIB_PATH = os.path.join(ROOT_PATH, 'output_grib_files')
@@ -15,10 +16,142 @@ OUTPUT_GRIB_PATH = os.path.join(ROOT_PATH, 'output_grib_files')
 sys.path.append(ROOT_PATH)
 
 from grib_files import *
-from logger import logger
+from logger import logger, instrumentation
+
+# variables whose perturbed values within [thresn, thresx] are set to thresfix
+TEMPERATURE_VARIABLES = ['t', '2t', 'skt']
+
+# physical bounds the perturbed values are clipped to, (min, max) with None for no bound
+PHYSICAL_BOUNDS = {
+    't': (0., None),
+    '2t': (0., None),
+    'skt': (0., None),
+    '2d': (0., None),
+    'q': (0., None),
+    'tcw': (0., None),
+    'msl': (0., None),
+    'sp': (0., None),
+    'lsm': (0., 1.),
+    'sdor': (0., None),
+    'slor': (0., None),
+}
+
+def threshold_rules(variable, thresx=274.5, thresn=270., thresfix=274.5, rules=None):
+    """
+    Thresholding rules of a variable, applied in order to its perturbed values.
+
+    A rule either sets the values within a range to a fixed value,
+    {"range": [low, high], "value": value}, or clips them to bounds,
+    {"min": low, "max": high}. By default the temperature variables get the
+    [thresn, thresx] -> thresfix rule and every variable its PHYSICAL_BOUNDS;
+    `rules` ({variable: [rule, ...]}) replaces the rules of the variables it lists.
+    """
+    if rules is not None and variable in rules:
+        return rules[variable]
+
+    variable_rules = list()
+    if variable in TEMPERATURE_VARIABLES:
+        variable_rules.append({"range": [thresn, thresx], "value": thresfix})
+    if variable in PHYSICAL_BOUNDS:
+        low, high = PHYSICAL_BOUNDS[variable]
+        variable_rules.append({"min": low, "max": high})
+    return variable_rules
+
+def apply_thresholds(data, variable, indices=None, rules=None, thresx=274.5, thresn=270., thresfix=274.5):
+    """
+    Apply the thresholding rules of a variable in place, only at `indices` (the modified points) if given.
+
+    `data` can hold one field or a stack of fields (the points being the last axis)
+    of any float type, it is modified without changing its type. The points changed
+    by the rules are counted in the `points_clipped` counter of the run report.
+
+    Returns
+    -------
+    numpy.ndarray
+        `data`.
+    """
+    variable_rules = threshold_rules(variable, thresx=thresx, thresn=thresn, thresfix=thresfix, rules=rules)
+    if not variable_rules:
+        return data
+
+    values = data if indices is None else data[..., indices]
+
+    for rule in variable_rules:
+        if "range" in rule:
+            low, high = rule["range"]
+            mask = (values >= low) & (values <= high)
+            values[mask] = rule["value"]
+        else:
+            low, high = rule.get("min"), rule.get("max")
+            mask = np.zeros(values.shape, dtype=bool)
+            if low is not None:
+                mask |= values < low
+            if high is not None:
+                mask |= values > high
+            np.clip(values, low, high, out=values, where=mask)
+
+        count = np.count_nonzero(mask)
+        if count:
+            logger.debug("thresholding %s: %d points changed by %s", variable, count, rule)
+            instrumentation.count("points_clipped", count)
+
+    if indices is not None:
+        data[..., indices] = values
+
+    return data
+
+def scale_points(data, indices, zmul=1., zadd=0.):
+    """
+    `data[..., indices] = data[..., indices] * zmul + zadd` in place, with the points gathered once.
+
+    `zmul` and `zadd` are scalars or arrays broadcast against the gathered points;
+    `indices` None scales the whole array without any temporary. The type of `data`
+    is kept, float32 data are scaled in float32.
+
+    Returns
+    -------
+    numpy.ndarray
+        `data`.
+    """
+    values = data if indices is None else data[..., indices]
+    np.multiply(values, zmul, out=values, casting="same_kind")
+    np.add(values, zadd, out=values, casting="same_kind")
+    if indices is not None:
+        data[..., indices] = values
+    return data
+
+def instrumented_run(function):
+    """
+    Run a perturbation function as an instrumented run (see `Logger.run`): its
+    stage timers and counters are reset on entry and reported with its config.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with instrumentation.run():
+            return function(*args, **kwargs)
+    return wrapper
+
+def write_perturbation_cfg(cfg_file, cfg, output_grib_file=None, cache_id=None):
+    """
+    Write the `_cfg.json` of a perturbation, registering it in the experiment registry
+    when it is written in the experiments directory (see `ExperimentRegistry`).
+
+    Within an instrumented run (see `instrumented_run`) the run report is written
+    next to it, as `_report.json`.
+    """
+    with open(cfg_file, "w") as f:
+        f.write(json.dumps(cfg))
+
+    if instrumentation.in_run():
+        report_file = f"{cfg_file.removesuffix('_cfg.json')}_report.json"
+        instrumentation.write_run_report(report_file, cfg_file=cfg_file, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    if os.path.dirname(os.path.abspath(cfg_file)) == GRIB_DIR_PATH:
+        get_experiment_registry().register_cfg(cfg_file, cfg, output_grib_file=output_grib_file, cache_id=cache_id)
 
 def apply_thresh_to_temp_data(data, variable, thresx=274.5, thresn=270., thresfix=274.5):
-    if variable in ['t', '2t', 'skt']:
+    # kept for existing callers, the perturbation functions use apply_thresholds on the modified points
+    if variable in TEMPERATURE_VARIABLES:
         temp_mask = (data >= thresn) & (data <= thresx)
         data[temp_mask] = thresfix
     return data
\ No newline at end of file
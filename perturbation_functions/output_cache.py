@@ -0,0 +1,148 @@
+import glob
+import hashlib
+
+from .helper_functions import *
+from grib_files.grib_index import _grib_file_fingerprint
+
+# size of the perturbed outputs kept in OUTPUT_GRIB_PATH before the least recently used ones are removed
+OUTPUT_CACHE_MAX_BYTES = int(float(os.environ.get("PERTURBATION_OUTPUT_CACHE_MAX_GB", 50)) * 1024 ** 3)
+
+# sources whose changes invalidate every cached output
+CODE_VERSION_PATHS = [
+    os.path.join(ROOT_PATH, "perturbation_functions", "*.py"),
+    os.path.join(ROOT_PATH, "grib_files", "*.py"),
+]
+
+_code_version = None
+
+def code_version():
+    """
+    Hash of the perturbation and grib sources, so that outputs written by other code are not reused.
+    """
+    global _code_version
+
+    if _code_version is None:
+        digest = hashlib.blake2b(digest_size=8)
+        for source_file in sorted(f for pattern in CODE_VERSION_PATHS for f in glob.glob(pattern)):
+            if os.path.basename(source_file) == "tests.py":
+                continue
+            with open(source_file, "rb") as f:
+                digest.update(os.path.basename(source_file).encode())
+                digest.update(f.read())
+        _code_version = digest.hexdigest()
+
+    return _code_version
+
+def canonical_parameters(parameters):
+    """
+    Parameters in a canonical form: numbers as floats (1 and 1.0 are the same parameter),
+    tuples as lists, numpy arrays by the hash of their values and dict keys as strings.
+    """
+    if isinstance(parameters, dict):
+        return {str(key): canonical_parameters(value) for (key, value) in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [canonical_parameters(value) for value in parameters]
+    if isinstance(parameters, np.ndarray):
+        values = np.ascontiguousarray(parameters, dtype=np.float64)
+        return {"array": hashlib.blake2b(values.tobytes(), digest_size=16).hexdigest(), "shape": list(values.shape)}
+    if isinstance(parameters, np.generic):
+        parameters = parameters.item()
+    if isinstance(parameters, (int, float)) and not isinstance(parameters, bool):
+        return float(parameters)
+    return parameters
+
+def output_cache_id(grib_file, command, parameters):
+    """
+    Identifier of a perturbed output: a hash of the input grib file (its path, size and
+    modification time, the fingerprint of its index), the command, its canonical
+    parameters and the code version.
+
+    Only the outputs named after it need it: it is cheap to compute (no read of the input),
+    and running the same perturbation of the same file again gives the same identifier,
+    so the output is found by `cached_output` instead of being written again.
+
+    Returns
+    -------
+    str
+        16 hexadecimal characters.
+    """
+    key = json.dumps({
+        "input": dict(_grib_file_fingerprint(grib_file), path=os.path.abspath(grib_file)),
+        "command": command,
+        "parameters": canonical_parameters(parameters),
+        "code_version": code_version(),
+    }, sort_keys=True)
+
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+def cached_output(output_grib_file):
+    """
+    Whether an output was already written, marking it as recently used if so.
+    """
+    if not os.path.exists(output_grib_file):
+        return False
+
+    # the modification time orders the outputs for the eviction (atime is often not updated)
+    os.utime(output_grib_file)
+    logger.info(f"Output GRIB file found in the cache: {output_grib_file}")
+    return True
+
+def discard_output(output_grib_file):
+    """
+    Remove an output that perturbed nothing, so that it is never found by `cached_output`.
+    """
+    try:
+        os.remove(output_grib_file)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"could not remove {output_grib_file}: {e}")
+
+def evict_outputs(output_dir=OUTPUT_GRIB_PATH, max_bytes=OUTPUT_CACHE_MAX_BYTES, keep=()):
+    """
+    Remove the least recently used outputs of `output_dir` until they take at most `max_bytes`.
+
+    Files being written (hidden temporary files) and the `keep` files are never removed.
+
+    Returns
+    -------
+    list of str
+        The removed files.
+    """
+    if not os.path.isdir(output_dir):
+        return []
+
+    keep = {os.path.abspath(output_file) for output_file in keep}
+    outputs = list()
+    for entry in os.scandir(output_dir):
+        if entry.is_file() and not entry.name.startswith("."):
+            stat = entry.stat()
+            outputs.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total = sum(size for (_, size, _) in outputs)
+    removed = list()
+    for (_, size, output_file) in sorted(outputs):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(output_file) in keep:
+            continue
+        try:
+            os.remove(output_file)
+        except OSError as e:
+            logger.warning(f"could not remove {output_file} from the output cache: {e}")
+            continue
+        total -= size
+        removed.append(output_file)
+
+    if removed:
+        logger.info(f"removed {len(removed)} least recently used outputs from {output_dir}")
+
+    return removed
+
+def store_output(*output_grib_files):
+    """
+    Register newly written outputs: the outputs of OUTPUT_GRIB_PATH are size capped (see `evict_outputs`),
+    the outputs registered together are never evicted by their own registration.
+    """
+    if any(os.path.dirname(os.path.abspath(output_grib_file)) == os.path.abspath(OUTPUT_GRIB_PATH) for output_grib_file in output_grib_files):
+        evict_outputs(OUTPUT_GRIB_PATH, keep=output_grib_files)
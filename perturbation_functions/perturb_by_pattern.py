@@ -0,0 +1,238 @@
+import hashlib
+from collections import OrderedDict
+
+from .helper_functions import *
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
+
+PATTERN_EXTENSIONS = [".npy", ".npz", ".grb", ".grib", ".grib1", ".grib2"]
+
+# patterns read from npz and GRIB files (npy files stay memory mapped), keyed on
+# (pattern file, size, mtime, variable, level, grid key), enough for every field of a file
+MAX_CACHED_PATTERNS = 128
+
+_loaded_patterns = OrderedDict()
+
+def _pattern_file_key(pattern_file):
+    stat = os.stat(pattern_file)
+    return (os.path.abspath(pattern_file), stat.st_size, stat.st_mtime_ns)
+
+def _coordinates_geometry(lats, lons, n_points):
+    """
+    Geometry of the source grid of a pattern of `n_points` given by its coordinates, either one
+    latitude and longitude per point or the latitude and longitude axes of a regular grid.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if lats.ndim == 1 and lons.ndim == 1 and lats.size != n_points and lats.size * lons.size == n_points:
+        lats, lons = np.meshgrid(lats, lons, indexing="ij")
+
+    lats, lons = lats.reshape(-1), lons.reshape(-1)
+    key = hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest()[:16]
+
+    return GridGeometry(f"coordinates_{key}", lats, lons)
+
+def read_pattern(pattern_file, variable, level, pattern_levels=None):
+    """
+    Read the pattern of a (variable, level) field from a file, without loading the rest of the file.
+
+    - `.npy`: a single (points,) pattern for every field, or a (levels, points) pattern whose rows
+      are the `pattern_levels` (default LEVELS); the file is memory mapped.
+    - `.npz`: the `{variable}_{level}` array, else the `{variable}` array (one or several levels, as for
+      `.npy`), else the `pattern` array; the source grid can be given with `lats` and `lons` arrays.
+    - GRIB: the (shortName, level) message of the pattern file.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, GridGeometry)
+        The pattern values and the geometry of their grid (None if not known, the pattern must
+        then be on the grid of the perturbed field).
+    """
+    extension = os.path.splitext(pattern_file)[1]
+    pattern_levels = list(pattern_levels) if pattern_levels is not None else LEVELS
+
+    def level_row(pattern):
+        if pattern.ndim == 1:
+            return pattern
+        if level not in pattern_levels:
+            raise ValueError(f"no level {level} in the pattern levels {pattern_levels}")
+        return pattern[pattern_levels.index(level)]
+
+    if extension == ".npy":
+        return level_row(np.load(pattern_file, mmap_mode="r")), None
+
+    if extension == ".npz":
+        # the members of an npz file are only read when accessed
+        with np.load(pattern_file) as patterns:
+            for name in [f"{variable}_{level}", variable, "pattern"]:
+                if name in patterns.files:
+                    pattern = level_row(patterns[name]).reshape(-1)
+                    geometry = None
+                    if "lats" in patterns.files and "lons" in patterns.files:
+                        geometry = _coordinates_geometry(patterns["lats"], patterns["lons"], pattern.size)
+                    return pattern, geometry
+
+        raise ValueError(f"no pattern for {variable} - {level} in {pattern_file}")
+
+    grib_index = get_grib_index(pattern_file)
+    entries = grib_index.select(variable, level)
+    if not entries:
+        raise ValueError(f"no pattern for {variable} - {level} in {pattern_file}")
+    grb = grib_index.read_message(entries[0])
+    geometry = get_grid_geometry(grb)
+
+    return read_values(grb), geometry
+
+def _nearest_mapping(source_geometry, geometry):
+    """
+    Index of the nearest source grid point of every point of `geometry`, cached on disk per pair of grids.
+    """
+    mapping_file = os.path.join(GRID_CACHE_DIR, f"nearest_{source_geometry.key}_{geometry.key}.npy")
+    if os.path.exists(mapping_file):
+        return np.load(mapping_file, mmap_mode="r")
+
+    logger.debug("regridding from %s to %s", source_geometry.key, geometry.key)
+    mapping = nearest_indices(source_geometry, geometry.lats, geometry.lons)
+
+    try:
+        os.makedirs(GRID_CACHE_DIR, exist_ok=True)
+        tmp_mapping_file = f"{mapping_file}.{os.getpid()}.tmp.npy"
+        np.save(tmp_mapping_file, mapping)
+        os.replace(tmp_mapping_file, mapping_file)
+    except OSError as e:
+        logger.warning(f"could not store the regridding in {GRID_CACHE_DIR}: {e}")
+
+    return mapping
+
+def load_pattern(pattern_file, variable, level, geometry, pattern_levels=None):
+    """
+    Pattern of a (variable, level) field on the grid of `geometry`.
+
+    A pattern on another grid (GRIB, or npz with `lats`/`lons`) is regridded once by
+    nearest neighbour, the regridding being cached per pair of grids (GRID_CACHE_DIR).
+    Patterns read from npz and GRIB files are kept in memory, so a file is read (and
+    an npz member decompressed) once per field rather than for every time of the field.
+
+    Returns
+    -------
+    numpy.ndarray
+        The pattern, one value per grid point in the order of the field values (read-only).
+    """
+    cache_key = _pattern_file_key(pattern_file) + (variable, level, geometry.key)
+    if cache_key in _loaded_patterns:
+        _loaded_patterns.move_to_end(cache_key)
+        return _loaded_patterns[cache_key]
+
+    pattern, source_geometry = read_pattern(pattern_file, variable, level, pattern_levels=pattern_levels)
+    pattern = np.asarray(pattern).reshape(-1)
+
+    if source_geometry is not None and source_geometry.key != geometry.key:
+        pattern = pattern[_nearest_mapping(source_geometry, geometry)]
+    elif pattern.size != geometry.n_points:
+        raise ValueError(f"the pattern of {variable} - {level} has {pattern.size} points, the grid {geometry.n_points}")
+
+    if os.path.splitext(pattern_file)[1] != ".npy":
+        pattern = np.ascontiguousarray(pattern)
+        pattern.setflags(write=False)
+        _loaded_patterns[cache_key] = pattern
+        if len(_loaded_patterns) > MAX_CACHED_PATTERNS:
+            _loaded_patterns.popitem(last=False)
+
+    return pattern
+
+def perturb_pattern_values(data, pattern, alpha=1., variable=None, thresholds=None):
+    """
+    Add alpha * pattern to the field values in place, then the thresholds of `variable`
+    (if given) on the points where the pattern is not zero (see `apply_thresholds`).
+    """
+    data += float(alpha) * pattern
+    indices = np.flatnonzero(pattern)
+    instrumentation.count("points_modified", indices.size)
+    if variable is None:
+        return data
+    return apply_thresholds(data, variable, indices=indices, rules=thresholds)
+
+@instrumented_run
+def perturb_by_pattern(
+        grib_file,
+        pattern_file,
+        perturbation_dict,
+        alpha=1.,
+        pattern_levels=None,
+        thresholds=None,
+        output_grib_file=None,
+        use_index=False,):
+    """
+    Add a scaled anomaly/EOF pattern read from a file to one or many fields in a single pass.
+
+    Parameters
+    ----------
+    grib_file : str
+        The input GRIB file.
+    pattern_file : str
+        The pattern, a `.npy`/`.npz` file or another GRIB file (see `read_pattern`).
+    perturbation_dict : dict
+        The levels of every variable to perturb, {variable_name: [level, ...]}.
+    alpha : float, optional
+        Scale of the pattern. Default is 1.
+    pattern_levels : list of int, optional
+        Levels of the rows of a multi-level `.npy`/`.npz` pattern. Default is LEVELS.
+    thresholds : dict, optional
+        Thresholding rules per variable, see `threshold_rules`. Default are the rules of every variable.
+    output_grib_file : str, optional
+        The output GRIB file. If not provided, it will create one.
+    use_index : bool, optional
+        Use the message index of the grib file. Default is False.
+    """
+    if os.path.splitext(pattern_file)[1] not in PATTERN_EXTENSIONS:
+        logger.error(f"unknown pattern file type {pattern_file}, expected one of {PATTERN_EXTENSIONS}")
+        return False
+
+    path, file = os.path.split(grib_file)
+    filename, extension = os.path.splitext(file)
+
+    cache_id = None
+    if not output_grib_file:
+        cache_id = output_cache_id(grib_file, "pattern_perturbation", {
+            "pattern_file": _pattern_file_key(pattern_file), "perturbation_dict": perturbation_dict, "alpha": alpha,
+            "pattern_levels": pattern_levels, "thresholds": thresholds})
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_pattern_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
+
+    variables_levels = {(variable, int(level)) for (variable, levels) in perturbation_dict.items() for level in levels}
+
+    def select(short_name, grb_level, data_time):
+        return (short_name, grb_level) in variables_levels
+
+    def perturb(grb):
+        logger.debug("perturbing %s - %s @ Time: %s with %s * pattern", grb.shortName, grb.level, grb.dataTime, alpha)
+
+        geometry = get_grid_geometry(grb)
+        pattern = load_pattern(pattern_file, grb.shortName, grb.level, geometry, pattern_levels=pattern_levels)
+
+        write_values(grb, perturb_pattern_values(read_values(grb, reuse=True), pattern, alpha=alpha, variable=grb.shortName, thresholds=thresholds))
+
+    valid_grib, perturbed_messages = write_perturbed_grib(grib_file, output_grib_file, select, perturb, use_index=use_index)
+
+    if not valid_grib:
+        return False
+
+    if not perturbed_messages:
+        logger.error(f"none of the variables and levels {sorted(variables_levels)} exist in the GRIB file.")
+        discard_output(output_grib_file)
+        return False
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_pattern_perturbed_{u_id}_cfg.json"), {
+        "grib_file": grib_file,
+        "pattern_file": pattern_file,
+        "perturbation_dict": {variable: list(levels) for (variable, levels) in perturbation_dict.items()},
+        "alpha": alpha,
+        "pattern_levels": pattern_levels,
+        "thresholds": thresholds,
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    logger.info(f"Output GRIB file saved as: {output_grib_file}")
+    return True
@@ -0,0 +1,178 @@
+from .helper_functions import *
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
+
+def column_profile(levels, profile=None):
+    """
+    Amplitude of every level of a column perturbation.
+
+    Parameters
+    ----------
+    levels : list of int
+        The levels of the column.
+    profile : list or dict, optional
+        One amplitude per level (in the order of `levels`) or {level: amplitude}, missing levels
+        having an amplitude of 0. Default is 1 on every level.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if profile is None:
+        return np.ones(len(levels))
+    if isinstance(profile, dict):
+        profile = {int(level): float(amplitude) for (level, amplitude) in profile.items()}
+        return np.array([profile.get(level, 0.) for level in levels])
+    if len(profile) != len(levels):
+        raise ValueError(f"the profile has {len(profile)} amplitudes for {len(levels)} levels")
+    return np.asarray(profile, dtype=np.float64)
+
+def perturb_column_values(data, geometry, variable, amplitudes, lat_s, lat_n, lon_w, lon_e, zmul=1, zadd=0, thresx=274.5, thresn=270., thresfix=274.5, thresholds=None):
+    """
+    Apply zmul/zadd scaled by the amplitude of every level to a (levels, points) array within the box, then the thresholds on the box.
+
+    A level of amplitude `a` gets `data * (1 + a * (zmul - 1)) + a * zadd`, the region is
+    computed once for the whole column and the levels are perturbed in a single operation.
+    """
+    region = box_indices(geometry, lat_s, lat_n, lon_w, lon_e, snap=True)
+
+    level_zmul = (1. + amplitudes * (float(zmul) - 1.))[:, None]
+    level_zadd = (amplitudes * float(zadd))[:, None]
+
+    scale_points(data, region, zmul=level_zmul, zadd=level_zadd)
+    instrumentation.count("points_modified", len(data) * region.size)
+
+    return apply_thresholds(data, variable, indices=region, rules=thresholds, thresx=thresx, thresn=thresn, thresfix=thresfix)
+
+@instrumented_run
+def perturb_column(
+        grib_file,
+        variable,
+        levels="all",
+        profile=None,
+        zmul=1,
+        zadd=0,
+        lat_s=LAT_MIN_LIM,
+        lat_n=LAT_MAX_LIM,
+        lon_w=GRID_LON_MIN,
+        lon_e=GRID_LON_MAX,
+        thresx=274.5,
+        thresn=270.,
+        thresfix=274.5,
+        output_grib_file=None,
+        use_index=False,):
+    """
+    Perturb a variable on several levels of a region at once, with a vertical amplitude profile.
+
+    The messages of the column are read through the grib file index and stacked,
+    per dataTime, into a (levels, points) array that is perturbed in a single
+    vectorized operation with a region computed once, then all of them are
+    written back in one pass over the grib file.
+
+    Parameters
+    ----------
+    grib_file : str
+        The input GRIB file.
+    variable : str
+        Variable to perturb.
+    levels : list of int or "all", optional
+        Levels of the column, "all" for the LEVELS of an upper air variable. Default is "all".
+    profile : list or dict, optional
+        Amplitude of every level, see `column_profile`. Default is 1 on every level.
+    zmul, zadd : float, optional
+        Multiplication and addition terms on the levels of amplitude 1.
+    lat_s, lat_n, lon_w, lon_e : float, optional
+        The region to perturb, longitudes from 0 to 360, the whole grid by default.
+    output_grib_file : str, optional
+        The output GRIB file. If not provided, it will create one.
+    use_index : bool, optional
+        Copy the untouched messages as raw bytes when writing. Default is False.
+    """
+    if variable not in VALID_VARIABLES_DICT:
+        logger.error(f"unknown variable {variable}")
+        return False
+
+    if levels == "all" and variable not in UPPER_VARIABLES:
+        logger.error(f"{variable} is a surface variable, a column of all the levels needs an upper air variable")
+        return False
+
+    levels = list(LEVELS) if levels == "all" else [int(level) for level in levels]
+    amplitudes = column_profile(levels, profile)
+
+    path, file = os.path.split(grib_file)
+    filename, extension = os.path.splitext(file)
+
+    cache_id = None
+    if not output_grib_file:
+        cache_id = output_cache_id(grib_file, "column_perturbation", {
+            "variable": variable, "levels": levels, "profile": amplitudes, "zmul": zmul, "zadd": zadd, "lat_s": lat_s,
+            "lat_n": lat_n, "lon_w": lon_w, "lon_e": lon_e, "thresx": thresx, "thresn": thresn, "thresfix": thresfix})
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_column_{variable}_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
+
+    grib_index = get_grib_index(grib_file)
+    if not grib_index.inventory().is_valid():
+        return False
+
+    # Step 1: Stack and perturb the column of every dataTime
+    perturbed_data = dict()
+    data_times = sorted({entry["dataTime"] for entry in grib_index.select(short_name=variable)})
+
+    for data_time in data_times:
+        column_levels = [level for level in levels if grib_index.select(variable, level, data_time)]
+        if not column_levels:
+            continue
+
+        grbs = list(grib_index.iter_messages([grib_index.select(variable, level, data_time)[0] for level in column_levels]))
+        geometry = get_grid_geometry(grbs[0])
+        for grb in grbs:
+            grb.expand_grid(False)
+        column = np.stack([read_values(grb) for grb in grbs])
+
+        logger.debug("perturbing %s - %s @ Time: %s", variable, column_levels, data_time)
+        column = perturb_column_values(
+            column, geometry, variable, amplitudes[[levels.index(level) for level in column_levels]],
+            lat_s, lat_n, lon_w, lon_e, zmul=zmul, zadd=zadd, thresx=thresx, thresn=thresn, thresfix=thresfix)
+
+        for (level, values) in zip(column_levels, column):
+            perturbed_data[(variable, level, data_time)] = values
+
+    # Step 2: Write the perturbed column back
+    def select(short_name, level, data_time):
+        return (short_name, level, data_time) in perturbed_data
+
+    def perturb(grb):
+        grb.expand_grid(False)
+        write_values(grb, perturbed_data[(grb.shortName, grb.level, grb.dataTime)])
+
+    valid_grib, perturbed_messages = write_perturbed_grib(grib_file, output_grib_file, select, perturb, use_index=use_index)
+
+    if not valid_grib:
+        return False
+
+    if not perturbed_messages:
+        logger.error(f"Variable {variable} at levels {levels} does not exist in the GRIB file.")
+        discard_output(output_grib_file)
+        return False
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_column_{variable}_perturbed_{u_id}_cfg.json"), {
+        "grib_file": grib_file,
+        "variable": variable,
+        "levels": levels,
+        "profile": amplitudes.tolist(),
+        "zmul": zmul,
+        "zadd": zadd,
+        "lat_s": lat_s,
+        "lat_n": lat_n,
+        "lon_w": lon_w,
+        "lon_e": lon_e,
+        "thresx": thresx,
+        "thresn": thresn,
+        "thresfix": thresfix,
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    logger.info(f"Output GRIB file saved as: {output_grib_file}")
+    return True
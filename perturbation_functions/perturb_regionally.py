@@ -1,6 +1,20 @@
 from .helper_functions import *
-from . import validate_grib_file
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
 
+def perturb_region_values(data, geometry, variable, lat_s, lat_n, lon_w, lon_e, zmul=1, zadd=0, thresx=274.5, thresn=270., thresfix=274.5, thresholds=None):
+    """
+    Apply zmul/zadd to the points of `data` within the box, then the thresholds on those points (see `apply_thresholds`).
+    """
+    # Indices of the points within the latitude and longitude range, computed once per grid
+    region = box_indices(geometry, lat_s, lat_n, lon_w, lon_e, snap=True)
+
+    # Modify the data within the region
+    scale_points(data, region, zmul=float(zmul), zadd=float(zadd))
+    instrumentation.count("points_modified", region.size)
+
+    return apply_thresholds(data, variable, indices=region, rules=thresholds, thresx=thresx, thresn=thresn, thresfix=thresfix)
+
+@instrumented_run
 def perturb_regionally(
         grib_file,
         variable,
@@ -14,27 +28,23 @@ def perturb_regionally(
         thresx=274.5, 
         thresn=270., 
         thresfix=274.5,
-        output_grib_file=None,):
+        output_grib_file=None,
+        use_index=False,):
     
-    if not validate_grib_file(grib_file):
-        return False
-
     # arg check
     if (lat_s == LAT_MIN_LIM and \
         lat_n == LAT_MAX_LIM and \
         lon_w == LON_MIN_LIM and \
         lon_e == LON_MAX_LIM):
 
-        print(f"will perturb {variable} on all the coordinates.")
+        logger.info(f"will perturb {variable} on all the coordinates.")
     
     if (lat_s < LAT_MIN_LIM and \
         lat_n > LAT_MAX_LIM and \
         lon_w < LON_MIN_LIM and \
         lon_e > LON_MAX_LIM):
         
-        print(f"coordinates out of range limit lat",
-              f"({LAT_MIN_LIM}, {LAT_MAX_LIM})",
-              f"lon ({LON_MIN_LIM}, {LON_MAX_LIM})")
+        logger.error(f"coordinates out of range limit lat ({LAT_MIN_LIM}, {LAT_MAX_LIM}) lon ({LON_MIN_LIM}, {LON_MAX_LIM})")
         return False
 
 
@@ -42,64 +52,52 @@ def perturb_regionally(
     filename, extension = os.path.splitext(file)
 
     input_grib_file = grib_file
-    u_id = uuid4().hex[-8:]
-
+    cache_id = None
     if not output_grib_file:
-        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_regional_{variable}_perturbed_{u_id}{extension}")
-
-    with open(os.path.join(path, f"{filename}_regional_{variable}_perturbed_{u_id}_cfg.json"), "w") as f:
-        f.write(json.dumps({
-            "grib_file": grib_file,
-            "variable": variable,
-            "level": level,
-            "zmul": zmul,
-            "zadd": zadd,
-            "lat_min": lat_s, 
-            "lat_max": lat_n,
-            "lon_min": lon_w,
-            "lon_max": lon_e,
-            "thresx": thresx, 
-            "thresn": thresn, 
-            "thresfix": thresfix,
-        }))
-
-    grbs = pygrib.open(input_grib_file)
-
-    with open(output_grib_file, 'wb') as out_file:
-        found_variable = False
-        for (_i, grb) in enumerate(grbs):
-            # Get the data, latitudes, and longitudes
-            # grb.expand_grid(False)
-                        
-            if grb.shortName == variable and grb.level == level:
-                grb.expand_grid(False)
-                data, lats, lons = grb.data()
-
-                found_variable = True
-                unique_lons = np.unique(lons.flatten())
-                unique_lats = np.unique(lats.flatten())
-
-                lat_s, lat_n = (np.abs(np.unique(unique_lats) - lat_s)).min() + lat_s, (np.abs(np.unique(unique_lats) - lat_n)).min() + lat_n
-                lon_w, lon_e = (np.abs(np.unique(unique_lons) - lon_w)).min() + lon_w, (np.abs(np.unique(unique_lons) - lon_e)).min() + lon_e
-                                                
-                # Create a mask based on the latitude and longitude range
-                mask = (lats >= float(lat_s)) & (lats <= float(lat_n)) & (lons >= float(lon_w)) & (lons <= float(lon_e))
-
-                # Modify the data where the mask is True
-                data[mask] = float(zmul) * data[mask] + float(zadd)
-
-                data = apply_thresh_to_temp_data(data, variable, thresx=thresx, thresn=thresn, thresfix=thresfix)
-
-                # Flatten the data to 1D if required by the grid type
-                grb.values = data.flatten()
-
-            # Write the modified message to the new GRIB file
-            out_file.write(grb.tostring())
-
-    grbs.close()
-
-    if not found_variable:
-        print(f"{variable} column does not exist in the grib file.")
+        cache_id = output_cache_id(grib_file, "regional_perturbation", {
+            "variable": variable, "level": level, "zmul": zmul, "zadd": zadd, "lat_s": lat_s, "lat_n": lat_n,
+            "lon_w": lon_w, "lon_e": lon_e, "thresx": thresx, "thresn": thresn, "thresfix": thresfix})
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_regional_{variable}_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
+
+    def select(short_name, grb_level, data_time):
+        return short_name == variable and grb_level == level
+
+    def perturb(grb):
+        # the latitudes and longitudes are shared by all the messages on the same grid
+        geometry = get_grid_geometry(grb)
+
+        write_values(grb, perturb_region_values(
+            read_values(grb, reuse=True), geometry, variable, lat_s, lat_n, lon_w, lon_e,
+            zmul=zmul, zadd=zadd, thresx=thresx, thresn=thresn, thresfix=thresfix))
+
+    valid_grib, perturbed_messages = write_perturbed_grib(input_grib_file, output_grib_file, select, perturb, use_index=use_index)
+
+    if not valid_grib:
         return False
-    else:
-        return True
\ No newline at end of file
+
+    if not perturbed_messages:
+        logger.error(f"{variable} column does not exist in the grib file.")
+        discard_output(output_grib_file)
+        return False
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_regional_{variable}_perturbed_{u_id}_cfg.json"), {
+        "grib_file": grib_file,
+        "variable": variable,
+        "level": level,
+        "zmul": zmul,
+        "zadd": zadd,
+        "lat_min": lat_s, 
+        "lat_max": lat_n,
+        "lon_min": lon_w,
+        "lon_max": lon_e,
+        "thresx": thresx, 
+        "thresn": thresn, 
+        "thresfix": thresfix,
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    return True
\ No newline at end of file
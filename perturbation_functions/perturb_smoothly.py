@@ -0,0 +1,178 @@
+from .helper_functions import *
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
+
+SMOOTH_SHAPES = ["gaussian", "cosine_box", "pattern"]
+
+def smooth_amplitude(
+        geometry,
+        shape="gaussian",
+        lat=None,
+        lon=None,
+        sigma_km=500.,
+        lat_s=None,
+        lat_n=None,
+        lon_w=None,
+        lon_e=None,
+        taper_deg=5.,
+        pattern=None):
+    """
+    Smooth amplitude field of a perturbation on the grid, in [0, 1] for the gaussian and cosine_box shapes.
+
+    - "gaussian": Gaussian bump of standard deviation `sigma_km` (great-circle distance) centred on (lat, lon),
+    - "cosine_box": 1 in the (lat_s, lat_n, lon_w, lon_e) box with a cosine taper `taper_deg` degrees wide around it,
+    - "pattern": the user-supplied `pattern`, one value per grid point in the order of the field values.
+
+    The gaussian and cosine_box amplitudes are cached per grid (see `gaussian_weights`
+    and `cosine_box_weights`), so they are only computed once for all the variables,
+    levels and times they are applied to.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Indices of the grid points with a non-zero amplitude and their amplitude.
+    """
+    if shape == "gaussian":
+        return gaussian_weights(geometry, float(lat), float(lon), float(sigma_km))
+
+    if shape == "cosine_box":
+        return cosine_box_weights(geometry, float(lat_s), float(lat_n), float(lon_w), float(lon_e), float(taper_deg))
+
+    if shape == "pattern":
+        pattern = np.asarray(pattern, dtype=np.float64).reshape(-1)
+        if pattern.size != geometry.n_points:
+            raise ValueError(f"the pattern has {pattern.size} points, the grid {geometry.n_points}")
+        indices = np.nonzero(pattern)[0]
+        return indices, pattern[indices]
+
+    raise ValueError(f"unknown shape {shape}, expected one of {SMOOTH_SHAPES}")
+
+def perturb_smooth_values(data, geometry, variable, amplitude, zmul=1, zadd=0, thresx=274.5, thresn=270., thresfix=274.5, thresholds=None):
+    """
+    Apply zmul/zadd to `data` scaled by a smooth amplitude, then the thresholds on the perturbed points (see `apply_thresholds`).
+
+    A point of amplitude `a` becomes `data * (1 + a * (zmul - 1)) + a * zadd`, i.e. the
+    regional perturbation where `a` is 1, nothing where it is 0 and a smooth transition
+    in between.
+    """
+    indices, weights = amplitude
+
+    scale_points(data, indices, zmul=1. + weights * (float(zmul) - 1.), zadd=weights * float(zadd))
+    instrumentation.count("points_modified", indices.size)
+
+    return apply_thresholds(data, variable, indices=indices, rules=thresholds, thresx=thresx, thresn=thresn, thresfix=thresfix)
+
+@instrumented_run
+def perturb_smoothly(
+        grib_file,
+        variable,
+        level,
+        shape="gaussian",
+        zmul=1,
+        zadd=0,
+        lat=None,
+        lon=None,
+        sigma_km=500.,
+        lat_s=None,
+        lat_n=None,
+        lon_w=None,
+        lon_e=None,
+        taper_deg=5.,
+        pattern=None,
+        thresx=274.5,
+        thresn=270.,
+        thresfix=274.5,
+        output_grib_file=None,
+        use_index=False,):
+    """
+    Perturb variable and level with a smooth, spatially tapered amplitude instead of a hard box mask.
+
+    Parameters
+    ----------
+    grib_file : str
+        The input GRIB file.
+    variable : str
+        Variable to perturb.
+    level : int
+        Level of the variable.
+    shape : str, optional
+        "gaussian", "cosine_box" or "pattern", see `smooth_amplitude`. Default is "gaussian".
+    zmul, zadd : float, optional
+        Multiplication and addition terms where the amplitude is 1.
+    lat, lon, sigma_km : float, optional
+        Centre and standard deviation (km) of the gaussian shape.
+    lat_s, lat_n, lon_w, lon_e, taper_deg : float, optional
+        Box and taper width (degrees) of the cosine_box shape.
+    pattern : numpy.ndarray, optional
+        Amplitude of every grid point for the pattern shape.
+    output_grib_file : str, optional
+        The output GRIB file. If not provided, it will create one.
+    use_index : bool, optional
+        Use the message index of the grib file. Default is False.
+    """
+    if shape not in SMOOTH_SHAPES:
+        logger.error(f"unknown shape {shape}, expected one of {SMOOTH_SHAPES}")
+        return False
+
+    path, file = os.path.split(grib_file)
+    filename, extension = os.path.splitext(file)
+
+    cache_id = None
+    if not output_grib_file:
+        cache_id = output_cache_id(grib_file, "smooth_perturbation", {
+            "variable": variable, "level": level, "shape": shape, "zmul": zmul, "zadd": zadd, "lat": lat, "lon": lon,
+            "sigma_km": sigma_km, "lat_s": lat_s, "lat_n": lat_n, "lon_w": lon_w, "lon_e": lon_e, "taper_deg": taper_deg,
+            "pattern": pattern, "thresx": thresx, "thresn": thresn, "thresfix": thresfix})
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_smooth_{variable}_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
+
+    def select(short_name, grb_level, data_time):
+        return short_name == variable and grb_level == level
+
+    def perturb(grb):
+        logger.debug("perturbing %s - %s @ Time: %s with a %s amplitude", grb.shortName, grb.level, grb.dataTime, shape)
+
+        geometry = get_grid_geometry(grb)
+        amplitude = smooth_amplitude(
+            geometry, shape, lat=lat, lon=lon, sigma_km=sigma_km,
+            lat_s=lat_s, lat_n=lat_n, lon_w=lon_w, lon_e=lon_e, taper_deg=taper_deg, pattern=pattern)
+
+        write_values(grb, perturb_smooth_values(
+            read_values(grb, reuse=True), geometry, variable, amplitude, zmul=zmul, zadd=zadd,
+            thresx=thresx, thresn=thresn, thresfix=thresfix))
+
+    valid_grib, perturbed_messages = write_perturbed_grib(grib_file, output_grib_file, select, perturb, use_index=use_index)
+
+    if not valid_grib:
+        return False
+
+    if not perturbed_messages:
+        logger.error(f"Variable {variable} at level {level} does not exist in the GRIB file.")
+        discard_output(output_grib_file)
+        return False
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_smooth_{variable}_perturbed_{u_id}_cfg.json"), {
+        "grib_file": grib_file,
+        "variable": variable,
+        "level": level,
+        "shape": shape,
+        "zmul": zmul,
+        "zadd": zadd,
+        "lat": lat,
+        "lon": lon,
+        "sigma_km": sigma_km,
+        "lat_s": lat_s,
+        "lat_n": lat_n,
+        "lon_w": lon_w,
+        "lon_e": lon_e,
+        "taper_deg": taper_deg,
+        "thresx": thresx,
+        "thresn": thresn,
+        "thresfix": thresfix,
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    logger.info(f"Output GRIB file saved as: {output_grib_file}")
+    return True
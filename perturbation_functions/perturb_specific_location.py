@@ -1,6 +1,20 @@
 from .helper_functions import *
-from . import validate_grib_file
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
 
+def perturb_location_values(data, geometry, variable, lat, lon, zmul=1, zadd=0, thresholds=None):
+    """
+    Apply zmul/zadd to the grid point of `data` nearest to (lat, lon), then the thresholds on that point (see `apply_thresholds`).
+    """
+    # Grid point nearest to the location (great-circle distance)
+    point = nearest_index(geometry, lat, lon)
+
+    # Modify the data at the grid point
+    data[point] = data[point] * float(zmul) + float(zadd)
+    instrumentation.count("points_modified", point.size)
+
+    return apply_thresholds(data, variable, indices=point, rules=thresholds)
+
+@instrumented_run
 def perturb_specific_location(
         grib_file,
         variable,
@@ -9,19 +23,15 @@ def perturb_specific_location(
         lon,
         zmul=1,
         zadd=0,
-        output_grib_file=None,):
-
-    if not validate_grib_file(grib_file):
-        return False
+        output_grib_file=None,
+        use_index=False,):
 
     if (lat < LAT_MIN_LIM and \
         lat > LAT_MAX_LIM and \
         lon < LON_MIN_LIM and \
         lon > LON_MAX_LIM):
         
-        print(f"coordinates out of range limit lat",
-              f"({LAT_MIN_LIM}, {LAT_MAX_LIM})",
-              f"lon ({LON_MIN_LIM}, {LON_MAX_LIM})")
+        logger.error(f"coordinates out of range limit lat ({LAT_MIN_LIM}, {LAT_MAX_LIM}) lon ({LON_MIN_LIM}, {LON_MAX_LIM})")
         return False
     
     path, file = os.path.split(grib_file)
@@ -29,64 +39,41 @@ def perturb_specific_location(
 
     input_grib_file = grib_file
 
-    u_id = uuid4().hex[-8:]
-
+    cache_id = None
     if not output_grib_file:
-        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_coord_point__{variable}_perturbed_{u_id}{extension}")
-
-    with open(os.path.join(path, f"{filename}_coord_point_{variable}_perturbed_{u_id}_cfg.json"), "w") as f:
-        f.write(json.dumps({ 
-            "lat": lat,
-            "lon": lon,
-            "variable": variable,
-            "level": level,
-            "zadd": zadd,
-            "zmul": zmul,
-        }))
+        cache_id = output_cache_id(grib_file, "location_perturbation", {"variable": variable, "level": level, "lat": lat, "lon": lon, "zmul": zmul, "zadd": zadd})
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_coord_point__{variable}_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
 
-    grbs = pygrib.open(input_grib_file)
+    def select(short_name, grb_level, data_time):
+        return short_name == variable and grb_level == level
 
-    with open(output_grib_file, 'wb') as out_file:
-        found_variable = False
-        # Loop through all messages in the GRIB file
-        for (_i, grb) in enumerate(grbs):
-            # Get the data, latitudes, and longitudes
-            grb.expand_grid(False)
-            data, lats, lons = grb.data()
+    def perturb(grb):
+        geometry = get_grid_geometry(grb)
 
-            if grb.shortName == variable and grb.level == level:
-                grb.expand_grid(False)
+        write_values(grb, perturb_location_values(read_values(grb, reuse=True), geometry, variable, lat, lon, zmul=zmul, zadd=zadd))
 
-                found_variable = True
-                unique_lons = np.unique(lons.flatten())
-                unique_lats = np.unique(lats.flatten())
+    valid_grib, perturbed_messages = write_perturbed_grib(input_grib_file, output_grib_file, select, perturb, use_index=use_index)
 
-                # (np.abs(np.unique(unique_lats) - lat_s)).min() + lat_s
-
-                lat = np.abs(np.unique(unique_lats) - lat).min() + lat
-                lon = np.abs(np.unique(unique_lons) - lon).min() + lon
-                                                
-                # Create a mask based on the latitude and longitude range
-                lat = float(lat)
-                lon = float(lon)
-
-                mask = (lats == lat) & (lons == lon)
-
-                # Modify the data where the mask is True
-                data[mask] = data[mask] * float(zmul) + float(zadd)
+    if not valid_grib:
+        return False
 
-                data = apply_thresh_to_temp_data(data, variable)
+    if not perturbed_messages:
+        logger.error(f"{variable} column does not exist in the grib file.")
+        discard_output(output_grib_file)
+        return False
 
-                # Flatten the data to 1D if required by the grid type
-                grb.values = data.flatten()
+    store_output(output_grib_file)
 
-            # Write the modified message to the new GRIB file
-            out_file.write(grb.tostring())
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_coord_point_{variable}_perturbed_{u_id}_cfg.json"), {
+        "lat": lat,
+        "lon": lon,
+        "variable": variable,
+        "level": level,
+        "zadd": zadd,
+        "zmul": zmul,
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
 
-    grbs.close()
-    
-    if not found_variable:
-        print(f"{variable} column does not exist in the grib file.")
-        return False
-    else:
-        return True
\ No newline at end of file
+    return True
\ No newline at end of file
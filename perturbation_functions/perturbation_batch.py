@@ -0,0 +1,377 @@
+import glob
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .helper_functions import *
+from .output_cache import output_cache_id, cached_output, store_output
+from .custom_config import load_custom_config
+from .perturbation_plan import THRESHOLD_OPERATION_KINDS, load_perturbation_plan, plan_operations, group_plan_operations
+from .perturbation_ensemble import (
+    generate_ensemble, _load_ensemble_base, _release_ensemble_base, _init_ensemble_worker, _write_member)
+
+BATCH_CONFIG_EXTENSIONS = [".config", ".json", ".yaml", ".yml"]
+
+BATCH_COMMANDS = [
+    "perturbation_by_factor",
+    "perturbation_by_list",
+    "perturbation_phase",
+    "regional_perturbation",
+    "location_perturbation",
+    "perturbation_of_variable",
+    "perturbation_by_polygons",
+    "smooth_perturbation",
+    "pattern_perturbation",
+    "column_perturbation",
+    "perturbation_plan",
+    "perturbation_ensemble",
+]
+
+def batch_config_files(configs):
+    """
+    Config files of a batch: the files of a directory, a glob pattern or a list of both, in name order.
+    """
+    config_files = list()
+    for config in [configs] if isinstance(configs, str) else configs:
+        if os.path.isdir(config):
+            matches = [os.path.join(config, name) for name in os.listdir(config)]
+        else:
+            matches = glob.glob(config)
+        config_files.extend(
+            match for match in sorted(matches)
+            if os.path.isfile(match) and os.path.splitext(match)[1] in BATCH_CONFIG_EXTENSIONS)
+    return config_files
+
+def load_batch_config(config_file):
+    """
+    Load a config of a batch: `key=value` files (see `load_custom_config`), JSON or YAML files otherwise.
+    """
+    if os.path.splitext(config_file)[1] == ".config":
+        return load_custom_config(config_file)
+    return load_perturbation_plan(config_file)
+
+def config_command(config):
+    """
+    Command of a config: its `command` key, or the command its keys belong to.
+    """
+    if "command" in config:
+        if config["command"] not in BATCH_COMMANDS:
+            raise ValueError(f"unknown command {config['command']}, expected one of {BATCH_COMMANDS}")
+        return config["command"]
+
+    if "grid" in config or "random" in config:
+        return "perturbation_ensemble"
+    if "operations" in config:
+        return "perturbation_plan"
+    if "pattern_file" in config:
+        return "pattern_perturbation"
+    if "perturbation_json" in config:
+        return "perturbation_by_list"
+    if "phase_shift" in config or "data_times" in config:
+        return "perturbation_phase"
+    if "factor" in config:
+        return "perturbation_by_factor"
+    if "levels" in config or "profile" in config:
+        return "column_perturbation"
+    if "shape" in config or "sigma_km" in config or "taper_deg" in config:
+        return "smooth_perturbation"
+    if any(key in config for key in ["lonw", "lone", "lats", "latn"]):
+        return "perturbation_by_polygons"
+    if "lat" in config and "lon" in config:
+        return "location_perturbation"
+    if any(key in config for key in ["lat_min", "lat_max", "lon_min", "lon_max"]):
+        return "regional_perturbation"
+    if "zmul" in config or "zadd" in config:
+        return "perturbation_of_variable"
+
+    raise ValueError(f"cannot tell the command of a config with the keys {sorted(config)}")
+
+def _floats(value):
+    # "330.,345." in key=value configs, numbers or lists in JSON/YAML ones
+    if isinstance(value, str):
+        return [float(x) for x in value.split(",") if x.strip()]
+    if isinstance(value, (list, tuple)):
+        return [float(x) for x in value]
+    return [float(value)]
+
+def _float(value, default):
+    return default if value is None else _floats(value)[0]
+
+def _json(value):
+    return json.loads(value) if isinstance(value, str) else value
+
+def config_operations(config, command=None):
+    """
+    Plan operations (see `load_perturbation_plan`) doing what the CLI `command` does with a config.
+
+    Returns
+    -------
+    list of dict
+    """
+    command = command if command else config_command(config)
+
+    thresholds = {key: _float(config[key], None) for key in ["thresx", "thresn", "thresfix"] if key in config}
+    if "thresholds" in config:
+        thresholds["thresholds"] = _json(config["thresholds"])
+
+    if command == "perturbation_plan":
+        operations = plan_operations(config)
+        return operations
+
+    if command == "perturbation_by_list":
+        return [
+            {"kind": "factor", "variable": variable, "level": int(level), "factor": float(factor)}
+            for (variable, factors) in _json(config["perturbation_json"]).items()
+            for (level, factor) in factors.items()
+        ]
+
+    if command == "perturbation_phase":
+        data_times = config.get("data_times")
+        if isinstance(data_times, str):
+            data_times = [[int(t) for t in pair.split(":")] for pair in data_times.split(",")]
+        return [{"kind": "phase", "phase_shift": config.get("phase_shift", "both"), "data_times": data_times}]
+
+    if command == "pattern_perturbation":
+        return [
+            {"kind": "pattern", "variable": variable, "level": int(level), "pattern_file": config["pattern_file"],
+             "alpha": _float(config.get("alpha"), 1.), "pattern_levels": config.get("pattern_levels"), **thresholds}
+            for (variable, levels) in _json(config["perturbation_json"]).items()
+            for level in levels
+        ]
+
+    variable = config["variable"]
+
+    if command == "column_perturbation":
+        levels = config.get("levels", "all")
+        if levels == "all" and variable not in UPPER_VARIABLES:
+            raise ValueError(f"{variable} is a surface variable, a column of all the levels needs an upper air variable")
+        levels = list(LEVELS) if levels == "all" else [int(level) for level in _floats(levels)]
+        profile = _floats(config["profile"]) if "profile" in config else [1.] * len(levels)
+        zmul, zadd = _float(config.get("zmul"), 1.), _float(config.get("zadd"), 0.)
+        # a column is a regional perturbation of every level, scaled by its amplitude (see `perturb_column_values`)
+        return [
+            {"kind": "regional", "variable": variable, "level": level,
+             "lat_min": _float(config.get("lat_min"), LAT_MIN_LIM), "lat_max": _float(config.get("lat_max"), LAT_MAX_LIM),
+             "lon_min": _float(config.get("lon_min"), GRID_LON_MIN), "lon_max": _float(config.get("lon_max"), GRID_LON_MAX),
+             "zmul": 1. + amplitude * (zmul - 1.), "zadd": amplitude * zadd, **thresholds}
+            for (level, amplitude) in zip(levels, profile) if amplitude
+        ]
+
+    operation = {"variable": variable, "level": int(config.get("level", 0))}
+
+    if command == "perturbation_by_factor":
+        operation.update(kind="factor", factor=_float(config["factor"], 1.))
+    elif command == "perturbation_of_variable":
+        operation.update(kind="variable", zmul=_float(config.get("zmul"), 1.), zadd=_float(config.get("zadd"), 0.))
+    elif command == "location_perturbation":
+        operation.update(
+            kind="location", lat=_float(config["lat"], None), lon=_float(config["lon"], None),
+            zmul=_float(config.get("zmul"), 1.), zadd=_float(config.get("zadd"), 0.))
+    elif command in ["regional_perturbation", "smooth_perturbation"]:
+        operation.update(kind="regional", zmul=_float(config.get("zmul"), 1.), zadd=_float(config.get("zadd"), 0.))
+        for key in ["lat_min", "lat_max", "lon_min", "lon_max"]:
+            if key in config:
+                operation[key] = _float(config[key], None)
+        if command == "smooth_perturbation":
+            operation.update(kind="smooth", shape=config.get("shape", "gaussian"), sigma_km=_float(config.get("sigma_km"), 500.),
+                             taper_deg=_float(config.get("taper_deg"), 5.))
+            for key in ["lat", "lon"]:
+                if key in config:
+                    operation[key] = _float(config[key], None)
+    elif command == "perturbation_by_polygons":
+        lats, latn = _floats(config.get("lats", LAT_MIN_LIM)), _floats(config.get("latn", LAT_MAX_LIM))
+        n_polygons = max(len(lats), len(latn))
+        # the polygons missing a bound span the grid in that direction (longitudes from 0 to 360)
+        lonw = _floats(config.get("lonw", [GRID_LON_MIN] * n_polygons))
+        lone = _floats(config.get("lone", [GRID_LON_MAX] * n_polygons))
+        operation.update(
+            kind="polygons", lonw=lonw, lone=lone, lats=lats, latn=latn,
+            zmul=_floats(config.get("zmul", [1.] * n_polygons)), zadd=_floats(config.get("zadd", [0.] * n_polygons)),
+            overlap=config.get("overlap", "last"))
+    else:
+        raise ValueError(f"{command} cannot be run from a batch")
+
+    if operation["kind"] in THRESHOLD_OPERATION_KINDS:
+        operation.update(thresholds)
+
+    return [operation]
+
+def _run_config(operations, output_grib_file):
+    start = time.perf_counter()
+    _write_member(operations, output_grib_file)
+    return time.perf_counter() - start
+
+def _print_batch_summary(rows):
+    lines = [f"{'config':<32} {'command':<26} {'status':<8} {'time (s)':>9} {'bytes':>12} {'fields':>7}"]
+    for row in rows:
+        lines.append(
+            f"{os.path.basename(row['config']):<32} {row['command'] or '-':<26} {row['status']:<8} "
+            f"{row['wall_time']:>9.2f} {row['bytes_written']:>12} {row['fields_modified']:>7}")
+    logger.info("batch summary:\n%s", "\n".join(lines))
+
+@instrumented_run
+def run_batch(configs, grib_file=None, output_dir=None, jobs=1):
+    """
+    Run a batch of perturbation configs, reading every input grib file once.
+
+    The configs (a directory, a glob pattern or a list of them, see
+    `batch_config_files`) are all parsed first: `key=value` configs as read by
+    the CLI and JSON/YAML plans or ensembles. The command of every config is its
+    `command` key or is inferred from its keys (see `config_command`), and it is
+    turned into plan operations (see `config_operations`).
+
+    The configs are then grouped by input grib file (their `grib_file`, else the
+    `grib_file` argument): every input is validated once from its message index, memory
+    mapped and the fields perturbed by any of its configs decoded once, then the
+    outputs are written by a pool of `jobs` processes sharing them (as the
+    members of an ensemble, see `generate_ensemble`).
+
+    Parameters
+    ----------
+    configs : str or list of str
+        Config files, directories or glob patterns.
+    grib_file : str, optional
+        Input GRIB file of the configs without a `grib_file`.
+    output_dir : str, optional
+        Directory of the outputs without an `output_grib_file`. Default is OUTPUT_GRIB_PATH.
+    jobs : int, optional
+        Number of processes writing outputs. Default is 1.
+
+    The outputs are named after their operations and input (see `output_cache_id`),
+    so the configs already run on the same input are not written again.
+
+    Returns
+    -------
+    list of dict
+        Per config: the command, status (ok, cached or failed), output file, wall time (s), bytes written
+        and fields modified.
+    """
+    output_dir = output_dir if output_dir else OUTPUT_GRIB_PATH
+    os.makedirs(output_dir, exist_ok=True)
+
+    u_id = uuid4().hex[-8:]
+
+    rows = list()
+    groups = dict()
+    ensembles = list()
+
+    # Step 1: Parse every config up front
+    for config_file in batch_config_files(configs):
+        row = {"config": config_file, "command": None, "status": "failed", "output_grib_file": None,
+               "wall_time": 0., "bytes_written": 0, "fields_modified": 0}
+        rows.append(row)
+        try:
+            config = load_batch_config(config_file)
+            row["command"] = config_command(config)
+            input_grib_file = config.get("grib_file", grib_file)
+            if not input_grib_file:
+                raise ValueError("no grib_file in the config and no default grib_file")
+
+            if row["command"] == "perturbation_ensemble":
+                ensembles.append((row, config, input_grib_file))
+                continue
+
+            operations = config_operations(config, row["command"])
+            filename, extension = os.path.splitext(os.path.basename(input_grib_file))
+            config_name = os.path.splitext(os.path.basename(config_file))[0]
+            if "output_grib_file" in config:
+                row["output_grib_file"] = config["output_grib_file"]
+            else:
+                cache_id = output_cache_id(input_grib_file, "perturbation_plan", {"operations": operations, "consistency": []})
+                row["output_grib_file"] = os.path.join(output_dir, f"{filename}_batch_{config_name}_{cache_id}{extension}")
+                if cached_output(row["output_grib_file"]):
+                    row["status"] = "cached"
+                    continue
+            groups.setdefault(os.path.abspath(input_grib_file), list()).append((row, operations))
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning(f"skipping {config_file}: {e!r}")
+
+    if not rows:
+        logger.warning(f"no config found in {configs}")
+        return rows
+
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+
+    # Step 2: Read every input once and write all of its outputs (the ones not found in the cache)
+    for (input_grib_file, group) in groups.items():
+        grib_index = get_grib_index(input_grib_file)
+        if not grib_index.inventory().is_valid():
+            logger.warning(f"{input_grib_file} is not a valid grib file, skipping its {len(group)} configs.")
+            continue
+
+        runs = list()
+        keys = set()
+        for (row, operations) in group:
+            grouped, unmatched = group_plan_operations(grib_index, operations)
+            for operation in unmatched:
+                logger.warning(f"{os.path.basename(row['config'])}: no message in the grib file for the operation {operation}")
+            if not grouped:
+                logger.error(f"{row['config']}: no message of {input_grib_file} matches its operations, nothing to write.")
+                continue
+            row["fields_modified"] = len(grouped)
+            keys.update(grouped)
+            runs.append((row, operations))
+
+        if not runs:
+            continue
+
+        _load_ensemble_base(input_grib_file, sorted(keys))
+        logger.info(f"loaded {input_grib_file}: {len(keys)} perturbed fields for {len(runs)} configs")
+
+        try:
+            if jobs > 1 and len(runs) > 1:
+                with ProcessPoolExecutor(
+                        max_workers=jobs, mp_context=context,
+                        initializer=_init_ensemble_worker, initargs=(input_grib_file, sorted(keys))) as executor:
+                    futures = [executor.submit(_run_config, operations, row["output_grib_file"]) for (row, operations) in runs]
+                    for ((row, _), future) in zip(runs, futures):
+                        try:
+                            row["wall_time"] = future.result()
+                            row["status"] = "ok"
+                        except Exception as e:
+                            logger.error(f"{row['config']} failed: {e!r}")
+            else:
+                for (row, operations) in runs:
+                    try:
+                        row["wall_time"] = _run_config(operations, row["output_grib_file"])
+                        row["status"] = "ok"
+                    except Exception as e:
+                        logger.error(f"{row['config']} failed: {e!r}")
+        finally:
+            _release_ensemble_base()
+
+        store_output(*[row["output_grib_file"] for (row, _) in runs if row["status"] == "ok"])
+
+        path, file = os.path.split(input_grib_file)
+        filename = os.path.splitext(file)[0]
+        write_perturbation_cfg(os.path.join(path, f"{filename}_batch_{u_id}_cfg.json"), {
+            "grib_file": input_grib_file,
+            "configs": [
+                {"config": row["config"], "command": row["command"], "operations": operations,
+                 "output_grib_file": row["output_grib_file"]}
+                for (row, operations) in runs if row["status"] == "ok"
+            ],
+        })
+
+    # Step 3: The ensembles write their own members
+    for (row, ensemble, input_grib_file) in ensembles:
+        start = time.perf_counter()
+        try:
+            member_files = generate_ensemble(input_grib_file, ensemble, output_dir=output_dir, jobs=jobs)
+        except Exception as e:
+            logger.error(f"{row['config']} failed: {e!r}")
+            member_files = False
+        row["wall_time"] = time.perf_counter() - start
+        if member_files:
+            row["status"] = "ok"
+            row["output_grib_file"] = member_files
+
+    for row in rows:
+        if row["status"] == "ok":
+            output_grib_files = row["output_grib_file"]
+            output_grib_files = output_grib_files if isinstance(output_grib_files, list) else [output_grib_files]
+            row["bytes_written"] = sum(os.path.getsize(output_grib_file) for output_grib_file in output_grib_files)
+
+    _print_batch_summary(rows)
+
+    return rows
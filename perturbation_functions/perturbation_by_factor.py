@@ -1,60 +1,61 @@
 from .helper_functions import *
-from . import validate_grib_file
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
 
+@instrumented_run
 def perturbation_by_factor(
         grib_file,
         variable,
         level=0,
         perturbation_factor=1,
-        output_grib_file=None,):
-    
-    if not validate_grib_file(grib_file):
-        return False
+        output_grib_file=None,
+        use_index=False,):
     
     if perturbation_factor == 1:
-        print(f"perturbation factor is {perturbation_factor}, grib file will not be perturbed")
+        logger.warning(f"perturbation factor is {perturbation_factor}, grib file will not be perturbed")
         return False
     
-    u_id = uuid4().hex[-8:]
-    
     path, file = os.path.split(grib_file)
     filename, extension = os.path.splitext(file)
     
     input_grib_file = grib_file
+    cache_id = None
     if not output_grib_file:
-        output_grib_file = os.path.join(path, f"{filename}_perturbed_factor_{variable}_{u_id}{extension}")
-
-    with open(os.path.join(path, f"{filename}_perturbed_factor_{variable}_{u_id}_cfg.json"), "w") as f:
-        f.write(json.dumps({
-            "grib_file_name": str(grib_file),
-            "variable": variable,
-            "level": level,
-            "zmul": perturbation_factor,
-        }))
-
-    # Open the GRIB file
-    grbs = pygrib.open(input_grib_file)
-
-    with open(output_grib_file, 'wb') as out_file:
-        found_variable = False
-        for grb in grbs:
-            # print(grb.shortName, variable, grb.level, level)
-            if grb.shortName == variable and grb.level == int(level):
-                grb.expand_grid(False)
-                found_variable = True
-                print(f"perturbing {grb.shortName} - {grb.level} @ Time: {grb.dataTime} by factor {perturbation_factor}")
-                data, latitudes, longitudes = grb.data()
-
-                modified_data = data * float(perturbation_factor)
-                
-                grb.values = modified_data
-
-            out_file.write(grb.tostring())
-    
-    grbs.close()
+        cache_id = output_cache_id(grib_file, "perturbation_by_factor", {"variable": variable, "level": level, "factor": perturbation_factor})
+        output_grib_file = os.path.join(path, f"{filename}_perturbed_factor_{variable}_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
+
+    def select(short_name, grb_level, data_time):
+        return short_name == variable and grb_level == int(level)
+
+    def perturb(grb):
+        grb.expand_grid(False)
+        logger.debug("perturbing %s - %s @ Time: %s by factor %s", grb.shortName, grb.level, grb.dataTime, perturbation_factor)
+        data = read_values(grb, reuse=True)
+
+        modified_data = scale_points(data, None, zmul=float(perturbation_factor))
+        instrumentation.count("points_modified", modified_data.size)
+        
+        write_values(grb, modified_data)
 
-    if not found_variable:
-        print(f"{variable} column does not exist in the grib file.")
+    valid_grib, perturbed_messages = write_perturbed_grib(input_grib_file, output_grib_file, select, perturb, use_index=use_index)
+
+    if not valid_grib:
+        return False
+
+    if not perturbed_messages:
+        logger.error(f"{variable} column does not exist in the grib file.")
+        discard_output(output_grib_file)
         return False
-    else:
-        return True
\ No newline at end of file
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_perturbed_factor_{variable}_{u_id}_cfg.json"), {
+        "grib_file_name": str(grib_file),
+        "variable": variable,
+        "level": level,
+        "zmul": perturbation_factor,
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    return True
\ No newline at end of file
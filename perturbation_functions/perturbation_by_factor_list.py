@@ -1,32 +1,31 @@
 from .helper_functions import *
-from . import validate_grib_file
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
+from .perturbation_plan import encode_plan_message
 
+@instrumented_run
 def perturbation_by_factor_list(
         grib_file,
         perturbation_dict = {"u": {300: 0.6}, "v": {300: 0.6}},
         output_grib_file=None,
+        use_index=False,
+        jobs=1,
         ):
     """
     perturbatio_dict contains tuples {variable_name: {variables_level: perturbation_factor}}
+
+    with jobs > 1 the perturbed messages are encoded by a pool of processes, through the grib file index
     """
-    if not validate_grib_file(grib_file):
-        return False
-    
     path, file = os.path.split(grib_file)
     filename, extension = os.path.splitext(file)
 
     input_grib_file = grib_file
 
-    u_id = uuid4().hex[-8:]
-
+    cache_id = None
     if not output_grib_file:
-        output_grib_file = os.path.join(path, f"{filename}_perturbed_{u_id}{extension}")
-
-    with open(os.path.join(path, f"{filename}_perturbed_{u_id}_cfg.json"), "w") as f:
-        f.write(json.dumps(dict(perturbation_dict, **{"grib_file": grib_file})))
-
-    # Open the GRIB file
-    grbs = pygrib.open(input_grib_file)
+        cache_id = output_cache_id(grib_file, "perturbation_by_list", perturbation_dict)
+        output_grib_file = os.path.join(path, f"{filename}_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
 
     # this will be used to track if the variables to perturb exist in the grib file
     variables_levels_check = list()
@@ -35,34 +34,55 @@ def perturbation_by_factor_list(
     perturbation_list = list()
     _ = [perturbation_list.extend([(k, int(k1), float(v1)) for (k1, v1) in v.items()]) for (k,v) in perturbation_dict.items()]
 
-    variables_list = [v[0] for v in perturbation_list]
-    levels_list = [v[1] for v in perturbation_list]
-
-    with open(output_grib_file, 'wb') as out_file:
-        variables_levels = list()
-        for grb in grbs:
-            grb.expand_grid(False)
-            
-            if grb.level in levels_list and grb.shortName in variables_list:
-                for _pert in perturbation_list:
-                    if _pert[0] == grb.shortName and _pert[1] == grb.level:    
-                        grb.expand_grid(False)
-                        print(f"perturbing {grb.shortName} - {grb.level} @ Time: {grb.dataTime}")
-                        data, latitudes, longitudes = grb.data()
-
-                        modified_data = data * _pert[2]
-
-                        grb.values = modified_data
-                        
-                        variables_levels.append((grb.shortName, grb.level))
-
-            out_file.write(grb.tostring())
-    
+    variables_levels = list()
+
+    def select(short_name, grb_level, data_time):
+        return (short_name, grb_level) in variables_levels_check
+
+    def perturb(grb):
+        for _pert in perturbation_list:
+            if _pert[0] == grb.shortName and _pert[1] == grb.level:    
+                grb.expand_grid(False)
+                logger.debug("perturbing %s - %s @ Time: %s", grb.shortName, grb.level, grb.dataTime)
+                data = read_values(grb, reuse=True)
+
+                modified_data = scale_points(data, None, zmul=_pert[2])
+                instrumentation.count("points_modified", modified_data.size)
+
+                write_values(grb, modified_data)
+                
+                variables_levels.append((grb.shortName, grb.level))
+
+    if jobs > 1:
+        payloads = dict()
+        for (variable, level, factor) in perturbation_list:
+            for entry in get_grib_index(input_grib_file).select(variable, level):
+                key = (entry["shortName"], entry["level"], entry["dataTime"])
+                payloads[key] = (input_grib_file, key, [{"kind": "factor", "factor": factor}], [])
+                variables_levels.append((variable, level))
+
+        valid_grib, perturbed_messages = write_encoded_grib(input_grib_file, output_grib_file, payloads, encode_plan_message, jobs=jobs)
+    else:
+        valid_grib, perturbed_messages = write_perturbed_grib(input_grib_file, output_grib_file, select, perturb, use_index=use_index)
+
+    if not valid_grib:
+        return False
+
+    if not perturbed_messages:
+        logger.error(f"none of the variables and levels {sorted(set(variables_levels_check))} exist in the grib file.")
+        discard_output(output_grib_file)
+        return False
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(
+        os.path.join(path, f"{filename}_perturbed_{u_id}_cfg.json"), dict(perturbation_dict, **{"grib_file": grib_file}),
+        output_grib_file=output_grib_file, cache_id=cache_id)
+
     variables_diff = set(variables_levels_check) - set(variables_levels)
 
     if variables_diff:
-        print(f"these variables were not found in the grib file:\n{variables_diff}")
-
-    grbs.close()
+        logger.error(f"these variables were not found in the grib file:\n{variables_diff}")
 
-    return True    
\ No newline at end of file
+    return True
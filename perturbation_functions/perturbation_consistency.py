@@ -0,0 +1,156 @@
+from collections import OrderedDict
+
+from .helper_functions import *
+
+CONSISTENCY_RULES = ["geostrophic_wind", "humidity", "dewpoint", "surface_pressure"]
+
+# Earth angular velocity (rad/s)
+EARTH_OMEGA = 7.292e-5
+
+# no geostrophic wind increment closer to the equator, where the Coriolis parameter vanishes
+GEOSTROPHIC_MIN_LAT = 10.
+
+# perturbed source fields kept for the dependent fields (e.g. a z increment for both u and v)
+MAX_CACHED_SOURCE_FIELDS = 8
+
+_source_fields = OrderedDict()
+
+def consistency_rules(consistency):
+    """
+    Rules of a consistency setting: True or "all" for every rule, a list (or comma-separated string) of rules, None for none.
+    """
+    if not consistency:
+        return []
+    if consistency is True or consistency == "all":
+        return list(CONSISTENCY_RULES)
+    rules = consistency.split(",") if isinstance(consistency, str) else list(consistency)
+    for rule in rules:
+        if rule not in CONSISTENCY_RULES:
+            raise ValueError(f"unknown consistency rule {rule}, expected one of {CONSISTENCY_RULES}")
+    return rules
+
+def consistency_steps(grib_index, grouped, rules):
+    """
+    Dependent fields to adjust after the perturbation of the `grouped` fields (see `group_plan_operations`).
+
+    Returns
+    -------
+    dict
+        The adjustments of every dependent (shortName, level, dataTime), each one a dict with the
+        `rule`, the `source` field it depends on and the `source_operations` perturbing that field.
+    """
+    steps = dict()
+
+    def add(target, rule, source):
+        if target != source and grib_index.select(*target) and grib_index.select(*source):
+            steps.setdefault(target, list()).append({
+                "rule": rule, "source": source, "source_operations": grouped.get(source, [])})
+
+    for (short_name, level, data_time) in grouped:
+        if "geostrophic_wind" in rules and short_name == "z" and level in LEVELS:
+            add(("u", level, data_time), "geostrophic_wind", ("z", level, data_time))
+            add(("v", level, data_time), "geostrophic_wind", ("z", level, data_time))
+
+        if "humidity" in rules and short_name in ["t", "q"]:
+            add(("q", level, data_time), "humidity", ("t", level, data_time))
+
+        if "dewpoint" in rules and short_name in ["2t", "2d"]:
+            add(("2d", 0, data_time), "dewpoint", ("2t", 0, data_time))
+
+        if "surface_pressure" in rules and short_name == "msl":
+            add(("sp", 0, data_time), "surface_pressure", ("msl", 0, data_time))
+
+    return steps
+
+def _source_field(grib_index, key, operations, apply_operation):
+    """
+    Original and perturbed values of a source field, cached for the other fields depending on it.
+
+    The cache is keyed on the fingerprint of the grib file too, a file rewritten on disk gets its fields read again.
+    """
+    cache_key = (
+        grib_index.grib_file, grib_index.fingerprint["size"], grib_index.fingerprint["mtime_ns"],
+        key, json.dumps(operations, sort_keys=True, default=str))
+    if cache_key in _source_fields:
+        _source_fields.move_to_end(cache_key)
+        return _source_fields[cache_key]
+
+    grb = grib_index.read_message(grib_index.select(*key)[0])
+    geometry = get_grid_geometry(grb)
+    original = read_values(grb)
+    perturbed = original.copy()
+    for operation in operations:
+        perturbed = apply_operation(operation, perturbed, geometry, grib_index, key)
+
+    _source_fields[cache_key] = (original, perturbed)
+    if len(_source_fields) > MAX_CACHED_SOURCE_FIELDS:
+        _source_fields.popitem(last=False)
+
+    return original, perturbed
+
+def saturation_specific_humidity(t, pressure):
+    """
+    Saturation specific humidity (kg/kg) at temperature `t` (K) and `pressure` (Pa), Tetens formula over water.
+    """
+    e_sat = 611.2 * np.exp(17.67 * (t - 273.15) / (t - 29.65))
+    return 0.622 * e_sat / np.maximum(pressure - 0.378 * e_sat, 1e-3 * pressure)
+
+def apply_consistency_step(step, data, original, geometry, grib_index, key, apply_operation):
+    """
+    Adjust a dependent field to the perturbation of its source field, only where the fields changed.
+
+    - geostrophic_wind: u and v get the geostrophic wind of the z increment,
+      `u' = -dz/dy / f` and `v' = dz/dx / f` (no increment within GEOSTROPHIC_MIN_LAT of the equator),
+    - humidity: q is clipped to [0, saturation] at the (perturbed) t of the level,
+    - dewpoint: 2d is clipped to the (perturbed) 2t,
+    - surface_pressure: sp is scaled by the ratio of the perturbed to the original msl.
+
+    Parameters
+    ----------
+    step : dict
+        The adjustment (see `consistency_steps`).
+    data : numpy.ndarray
+        The values of the dependent field, after its own perturbations.
+    original : numpy.ndarray
+        The original values of the dependent field.
+    apply_operation : callable
+        The function applying a plan operation (see `apply_plan_operation`).
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, int)
+        The adjusted values and the number of adjusted points.
+    """
+    source_original, source = _source_field(grib_index, step["source"], step["source_operations"], apply_operation)
+    rule = step["rule"]
+
+    if rule == "geostrophic_wind":
+        increment = source - source_original
+        changed = np.nonzero(increment)[0]
+        if not changed.size:
+            return data, 0
+
+        dzdx, dzdy = grid_gradient(geometry, increment)
+        coriolis = 2 * EARTH_OMEGA * np.sin(np.radians(geometry.lats))
+        balanced = np.abs(geometry.lats) >= GEOSTROPHIC_MIN_LAT
+
+        wind = -dzdy if key[0] == "u" else dzdx
+        points = np.nonzero(balanced & (wind != 0))[0]
+        data[points] += wind[points] / coriolis[points]
+        return data, points.size
+
+    # the other rules only look at the points where the field or its source changed
+    points = np.nonzero((source != source_original) | (data != original))[0]
+
+    if rule == "humidity":
+        q_sat = saturation_specific_humidity(source[points], key[1] * 100.)
+        clipped = np.clip(data[points], 0., q_sat)
+    elif rule == "dewpoint":
+        clipped = np.minimum(data[points], source[points])
+    else:
+        clipped = data[points] * source[points] / source_original[points]
+
+    adjusted = np.count_nonzero(clipped != data[points])
+    data[points] = clipped
+
+    return data, adjusted
@@ -0,0 +1,281 @@
+import mmap
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .helper_functions import *
+from .output_cache import output_cache_id, cached_output, store_output
+from .perturbation_plan import load_perturbation_plan, plan_operations, group_plan_operations, apply_plan_operation
+
+ENSEMBLE_DISTRIBUTIONS = ["uniform", "normal", "choice"]
+
+# base grib file shared by the members of the ensemble being generated, inherited by forked workers
+_ensemble_base = None
+
+def load_ensemble(ensemble_file):
+    """
+    Load an ensemble definition from a JSON or YAML file (see `generate_ensemble`).
+    """
+    return load_perturbation_plan(ensemble_file)
+
+def _draw_parameter(rng, distribution):
+    kind = distribution.get("distribution", "uniform")
+    if kind == "uniform":
+        return float(rng.uniform(distribution.get("low", 0.), distribution.get("high", 1.)))
+    if kind == "normal":
+        return float(rng.normal(distribution.get("mean", 0.), distribution.get("std", 1.)))
+    if kind == "choice":
+        values = distribution["values"]
+        return values[int(rng.integers(len(values)))]
+    raise ValueError(f"unknown distribution {kind}, expected one of {ENSEMBLE_DISTRIBUTIONS}")
+
+def ensemble_members(ensemble):
+    """
+    Parameters of every member of an ensemble.
+
+    The members are either the cartesian product of the values listed in
+    `grid`, or `members` draws of the distributions listed in `random`
+    (reproducible through its `seed`).
+
+    Returns
+    -------
+    list of dict
+    """
+    if ("grid" in ensemble) == ("random" in ensemble):
+        raise ValueError("an ensemble needs either a parameter grid or a random distribution")
+
+    if "grid" in ensemble:
+        names = list(ensemble["grid"])
+        return [dict(zip(names, values)) for values in itertools.product(*(ensemble["grid"][name] for name in names))]
+
+    random = ensemble["random"]
+    rng = np.random.default_rng(random.get("seed"))
+    return [
+        {name: _draw_parameter(rng, distribution) for (name, distribution) in random["parameters"].items()}
+        for _ in range(int(random["members"]))
+    ]
+
+def _substitute(value, parameters):
+    if isinstance(value, str) and value.startswith("$"):
+        if value[1:] not in parameters:
+            raise ValueError(f"no ensemble parameter {value[1:]}")
+        return parameters[value[1:]]
+    if isinstance(value, list):
+        return [_substitute(v, parameters) for v in value]
+    return value
+
+def member_operations(operations, parameters):
+    """
+    Operations of a member: the `$name` values of the ensemble operations replaced by the member parameters.
+    """
+    return [{key: _substitute(value, parameters) for (key, value) in operation.items()} for operation in operations]
+
+def _load_ensemble_base(grib_file, keys):
+    """
+    Map the base grib file and decode once the fields perturbed by at least one member.
+    """
+    global _ensemble_base
+
+    grib_index = get_grib_index(grib_file)
+
+    with open(grib_index.grib_file, "rb") as f:
+        raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    fields = dict()
+    geometries = dict()
+    for key in keys:
+        entry = grib_index.select(*key)[0]
+        grb = pygrib.fromstring(raw[entry["offset"]:entry["offset"] + entry["length"]])
+        geometries[key] = get_grid_geometry(grb)
+        fields[key] = read_values(grb)
+
+    _ensemble_base = {
+        "grib_file": grib_index.grib_file,
+        "grib_index": grib_index,
+        "raw": raw,
+        "fields": fields,
+        "geometries": geometries,
+    }
+
+def _release_ensemble_base():
+    global _ensemble_base
+    _ensemble_base["raw"].close()
+    _ensemble_base = None
+
+def _init_ensemble_worker(grib_file, keys):
+    # forked workers already share the base of the parent
+    if _ensemble_base is None or _ensemble_base["grib_file"] != os.path.abspath(grib_file):
+        _load_ensemble_base(grib_file, keys)
+
+def _write_member(operations, output_grib_file, base=None):
+    # `base` defaults to the ensemble base, the perturbation server passes the fields it keeps warm
+    base = _ensemble_base if base is None else base
+    grib_index = base["grib_index"]
+    raw = base["raw"]
+    grouped, _ = group_plan_operations(grib_index, operations)
+
+    tmp_grib_file = os.path.join(
+        os.path.dirname(output_grib_file), f".{os.path.basename(output_grib_file)}.{uuid4().hex[-8:]}.tmp")
+
+    def write_slice(out_file, view, start, end):
+        with instrumentation.stage("writing"):
+            out_file.write(view[start:end])
+        instrumentation.count("bytes_copied", end - start)
+
+    try:
+        with open(tmp_grib_file, "wb") as out_file, memoryview(raw) as view:
+            # consecutive untouched messages are written as a single slice of the base file
+            run_start, run_end = 0, 0
+
+            for entry in grib_index.messages:
+                key = (entry["shortName"], entry["level"], entry["dataTime"])
+                if key not in grouped:
+                    if run_end != entry["offset"]:
+                        write_slice(out_file, view, run_start, run_end)
+                        run_start = entry["offset"]
+                    run_end = entry["offset"] + entry["length"]
+                    continue
+
+                write_slice(out_file, view, run_start, run_end)
+                run_start, run_end = 0, 0
+
+                with instrumentation.stage("arithmetic"):
+                    data = base["fields"][key].copy()
+                    for operation in grouped[key]:
+                        data = apply_plan_operation(operation, data, base["geometries"][key], grib_index, key)
+
+                with instrumentation.stage("decoding"):
+                    grb = pygrib.fromstring(view[entry["offset"]:entry["offset"] + entry["length"]].tobytes())
+                grb.expand_grid(False)
+                write_values(grb, data)
+                with instrumentation.stage("encoding"):
+                    message = grb.tostring()
+                with instrumentation.stage("writing"):
+                    out_file.write(message)
+                instrumentation.count("bytes_written", len(message))
+                instrumentation.count("messages_reencoded")
+
+            write_slice(out_file, view, run_start, run_end)
+    except BaseException:
+        os.remove(tmp_grib_file)
+        raise
+
+    os.replace(tmp_grib_file, output_grib_file)
+
+    return output_grib_file
+
+@instrumented_run
+def generate_ensemble(
+        grib_file,
+        ensemble,
+        output_dir=None,
+        jobs=1,):
+    """
+    Write the perturbed members of an ensemble, reading the base grib file once.
+
+    An ensemble is a list of plan `operations` (see `load_perturbation_plan`)
+    whose values can refer to ensemble parameters as `"$name"`, plus the values
+    of the parameters, either as a grid (every combination is a member)
+
+        {"operations": [{"kind": "variable", "variable": "msl", "level": 0, "zmul": "$zmul", "zadd": "$zadd"}],
+         "grid": {"zmul": [0.9, 1, 1.1], "zadd": [-100, 100]}}
+
+    or as random distributions (uniform low/high, normal mean/std or choice values)
+
+        {"operations": [{"kind": "regional", "variable": "skt", "level": 0, "lat_min": 40, "lat_max": 60,
+                         "lon_min": 0, "lon_max": 10, "zadd": "$amplitude"}],
+         "random": {"members": 20, "seed": 1, "parameters": {"amplitude": {"distribution": "normal", "std": 2}}}}
+
+    As in a plan, the `thresholds` of the ensemble apply to every operation without its own.
+
+    The base file is validated once from its message index and memory mapped,
+    the fields perturbed by any member are decoded once and shared by all the
+    members; the untouched messages of every member are written straight from
+    the mapped base file. With `jobs` > 1 the members are written by a pool of
+    processes (forked workers inherit the decoded base fields).
+
+    Parameters
+    ----------
+    grib_file : str
+        The base GRIB file.
+    ensemble : dict
+        The ensemble definition (see `load_ensemble`).
+    output_dir : str, optional
+        The directory of the member files. Default is OUTPUT_GRIB_PATH.
+    jobs : int, optional
+        Number of processes writing members. Default is 1.
+
+    Returns
+    -------
+    list of str
+        The member files, or False if the base grib file is not valid.
+    """
+    start = time.perf_counter()
+
+    path, file = os.path.split(grib_file)
+    filename, extension = os.path.splitext(file)
+
+    output_dir = output_dir if output_dir else OUTPUT_GRIB_PATH
+    os.makedirs(output_dir, exist_ok=True)
+
+    grib_index = get_grib_index(grib_file)
+    if not grib_index.inventory().is_valid():
+        logger.error(f"{grib_file} is not a valid grib file, no member was written.")
+        return False
+
+    members = ensemble_members(ensemble)
+    ensemble_operations = plan_operations(ensemble)
+    u_id = output_cache_id(grib_file, "perturbation_ensemble", {"operations": ensemble_operations, "members": members})
+    operations = [member_operations(ensemble_operations, parameters) for parameters in members]
+
+    keys = set()
+    for member in operations:
+        grouped, unmatched = group_plan_operations(grib_index, member)
+        keys.update(grouped)
+        for operation in unmatched:
+            logger.warning(f"no message in the grib file for the operation {operation}")
+
+    output_grib_files = [
+        os.path.join(output_dir, f"{filename}_ensemble_{u_id}_m{number:03d}{extension}")
+        for number in range(len(members))
+    ]
+
+    if all(os.path.exists(output_grib_file) for output_grib_file in output_grib_files):
+        for output_grib_file in output_grib_files:
+            cached_output(output_grib_file)
+        return output_grib_files
+
+    _load_ensemble_base(grib_file, sorted(keys))
+    logger.info(f"loaded {grib_file}: {len(keys)} perturbed fields for {len(members)} members")
+
+    try:
+        if jobs > 1:
+            context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+            with ProcessPoolExecutor(
+                    max_workers=jobs, mp_context=context,
+                    initializer=_init_ensemble_worker, initargs=(grib_file, sorted(keys))) as executor:
+                for output_grib_file in executor.map(_write_member, operations, output_grib_files):
+                    logger.info(f"Output GRIB file saved as: {output_grib_file}")
+        else:
+            for (member, output_grib_file) in zip(operations, output_grib_files):
+                _write_member(member, output_grib_file)
+                logger.info(f"Output GRIB file saved as: {output_grib_file}")
+    finally:
+        _release_ensemble_base()
+
+    store_output(*output_grib_files)
+
+    write_perturbation_cfg(os.path.join(path, f"{filename}_ensemble_{u_id}_cfg.json"), {
+        "grib_file": grib_file,
+        "ensemble": ensemble,
+        "members": [
+            {"parameters": parameters, "output_grib_file": output_grib_file}
+            for (parameters, output_grib_file) in zip(members, output_grib_files)
+        ],
+    }, cache_id=u_id)
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"{len(members)} members in {elapsed:.2f}s ({len(members) / elapsed:.2f} members/s)")
+
+    return output_grib_files
@@ -1,87 +1,179 @@
 from .helper_functions import *
-from . import validate_grib_file
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
 
+PHASE_SHIFTS = ["future", "past", "both"]
+
+# dataTimes swapped by default
+DEFAULT_PHASE_DATA_TIMES = [(0, 1800)]
+
+def phase_time_pairs(phase_shift="both", data_times=None):
+    """
+    (target, source) dataTime pairs of a phase shift.
+
+    Parameters
+    ----------
+    phase_shift : str
+        "future" copies the values of the second dataTime of every pair to the first one,
+        "past" the values of the first dataTime to the second one and "both" swaps them.
+    data_times : list of tuple, optional
+        Pairs of dataTimes (e.g. [(0, 1800), (600, 1200)]). Default is DEFAULT_PHASE_DATA_TIMES.
+
+    Returns
+    -------
+    list of tuple
+    """
+    if phase_shift not in PHASE_SHIFTS:
+        raise ValueError(f"unknown phase_shift {phase_shift}, expected one of {PHASE_SHIFTS}")
+
+    pairs = list()
+    for (time_a, time_b) in (data_times if data_times else DEFAULT_PHASE_DATA_TIMES):
+        if phase_shift in ["future", "both"]:
+            pairs.append((int(time_a), int(time_b)))
+        if phase_shift in ["past", "both"]:
+            pairs.append((int(time_b), int(time_a)))
+
+    targets = [target for (target, _) in pairs]
+    if len(set(targets)) != len(targets):
+        raise ValueError(f"the dataTimes {data_times} overwrite the same time more than once")
+
+    return pairs
+
+@instrumented_run
 def perturbation_phase(
-        grib_file, 
-        output_grib_file=None, 
-        phase_shift="both"):
+        grib_file,
+        output_grib_file=None,
+        phase_shift="both",
+        use_index=False,
+        data_times=None,
+        dtype=None,
+        max_memory_mb=None):
     """
     Perturb the phase of a GRIB file based on the phase_shift variable.
-    
+
+    Only field values are kept in memory. With `use_index` the messages are
+    paired through the grib file index and swapped while the output is being
+    written: the values of a message are read when its pair is written, and the
+    original values of a rewritten message are kept (within `max_memory_mb`)
+    only if its own pair comes later in the file, otherwise they are read again.
+
     Args:
         grib_file (str): The input GRIB file.
         output_grib_file (str, optional): The output GRIB file. If not provided, it will create one.
         phase_shift (str): "future" to replicate values from 1800 to 0000, "past" to replicate values from 0000 to 1800, or "both" to swap the values.
+        data_times (list of tuple, optional): Pairs of dataTimes to shift instead of [(0, 1800)].
+        dtype (numpy.dtype, optional): Type of the values held in memory, the decoded float64 by default (the values are copied unchanged), FIELD_DTYPE (float32) to halve the memory at the cost of precision.
+        max_memory_mb (float, optional): Memory used to keep values for later messages with `use_index`, unlimited by default.
     """
-    if not validate_grib_file(grib_file):
-        return False
-
     # Set the output GRIB file name if not provided
     path, file = os.path.split(grib_file)
     filename, extension = os.path.splitext(file)
-    
-    u_id = uuid4().hex[-8:]
-    
+
+    cache_id = None
     if not output_grib_file:
-        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_phase_perturbed_{u_id}{extension}")
-    
-    with open(os.path.join(path, f"{filename}_phase_perturbed_{u_id}_cfg.json"), "w") as f:
-        f.write(json.dumps({
-            "grib_file": grib_file,
-            "phase_shift": str(phase_shift),
-        }))
-
-    # Open the GRIB file
-    grbs = pygrib.open(grib_file)
-
-    # Dictionaries to store data for times 0 and 1800
-    zero_time_data = {}
-    eighteen_time_data = {}
-
-    # Step 1: Store data for dataTime == 0 and dataTime == 1800
-    for grb in grbs:
-        grb.expand_grid(False)
-        key = (grb.shortName, grb.level)
-        if grb.dataTime == 0:
-            zero_time_data[key] = grb.data()  # Store data for time 0
-        elif grb.dataTime == 1800:
-            eighteen_time_data[key] = grb.data()  # Store data for time 1800
+        cache_id = output_cache_id(grib_file, "perturbation_phase", {"phase_shift": phase_shift, "data_times": data_times})
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_phase_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
 
-    # Rewind the GRIB file to iterate again
-    grbs.seek(0)
+    # source dataTime of every overwritten dataTime
+    source_times = dict(phase_time_pairs(phase_shift, data_times))
 
-    # Step 2: Create the output file and apply the phase shift
-    with open(output_grib_file, 'wb') as out_file:
-        for grb in grbs:
+    # values of the source messages, keyed on (shortName, level, dataTime)
+    source_data = {}
+
+    if use_index:
+        grib_index = get_grib_index(grib_file)
+        if not grib_index.inventory().is_valid():
+            return False
+
+        targets = [
+            (entry["shortName"], entry["level"], entry["dataTime"]) for entry in grib_index.messages
+            if entry["dataTime"] in source_times
+            and grib_index.select(entry["shortName"], entry["level"], source_times[entry["dataTime"]])
+        ]
+        # message each source is copied to, a source can only have one
+        target_of = {(short_name, level, source_times[data_time]): (short_name, level, data_time) for (short_name, level, data_time) in targets}
+        targets = set(targets)
+        written = set()
+        memory_cap = None if max_memory_mb is None else max_memory_mb * 2 ** 20
+        memory_used = 0
+
+        def source_values(key):
+            grb = grib_index.read_message(grib_index.select(*key)[0])
             grb.expand_grid(False)
-            key = (grb.shortName, grb.level)
-            
-            if phase_shift == "future":
-                if grb.dataTime == 0 and key in eighteen_time_data:
-                    # Copy values from time 1800 to time 0
-                    grb.values = eighteen_time_data[key][0]  # Set the data from time 1800
-                    grb.dataTime = 0  # Keep the time at 0
-                # Keep time 1800 messages unchanged
-            elif phase_shift == "past":
-                if grb.dataTime == 1800 and key in zero_time_data:
-                    # Copy values from time 0 to time 1800
-                    grb.values = zero_time_data[key][0]  # Set the data from time 0
-                    grb.dataTime = 1800  # Keep the time at 1800
-                # Keep time 0 messages unchanged
-            elif phase_shift == "both":
-                if grb.dataTime == 0 and key in eighteen_time_data:
-                    # Swap values: Copy data from time 1800 to time 0
-                    grb.values = eighteen_time_data[key][0]
-                    grb.dataTime = 0
-                elif grb.dataTime == 1800 and key in zero_time_data:
-                    # Swap values: Copy data from time 0 to time 1800
-                    grb.values = zero_time_data[key][0]
-                    grb.dataTime = 1800
-
-            # Write the modified or unchanged message to the output file
-            out_file.write(grb.tostring())
-
-    grbs.close()
-
-    print(f"Output GRIB file saved as: {output_grib_file}")
-    return True
\ No newline at end of file
+            return read_values(grb, dtype=dtype)
+    else:
+        # Step 1: Store the values of the source messages only
+        inventory = GribInventory()
+        source_keys = set()
+
+        grbs = pygrib.open(grib_file)
+        for grb in grbs:
+            inventory.add(grb.shortName, grb.level, grb.dataTime)
+            if grb.dataTime in source_times.values():
+                grb.expand_grid(False)
+                source_data[(grb.shortName, grb.level, grb.dataTime)] = read_values(grb, dtype=dtype)
+        grbs.close()
+
+        if not inventory.is_valid():
+            return False
+
+        targets = {
+            (short_name, level, target_time)
+            for (target_time, source_time) in source_times.items()
+            for (short_name, level, data_time) in source_data if data_time == source_time
+        }
+
+    # Step 2: Create the output file and apply the phase shift
+    def select(short_name, level, data_time):
+        return (short_name, level, data_time) in targets
+
+    def perturb(grb):
+        nonlocal memory_used
+        grb.expand_grid(False)
+        key = (grb.shortName, grb.level, grb.dataTime)
+        source_key = (grb.shortName, grb.level, source_times[grb.dataTime])
+
+        if not use_index:
+            write_values(grb, source_data[source_key])
+            instrumentation.count("points_modified", source_data[source_key].size)
+            return
+
+        values = source_data.pop(source_key, None)
+        if values is None:
+            values = source_values(source_key)
+        else:
+            memory_used -= values.nbytes
+
+        # keep the original values if they still have to be copied to a later message
+        if key in target_of and target_of[key] not in written:
+            original = read_values(grb, dtype=dtype)
+            if memory_cap is None or memory_used + original.nbytes <= memory_cap:
+                source_data[key] = original
+                memory_used += original.nbytes
+
+        write_values(grb, values)
+        instrumentation.count("points_modified", values.size)
+        written.add(key)
+
+    valid_grib, perturbed_messages = write_perturbed_grib(grib_file, output_grib_file, select, perturb, use_index=use_index)
+
+    if not valid_grib:
+        return False
+
+    if not perturbed_messages:
+        logger.error(f"no message of the grib file has a {phase_shift} phase shift source.")
+        discard_output(output_grib_file)
+        return False
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_phase_perturbed_{u_id}_cfg.json"), {
+        "grib_file": grib_file,
+        "phase_shift": str(phase_shift),
+        "data_times": [list(pair) for pair in (data_times if data_times else DEFAULT_PHASE_DATA_TIMES)],
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    logger.info(f"Output GRIB file saved as: {output_grib_file}")
+    return True
@@ -0,0 +1,310 @@
+from .helper_functions import *
+from .output_cache import output_cache_id, cached_output, store_output, discard_output
+from .perturb_regionally import perturb_region_values
+from .perturb_specific_location import perturb_location_values
+from .perturb_by_polygons import perturb_polygons_values
+from .perturb_smoothly import SMOOTH_SHAPES, smooth_amplitude, perturb_smooth_values
+from .perturb_by_pattern import load_pattern, perturb_pattern_values
+from .perturbation_phase import phase_time_pairs
+from .perturbation_consistency import consistency_rules, consistency_steps, apply_consistency_step
+
+PLAN_OPERATION_KINDS = ["factor", "variable", "regional", "location", "polygons", "smooth", "pattern", "phase"]
+
+# kinds that threshold the points they modify (see `apply_thresholds`), factor and
+# variable scale whole fields as perturbation_by_factor and perturbation_of_variable do
+THRESHOLD_OPERATION_KINDS = ["regional", "location", "polygons", "smooth", "pattern"]
+
+# a plan cannot hold the amplitude array of the pattern shape, pattern operations add pattern files
+PLAN_SMOOTH_SHAPES = [shape for shape in SMOOTH_SHAPES if shape != "pattern"]
+
+def load_perturbation_plan(plan_file):
+    """
+    Load a perturbation plan from a JSON or YAML file.
+
+    A plan is a dict with a list of `operations` (a bare list of operations is
+    accepted too) and optionally the `grib_file` and `output_grib_file` to use.
+    Every operation has a `kind` (one of PLAN_OPERATION_KINDS) and the arguments
+    of the matching perturbation function, e.g.
+
+        {"kind": "factor", "variable": "u", "level": 300, "factor": 0.8}
+        {"kind": "variable", "variable": "msl", "level": 0, "zmul": 1, "zadd": 300}
+        {"kind": "regional", "variable": "msl", "level": 0, "lat_min": 40, "lat_max": 60,
+         "lon_min": 0, "lon_max": 10, "zmul": 1.1, "zadd": 1}
+        {"kind": "location", "variable": "msl", "level": 0, "lat": 50, "lon": 10, "zadd": 100}
+        {"kind": "polygons", "variable": "skt", "level": 0, "lonw": [310, 295], "lone": [320, 305],
+         "lats": [45, 35], "latn": [55, 45], "zmul": [1, 1], "zadd": [2, -2]}
+        {"kind": "smooth", "variable": "t", "level": 850, "shape": "gaussian", "lat": 50, "lon": 10,
+         "sigma_km": 500, "zadd": 2}
+        {"kind": "phase", "phase_shift": "both", "data_times": [[0, 1800]]}
+
+    Smooth operations use one of PLAN_SMOOTH_SHAPES. Field operations apply to
+    every dataTime unless a `data_time` is given. The thresholding rules of the
+    regional, location, polygons, smooth and pattern operations
+    (THRESHOLD_OPERATION_KINDS) can be set per variable for the whole plan with
+    `thresholds` ({variable: [rule, ...]}, see `threshold_rules`) or per
+    operation; the other kinds do not threshold and reject `thresholds`.
+
+    Parameters
+    ----------
+    plan_file : str
+        Path to the plan, `.yaml`/`.yml` files are read with PyYAML, anything else as JSON.
+
+    Returns
+    -------
+    dict
+    """
+    with open(plan_file, "r") as f:
+        if os.path.splitext(plan_file)[1] in [".yaml", ".yml"]:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is required to read YAML perturbation plans, use a JSON plan instead")
+            plan = yaml.safe_load(f)
+        else:
+            plan = json.load(f)
+
+    if isinstance(plan, list):
+        plan = {"operations": plan}
+
+    return plan
+
+def plan_operations(plan):
+    """
+    Operations of a plan (or of an ensemble, see `load_ensemble`), the plan `thresholds`
+    set on every operation of THRESHOLD_OPERATION_KINDS without its own.
+    """
+    operations = plan["operations"] if isinstance(plan, dict) else plan
+    if isinstance(plan, dict) and plan.get("thresholds"):
+        operations = [
+            dict({"thresholds": plan["thresholds"]}, **operation) if operation.get("kind") in THRESHOLD_OPERATION_KINDS else operation
+            for operation in operations
+        ]
+    return operations
+
+def _check_operation(operation):
+    kind = operation.get("kind")
+    if kind not in PLAN_OPERATION_KINDS:
+        raise ValueError(f"unknown perturbation kind {kind}, expected one of {PLAN_OPERATION_KINDS}")
+    if "thresholds" in operation and kind not in THRESHOLD_OPERATION_KINDS:
+        raise ValueError(f"{kind} perturbations are not thresholded, thresholds are only used by {THRESHOLD_OPERATION_KINDS}")
+
+    if kind == "smooth" and operation.get("shape", "gaussian") not in PLAN_SMOOTH_SHAPES:
+        raise ValueError(f"unknown smooth shape {operation['shape']} in a plan, expected one of {PLAN_SMOOTH_SHAPES} (use a pattern operation for a pattern file)")
+
+    if kind == "phase":
+        phase_time_pairs(operation.get("phase_shift", "both"), operation.get("data_times"))
+    elif "variable" not in operation:
+        raise ValueError(f"{kind} perturbation without variable: {operation}")
+
+def _operation_keys(grib_index, operation):
+    """
+    (shortName, level, dataTime) of the messages an operation applies to.
+    """
+    if operation["kind"] == "phase":
+        keys = list()
+        for (target_time, source_time) in phase_time_pairs(operation.get("phase_shift", "both"), operation.get("data_times")):
+            for entry in grib_index.select(data_time=target_time):
+                if grib_index.select(entry["shortName"], entry["level"], source_time):
+                    keys.append((entry["shortName"], entry["level"], target_time))
+        return keys
+
+    entries = grib_index.select(operation["variable"], operation.get("level", 0), operation.get("data_time"))
+    return [(entry["shortName"], entry["level"], entry["dataTime"]) for entry in entries]
+
+def apply_plan_operation(operation, data, geometry, grib_index, key):
+    # `data` is perturbed in place (but for "phase"), the callers pass a copy of the decoded values
+    kind = operation["kind"]
+    variable = operation.get("variable")
+
+    if kind == "factor":
+        instrumentation.count("points_modified", data.size)
+        return scale_points(data, None, zmul=float(operation["factor"]))
+
+    if kind == "variable":
+        instrumentation.count("points_modified", data.size)
+        return scale_points(data, None, zmul=float(operation.get("zmul", 1)), zadd=float(operation.get("zadd", 0)))
+
+    if kind == "regional":
+        return perturb_region_values(
+            data, geometry, variable,
+            operation.get("lat_min", LAT_MIN_LIM), operation.get("lat_max", LAT_MAX_LIM),
+            operation.get("lon_min", GRID_LON_MIN), operation.get("lon_max", GRID_LON_MAX),
+            zmul=operation.get("zmul", 1), zadd=operation.get("zadd", 0),
+            thresx=operation.get("thresx", 274.5), thresn=operation.get("thresn", 270.), thresfix=operation.get("thresfix", 274.5),
+            thresholds=operation.get("thresholds"))
+
+    if kind == "location":
+        return perturb_location_values(
+            data, geometry, variable, operation["lat"], operation["lon"],
+            zmul=operation.get("zmul", 1), zadd=operation.get("zadd", 0), thresholds=operation.get("thresholds"))
+
+    if kind == "polygons":
+        return perturb_polygons_values(
+            data, geometry, variable,
+            operation["lonw"], operation["lone"], operation["lats"], operation["latn"],
+            operation["zmul"], operation["zadd"],
+            thresx=operation.get("thresx", 274.5), thresn=operation.get("thresn", 270.), thresfix=operation.get("thresfix", 274.5),
+            overlap=operation.get("overlap", "last"), thresholds=operation.get("thresholds"))
+
+    if kind == "smooth":
+        amplitude = smooth_amplitude(
+            geometry, operation.get("shape", "gaussian"),
+            lat=operation.get("lat"), lon=operation.get("lon"), sigma_km=operation.get("sigma_km", 500.),
+            lat_s=operation.get("lat_min"), lat_n=operation.get("lat_max"),
+            lon_w=operation.get("lon_min"), lon_e=operation.get("lon_max"), taper_deg=operation.get("taper_deg", 5.))
+        return perturb_smooth_values(
+            data, geometry, variable, amplitude,
+            zmul=operation.get("zmul", 1), zadd=operation.get("zadd", 0),
+            thresx=operation.get("thresx", 274.5), thresn=operation.get("thresn", 270.), thresfix=operation.get("thresfix", 274.5),
+            thresholds=operation.get("thresholds"))
+
+    if kind == "pattern":
+        (short_name, level, _) = key
+        pattern = load_pattern(operation["pattern_file"], short_name, level, geometry, pattern_levels=operation.get("pattern_levels"))
+        return perturb_pattern_values(
+            data, pattern, alpha=operation.get("alpha", 1.), variable=short_name, thresholds=operation.get("thresholds"))
+
+    if kind == "phase":
+        (short_name, level, data_time) = key
+        source_time = dict(phase_time_pairs(operation.get("phase_shift", "both"), operation.get("data_times")))[data_time]
+        source = grib_index.read_message(grib_index.select(short_name, level, source_time)[0])
+        source.expand_grid(False)
+        instrumentation.count("points_modified", data.size)
+        return read_values(source)
+
+def group_plan_operations(grib_index, operations):
+    """
+    Group the operations of a plan by the (shortName, level, dataTime) they apply to, keeping the plan order.
+
+    Returns
+    -------
+    tuple of (dict, list)
+        The operations of every message key and the operations that match no message.
+    """
+    grouped = dict()
+    unmatched = list()
+    for operation in operations:
+        _check_operation(operation)
+        keys = _operation_keys(grib_index, operation)
+        if not keys:
+            unmatched.append(operation)
+        for key in keys:
+            grouped.setdefault(key, list()).append(operation)
+    return grouped, unmatched
+
+def encode_plan_message(message, payload):
+    """
+    Apply the plan operations of a message and encode it, `payload` is (grib_file, key, operations, consistency steps).
+
+    Runs in the worker processes of `write_encoded_grib`, so it only gets the
+    raw bytes of the message and picklable data.
+    """
+    grib_file, key, operations, steps = payload
+    grib_index = get_grib_index(grib_file)
+
+    with instrumentation.stage("decoding"):
+        grb = pygrib.fromstring(message)
+    geometry = get_grid_geometry(grb)
+    original = read_values(grb)
+    data = original.copy()
+
+    for operation in operations:
+        logger.debug("perturbing %s - %s @ Time: %s with %s", grb.shortName, grb.level, grb.dataTime, operation["kind"])
+        data = apply_plan_operation(operation, data, geometry, grib_index, key)
+
+    for step in steps:
+        data, adjusted = apply_consistency_step(step, data, original, geometry, grib_index, key, apply_plan_operation)
+        logger.debug("%s: adjusted %d points of %s - %s @ Time: %s", step["rule"], adjusted, grb.shortName, grb.level, grb.dataTime)
+
+    write_values(grb, data)
+
+    with instrumentation.stage("encoding"):
+        return grb.tostring()
+
+@instrumented_run
+def apply_perturbation_plan(
+        grib_file,
+        plan,
+        output_grib_file=None,
+        jobs=1,
+        consistency=None,):
+    """
+    Apply all the operations of a perturbation plan in a single read/write pass.
+
+    The operations are grouped by (shortName, level, dataTime) through the message
+    index of the grib file: every affected message is decoded once, all of its
+    operations are applied in plan order, and it is re-encoded once, while the
+    other messages are copied as raw bytes. With `jobs` > 1 the affected messages
+    are perturbed and encoded by a pool of processes (see `write_encoded_grib`).
+
+    A `phase` operation replaces the field with the original values of the paired
+    dataTime, operations listed after it are applied on top.
+
+    The optional consistency stage (`consistency`, or the `consistency` of the plan)
+    then adjusts the fields that depend on the perturbed ones, in the same pass and
+    only where they changed: geostrophic u/v increments from z increments, q and 2d
+    clipped against t and 2t, sp following msl (see `apply_consistency_step`).
+
+    Parameters
+    ----------
+    grib_file : str
+        The input GRIB file.
+    plan : dict or list
+        The plan (see `load_perturbation_plan`) or directly its list of operations.
+    output_grib_file : str, optional
+        The output GRIB file. If not provided, it will create one.
+    jobs : int, optional
+        Number of processes encoding the perturbed messages. Default is 1.
+    consistency : bool, str or list, optional
+        The consistency rules to apply, True or "all" for every rule (see `CONSISTENCY_RULES`).
+        Default is the `consistency` of the plan, if any.
+    """
+    operations = plan_operations(plan)
+    if consistency is None and isinstance(plan, dict):
+        consistency = plan.get("consistency")
+    rules = consistency_rules(consistency)
+
+    path, file = os.path.split(grib_file)
+    filename, extension = os.path.splitext(file)
+
+    cache_id = None
+    if not output_grib_file:
+        cache_id = output_cache_id(grib_file, "perturbation_plan", {"operations": operations, "consistency": rules})
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"{filename}_plan_perturbed_{cache_id}{extension}")
+        if cached_output(output_grib_file):
+            return True
+
+    grib_index = get_grib_index(grib_file)
+    grouped, unmatched = group_plan_operations(grib_index, operations)
+
+    for operation in unmatched:
+        logger.warning(f"no message in the grib file for the operation {operation}")
+
+    steps = consistency_steps(grib_index, grouped, rules)
+
+    payloads = {
+        key: (grib_file, key, grouped.get(key, []), steps.get(key, []))
+        for key in list(grouped) + [key for key in steps if key not in grouped]
+    }
+
+    valid_grib, perturbed_messages = write_encoded_grib(grib_file, output_grib_file, payloads, encode_plan_message, jobs=jobs)
+
+    if not valid_grib:
+        return False
+
+    if not perturbed_messages:
+        logger.error(f"no message of the grib file matched the perturbation plan.")
+        discard_output(output_grib_file)
+        return False
+
+    store_output(output_grib_file)
+
+    u_id = cache_id or uuid4().hex[-8:]
+    write_perturbation_cfg(os.path.join(path, f"{filename}_plan_perturbed_{u_id}_cfg.json"), {
+        "grib_file": grib_file,
+        "operations": operations,
+        "consistency": rules,
+    }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+    logger.info(f"Output GRIB file saved as: {output_grib_file}")
+    return True
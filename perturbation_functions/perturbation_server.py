@@ -0,0 +1,393 @@
+import mmap
+import time
+import socket
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .helper_functions import *
+from .output_cache import output_cache_id, cached_output, store_output
+from .perturbation_plan import group_plan_operations, apply_perturbation_plan
+from .perturbation_consistency import consistency_rules
+from .perturbation_ensemble import _write_member
+from .perturbation_batch import config_command, config_operations
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+
+# decoded fields kept in memory by the server, the least recently used ones are dropped first
+SERVER_MAX_MEMORY_MB = 4096.
+# base grib files kept memory mapped (with their index) by the server
+SERVER_MAX_FILES = 8
+
+# size of the chunks of an output streamed back to the client
+SERVER_CHUNK_SIZE = 1024 * 1024
+
+class FieldCache:
+    """
+    Least recently used cache of the decoded fields of the base grib files, bounded in bytes.
+
+    The base files themselves (their message index and a read-only memory map)
+    are kept for the SERVER_MAX_FILES last used ones. A base file modified on
+    disk gets a new message index (see `get_grib_index`), its stale fields are
+    then dropped. Shared by the threads of the server: the fields are decoded
+    outside of its lock, a field being decoded is waited for by the other
+    threads needing it instead of being decoded again.
+    """
+    def __init__(self, max_bytes=SERVER_MAX_MEMORY_MB * 1024 ** 2, max_files=SERVER_MAX_FILES):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._bases = OrderedDict()
+        self._fields = OrderedDict()
+        # futures of the fields being decoded, keyed as the fields
+        self._pending = dict()
+        self._lock = threading.RLock()
+
+    def base(self, grib_file):
+        """
+        Message index and memory map of a base grib file.
+        """
+        grib_file = os.path.abspath(grib_file)
+        grib_index = get_grib_index(grib_file)
+
+        with self._lock:
+            base = self._bases.get(grib_file)
+            if base is not None and base["grib_index"] is grib_index:
+                self._bases.move_to_end(grib_file)
+                return base
+
+            if base is not None:
+                self._drop_file(grib_file)
+
+            with open(grib_file, "rb") as f:
+                raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # the maps are closed when garbage collected, a request may still be writing from an evicted one
+            base = {"grib_file": grib_file, "grib_index": grib_index, "raw": raw}
+            self._bases[grib_file] = base
+
+            while len(self._bases) > self.max_files:
+                self._drop_file(next(iter(self._bases)))
+
+            return base
+
+    def _drop_file(self, grib_file):
+        del self._bases[grib_file]
+        for field_key in [field_key for field_key in self._fields if field_key[0] == grib_file]:
+            self.n_bytes -= self._fields.pop(field_key)[0].nbytes
+
+    def field(self, base, key):
+        """
+        Decoded values and grid geometry of the message `key` of a base grib file.
+        """
+        field_key = (base["grib_file"], key)
+
+        with self._lock:
+            if field_key in self._fields:
+                self.hits += 1
+                self._fields.move_to_end(field_key)
+                return self._fields[field_key]
+
+            pending = self._pending.get(field_key)
+            if pending is None:
+                self.misses += 1
+                pending = self._pending[field_key] = Future()
+                decoding = True
+            else:
+                self.hits += 1
+                decoding = False
+
+        if not decoding:
+            return pending.result()
+
+        try:
+            entry = base["grib_index"].select(*key)[0]
+            grb = pygrib.fromstring(base["raw"][entry["offset"]:entry["offset"] + entry["length"]])
+            geometry = get_grid_geometry(grb)
+            values = read_values(grb)
+        except BaseException as e:
+            with self._lock:
+                del self._pending[field_key]
+            pending.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._pending[field_key]
+            # a base file dropped (or modified) while decoding does not get its field back
+            if self._bases.get(base["grib_file"]) is base:
+                self._fields[field_key] = (values, geometry)
+                self.n_bytes += values.nbytes
+                # the field just decoded is kept even if it alone exceeds the budget
+                while self.n_bytes > self.max_bytes and len(self._fields) > 1:
+                    self.n_bytes -= self._fields.popitem(last=False)[1][0].nbytes
+
+        pending.set_result((values, geometry))
+        return values, geometry
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._bases),
+                "fields": len(self._fields),
+                "bytes": self.n_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+class PerturbationServer:
+    """
+    Long-running perturbation service keeping the base grib files warm in memory.
+
+    Clients connect over localhost TCP or a Unix socket and send one JSON
+    request per line. A request is a config as read by the CLI and the batch
+    (e.g. {"grib_file": ..., "perturbation_json": {"u": {"300": 0.6}}} or
+    {"grib_file": ..., "operations": [...]}, see `config_command` and
+    `config_operations`) with optionally:
+
+    - `output_grib_file`, else the output is written to `output_dir`, named after a hash
+      of the input and the operations (see `output_cache_id`) and reused when it exists,
+    - `response`: "path" (default) to get back the output path, "bytes" to get its content.
+
+    Every request gets one JSON line back: {"status": "ok", "output_grib_file", "cached",
+    "bytes", "fields_modified", "wall_time"} or {"status": "failed", "error"}, followed for
+    "bytes" responses by exactly `bytes` bytes of the output. {"command": "stats"} returns
+    the state of the field cache.
+
+    The message indexes, memory maps and decoded fields of the base files are kept
+    in a `FieldCache` and the grid geometries and regions in their own caches (see
+    `get_grid_geometry` and `box_indices`), so a request only decodes the fields that
+    are not in memory yet, perturbs copies of them and copies everything else as raw
+    bytes. Requests are handled concurrently by a pool of `jobs` threads.
+    """
+    def __init__(self, output_dir=None, max_memory_mb=SERVER_MAX_MEMORY_MB, max_files=SERVER_MAX_FILES, jobs=4):
+        self.output_dir = output_dir if output_dir else OUTPUT_GRIB_PATH
+        self.cache = FieldCache(max_bytes=float(max_memory_mb) * 1024 ** 2, max_files=max_files)
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.n_requests = 0
+        self._server = None
+        self._loop = None
+        # set once the server accepts connections
+        self.ready = threading.Event()
+        self._stopping = False
+
+    def preload(self, grib_file, keys=None):
+        """
+        Warm the cache with a base grib file and the fields `keys` (every field by default).
+        """
+        base = self.cache.base(grib_file)
+        keys = keys if keys is not None else [
+            (entry["shortName"], entry["level"], entry["dataTime"]) for entry in base["grib_index"].messages]
+        for key in keys:
+            self.cache.field(base, tuple(key))
+        logger.info(f"preloaded {len(keys)} fields of {grib_file}")
+
+    def handle(self, request):
+        """
+        Run one request (see `PerturbationServer`), returns the response.
+        """
+        start = time.perf_counter()
+        self.n_requests += 1
+
+        if request.get("command") == "stats":
+            return {"status": "ok", "requests": self.n_requests, **self.cache.stats()}
+
+        try:
+            config = {key: value for (key, value) in request.items() if key not in ["response", "output_grib_file"]}
+            command = config_command(config)
+            if command == "perturbation_ensemble":
+                raise ValueError("ensembles are not served, use the perturbation_ensemble command")
+            grib_file = request["grib_file"]
+            operations = config_operations(config, command)
+            rules = consistency_rules(config.get("consistency"))
+
+            base = self.cache.base(grib_file)
+            grouped, unmatched = group_plan_operations(base["grib_index"], operations)
+            for operation in unmatched:
+                logger.warning(f"no message in the grib file for the operation {operation}")
+
+            filename, extension = os.path.splitext(os.path.basename(grib_file))
+            output_grib_file = request.get("output_grib_file")
+            cache_id = None
+            cached = False
+            if not output_grib_file:
+                cache_id = output_cache_id(grib_file, "perturbation_plan", {"operations": operations, "consistency": rules})
+                output_grib_file = os.path.join(self.output_dir, f"{filename}_serve_{cache_id}{extension}")
+                cached = cached_output(output_grib_file)
+
+            if not cached and rules:
+                # the consistency stage reads the dependent fields itself
+                if not apply_perturbation_plan(grib_file, {"operations": operations, "consistency": rules}, output_grib_file):
+                    raise ValueError(f"the perturbation plan of {grib_file} failed")
+            elif not cached:
+                if not grouped:
+                    raise ValueError(f"no message of {grib_file} matches the operations")
+
+                fields = dict()
+                geometries = dict()
+                for key in grouped:
+                    fields[key], geometries[key] = self.cache.field(base, key)
+
+                os.makedirs(os.path.dirname(os.path.abspath(output_grib_file)), exist_ok=True)
+                _write_member(operations, output_grib_file, base=dict(base, fields=fields, geometries=geometries))
+                store_output(output_grib_file)
+
+                u_id = cache_id or uuid4().hex[-8:]
+                write_perturbation_cfg(os.path.join(os.path.dirname(grib_file), f"{filename}_serve_{u_id}_cfg.json"), {
+                    "grib_file": grib_file,
+                    "command": command,
+                    "operations": operations,
+                }, output_grib_file=output_grib_file, cache_id=cache_id)
+
+            return {
+                "status": "ok",
+                "output_grib_file": output_grib_file,
+                "cached": cached,
+                "bytes": os.path.getsize(output_grib_file),
+                "fields_modified": len(grouped),
+                "wall_time": time.perf_counter() - start,
+            }
+        except Exception as e:
+            logger.error(f"request {request} failed: {e!r}")
+            return {"status": "failed", "error": repr(e), "wall_time": time.perf_counter() - start}
+
+    async def _handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("a request is a JSON object")
+                except ValueError as e:
+                    response, request = {"status": "failed", "error": repr(e)}, {}
+                else:
+                    response = await loop.run_in_executor(self.executor, self.handle, request)
+
+                send_bytes = request.get("response") == "bytes" and response["status"] == "ok"
+                writer.write(json.dumps(response).encode() + b"\n")
+                if send_bytes:
+                    with open(response["output_grib_file"], "rb") as f:
+                        while chunk := f.read(SERVER_CHUNK_SIZE):
+                            writer.write(chunk)
+                            await writer.drain()
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=SERVER_HOST, port=SERVER_PORT, socket_path=None):
+        """
+        Start listening on a Unix socket if `socket_path` is given, else on host:port.
+        """
+        self._loop = asyncio.get_running_loop()
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=socket_path)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        logger.info(f"perturbation server listening on {socket_path if socket_path else self.address()}")
+        self.ready.set()
+        return self._server
+
+    def address(self):
+        return self._server.sockets[0].getsockname()
+
+    async def _serve(self, host, port, socket_path):
+        server = await self.start(host=host, port=port, socket_path=socket_path)
+        try:
+            # `stop` called while starting could not close the server yet
+            if self._stopping:
+                server.close()
+            else:
+                async with server:
+                    await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+    def serve(self, host=SERVER_HOST, port=SERVER_PORT, socket_path=None):
+        """
+        Serve until `stop` is called (or the process is interrupted).
+        """
+        try:
+            asyncio.run(self._serve(host, port, socket_path))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        """
+        Stop serving, from any thread, also while the server is still starting.
+        """
+        self._stopping = True
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+def serve_perturbations(
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        socket_path=None,
+        output_dir=None,
+        max_memory_mb=SERVER_MAX_MEMORY_MB,
+        max_files=SERVER_MAX_FILES,
+        jobs=4,
+        preload=(),):
+    """
+    Run a `PerturbationServer` until interrupted.
+
+    Parameters
+    ----------
+    host, port : str, int, optional
+        Localhost address to listen on. Default is 127.0.0.1:8765.
+    socket_path : str, optional
+        Unix socket to listen on instead.
+    output_dir : str, optional
+        Directory of the outputs without an `output_grib_file`. Default is OUTPUT_GRIB_PATH.
+    max_memory_mb : float, optional
+        Memory of the decoded fields kept warm. Default is SERVER_MAX_MEMORY_MB.
+    max_files : int, optional
+        Number of base grib files kept warm. Default is SERVER_MAX_FILES.
+    jobs : int, optional
+        Number of requests handled concurrently. Default is 4.
+    preload : list of str, optional
+        Base grib files whose fields are all decoded before serving.
+    """
+    server = PerturbationServer(output_dir=output_dir, max_memory_mb=max_memory_mb, max_files=max_files, jobs=jobs)
+    for grib_file in preload:
+        server.preload(grib_file)
+    server.serve(host=host, port=port, socket_path=socket_path)
+
+def send_perturbation_request(request, host=SERVER_HOST, port=SERVER_PORT, socket_path=None, timeout=None):
+    """
+    Send one request to a perturbation server (see `PerturbationServer`).
+
+    Returns
+    -------
+    dict or tuple of (dict, bytes)
+        The response, and the output content for a request with "response": "bytes".
+    """
+    if socket_path:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+    else:
+        connection = socket.create_connection((host, port), timeout=timeout)
+
+    with connection, connection.makefile("rb") as f:
+        connection.sendall(json.dumps(request).encode() + b"\n")
+        response = json.loads(f.readline())
+        if request.get("response") != "bytes" or response["status"] != "ok":
+            return response
+        return response, f.read(response["bytes"])
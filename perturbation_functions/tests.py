@@ -1,16 +1,34 @@
 import unittest
 # from unittest.mock import patch, mock_open, MagicMock
 import os
+import sys
 import json
+import subprocess
+import threading
+import time
+import glob
+import io
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import pygrib
 
 import numpy as np
 
 from . import test_grib_files
-from helper_functions import OUTPUT_GRIB_PATH
+from .helper_functions import OUTPUT_GRIB_PATH, ROOT_PATH
+from .perturb_regionally import perturb_region_values
+from . import perturbation_server
+from .perturbation_server import FieldCache
         
 # Assuming the functions from your CLI script are imported here
 from . import (
+    get_grib_index,
+    get_grid_geometry,
+    box_indices,
+    polygon_indices,
+    radius_indices,
+    nearest_index,
+    cosine_box_weights,
     validate_grib_file,
     perturbation_by_factor,
     perturbation_of_variable,
@@ -18,10 +36,35 @@ from . import (
     perturbation_phase,
     perturb_regionally,
     perturb_specific_location,
-    perturb_by_polygons
+    perturb_by_polygons,
+    perturb_polygons_values,
+    perturb_smoothly,
+    smooth_amplitude,
+    perturb_by_pattern,
+    load_pattern,
+    perturb_column,
+    apply_thresholds,
+    saturation_specific_humidity,
+    apply_perturbation_plan,
+    LEVELS,
+    generate_ensemble,
+    ensemble_members,
+    run_batch,
+    ExperimentRegistry,
+    output_cache_id,
+    evict_outputs,
+    config_command,
+    config_operations,
+    PerturbationServer,
+    send_perturbation_request,
+    grib_to_array_store,
+    open_array_store,
 )
 
-from logger import logger
+from logger import logger, instrumentation
+
+# seconds `perturbations_aifs.py --help` may take once the interpreter is started
+CLI_STARTUP_BUDGET = 0.1
 
 if len(test_grib_files) > 1:
     logger.warning(f"Several test files detected. Only {test_grib_files[0]} will be used")
@@ -39,6 +82,23 @@ class TestPerturbationFunctions(unittest.TestCase):
         if not os.path.exists(cls.test_grib_file):
             raise FileNotFoundError(f"Test GRIB file not found at {cls.test_grib_file}")
 
+    def _run_files(self):
+        # the _cfg.json and _report.json written next to the perturbed grib files
+        return {
+            run_file
+            for directory in [os.path.dirname(self.test_grib_file), OUTPUT_GRIB_PATH]
+            for pattern in ["*_cfg.json", "*_report.json"]
+            for run_file in glob.glob(os.path.join(directory, pattern))
+        }
+
+    def setUp(self):
+        self.existing_run_files = self._run_files()
+
+    def tearDown(self):
+        # Clean up the cfg and report files written by the test
+        for run_file in self._run_files() - self.existing_run_files:
+            os.remove(run_file)
+
     def test_perturbation_by_factor(self):
         logger.info("Testing perturbation_by_factor...")
         # Step 1: Extract original data for comparison
@@ -197,18 +257,42 @@ class TestPerturbationFunctions(unittest.TestCase):
                 if key in original_data_eighteen:
                     original_eighteen_data, _, _ = original_data_eighteen[key]
                     perturbed_data_zero, _, _ = grb.data()
-                    np.testing.assert_array_almost_equal(perturbed_data_zero, original_eighteen_data, decimal=3)
+                    np.testing.assert_array_equal(perturbed_data_zero, original_eighteen_data)
             elif grb.dataTime == 1800:
                 # Check that the data for time 1800 is now equal to what was originally at 0
                 if key in original_data_zero:
                     original_zero_data, _, _ = original_data_zero[key]
                     perturbed_data_eighteen, _, _ = grb.data()
-                    np.testing.assert_array_almost_equal(perturbed_data_eighteen, original_zero_data, decimal=3)
+                    np.testing.assert_array_equal(perturbed_data_eighteen, original_zero_data)
 
         grbs.close()
 
+        # Step 5: Streaming through the index, with float32 values and no memory to keep them, gives the same fields
+        streamed_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_perturbed_phase_streamed.grib')
+        self.assertTrue(perturbation_phase(self.test_grib_file, phase_shift="both", output_grib_file=streamed_grib_file, use_index=True, dtype=np.float32, max_memory_mb=0))
+
+        # Step 6: An explicit (1800, 0) pair shifted to the past is the default pair shifted to the future
+        future_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_perturbed_phase_future.grib')
+        past_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_perturbed_phase_past.grib')
+        self.assertTrue(perturbation_phase(self.test_grib_file, phase_shift="future", output_grib_file=future_grib_file, use_index=True))
+        self.assertTrue(perturbation_phase(self.test_grib_file, phase_shift="past", data_times=[(1800, 0)], output_grib_file=past_grib_file))
+        with open(future_grib_file, 'rb') as f_future, open(past_grib_file, 'rb') as f_past:
+            self.assertEqual(f_future.read(), f_past.read())
+
+        grbs = pygrib.open(perturbed_grib_file)
+        grbs_streamed = pygrib.open(streamed_grib_file)
+        for grb, grb_streamed in zip(grbs, grbs_streamed):
+            grb.expand_grid(False)
+            grb_streamed.expand_grid(False)
+            np.testing.assert_allclose(grb_streamed.values, grb.values, rtol=1e-6)
+        grbs.close()
+        grbs_streamed.close()
+
         # Clean up
         os.remove(perturbed_grib_file)
+        os.remove(streamed_grib_file)
+        os.remove(future_grib_file)
+        os.remove(past_grib_file)
 
     def test_perturb_regionally(self):
         # Step 1: Extract original data for comparison
@@ -296,8 +380,10 @@ class TestPerturbationFunctions(unittest.TestCase):
                 break
         grbs.close()
 
-        # Step 5: Create a mask for the specific location
-        mask = (np.isclose(original_lats, lat, atol=0.5)) & (np.isclose(original_lons, lon, atol=0.5))
+        # Step 5: Create a mask for the grid point nearest to the location
+        distance = np.sin(np.radians(original_lats - lat) / 2) ** 2 + \
+            np.cos(np.radians(original_lats)) * np.cos(np.radians(lat)) * np.sin(np.radians(original_lons - lon) / 2) ** 2
+        mask = distance == distance.min()
         expected_data = np.copy(original_data)
         expected_data[mask] = original_data[mask] * zmul + zadd
 
@@ -347,8 +433,8 @@ class TestPerturbationFunctions(unittest.TestCase):
                 break
         grbs.close()
 
-        unique_lons = np.unique(perturbed_lats.flatten())
-        unique_lats = np.unique(perturbed_lons.flatten())
+        unique_lons = np.unique(perturbed_lons.flatten())
+        unique_lats = np.unique(perturbed_lats.flatten())
 
         # Step 5: Apply perturbations within specified polygons
         expected_data = np.copy(original_data)
@@ -362,9 +448,752 @@ class TestPerturbationFunctions(unittest.TestCase):
         # Ensure perturbation only in the polygons
         np.testing.assert_array_almost_equal(perturbed_data, expected_data, decimal=0)
 
+        # Step 6: Overlapping polygons combine as the sum, the last or the max of their perturbations
+        geometry = get_grid_geometry(pygrib.open(self.test_grib_file).message(1))
+        lonw_list, lone_list, lats_list, latn_list = [0., 5., 300.], [20., 30., 330.], [30., 40., -20.], [50., 60., 10.]
+        zmul_list, zadd_list = [1.1, 0.9, 1.], [1., 2., -3.]
+        boxes = [box_indices(geometry, lat_s, lat_n, lon_w, lon_e, snap=True) for (lon_w, lon_e, lat_s, lat_n) in zip(lonw_list, lone_list, lats_list, latn_list)]
+        data = original_data.reshape(-1)
+
+        expected = {"last": data.copy(), "sum": data.copy(), "max": np.full(data.size, -np.inf)}
+        for region, zmul, zadd in zip(boxes, zmul_list, zadd_list):
+            expected["last"][region] = data[region] * zmul + zadd
+            expected["sum"][region] += data[region] * (zmul - 1) + zadd
+            expected["max"][region] = np.maximum(expected["max"][region], data[region] * zmul + zadd)
+        expected["max"] = np.where(np.isinf(expected["max"]), data, expected["max"])
+
+        for overlap in ["last", "sum", "max"]:
+            perturbed = perturb_polygons_values(data.copy(), geometry, var, lonw_list, lone_list, lats_list, latn_list, zmul_list, zadd_list, overlap=overlap)
+            np.testing.assert_array_almost_equal(perturbed, expected[overlap])
+
+        # Clean up
+        os.remove(perturbed_grib_file)
+
+    def test_perturb_smoothly(self):
+        # Step 1: Extract original data and coordinates for comparison
+        grbs = pygrib.open(self.test_grib_file)
+        for grb in grbs:
+            grb.expand_grid(False)
+            if grb.shortName == 'msl' and grb.level == 0:
+                original_data, original_lats, original_lons = grb.data()
+                geometry = get_grid_geometry(grb)
+                break
+        grbs.close()
+
+        # Step 2: Apply a gaussian bump of 800 km
+        perturbed_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_smooth_perturbed.grib')
+        self.assertTrue(perturb_smoothly(self.test_grib_file, 'msl', 0, shape="gaussian", lat=60., lon=340., sigma_km=800., zadd=500., output_grib_file=perturbed_grib_file))
+
+        grbs = pygrib.open(perturbed_grib_file)
+        for grb in grbs:
+            grb.expand_grid(False)
+            if grb.shortName == 'msl' and grb.level == 0:
+                perturbed_data = grb.values
+                break
+        grbs.close()
+
+        # Step 3: Compare with the gaussian of the great-circle distance over the whole grid
+        lats, lons = np.radians(original_lats), np.radians(original_lons)
+        a = np.sin((lats - np.radians(60.)) / 2) ** 2 + np.cos(lats) * np.cos(np.radians(60.)) * np.sin((lons - np.radians(340.)) / 2) ** 2
+        distance = 2 * 6371. * np.arcsin(np.sqrt(a))
+        weights = np.where(distance <= 3 * 800., np.exp(-0.5 * (distance / 800.) ** 2), 0.)
+        np.testing.assert_array_almost_equal(perturbed_data, original_data + 500. * weights, decimal=0)
+
+        # Step 4: The amplitude is cached, and a cosine box without taper is the plain box
+        self.assertIs(smooth_amplitude(geometry, "gaussian", lat=60., lon=340., sigma_km=800.)[1], smooth_amplitude(geometry, "gaussian", lat=60, lon=340, sigma_km=800)[1])
+        indices, weights = smooth_amplitude(geometry, "cosine_box", lat_s=40., lat_n=60., lon_w=0., lon_e=10., taper_deg=0.)
+        np.testing.assert_array_equal(indices, box_indices(geometry, 40., 60., 0., 10.))
+        self.assertTrue(np.all(weights == 1.))
+
+        # Step 5: A taper keeps the box and adds a smooth border in (0, 1)
+        tapered_indices, tapered_weights = smooth_amplitude(geometry, "cosine_box", lat_s=40., lat_n=60., lon_w=0., lon_e=10., taper_deg=10.)
+        self.assertTrue(np.all(tapered_weights[np.isin(tapered_indices, indices)] == 1.))
+        self.assertTrue(np.all((tapered_weights > 0) & (tapered_weights <= 1)))
+
         # Clean up
         os.remove(perturbed_grib_file)
 
+    def test_perturb_by_pattern(self):
+        # Step 1: Extract original data for comparison
+        grbs = pygrib.open(self.test_grib_file)
+        original_data = {}
+        for grb in grbs:
+            grb.expand_grid(False)
+            if grb.dataTime == 0 and (grb.shortName, grb.level) in [('t', 500), ('t', 850), ('msl', 0)]:
+                original_data[(grb.shortName, grb.level)] = grb.values
+                geometry = get_grid_geometry(grb)
+        grbs.close()
+
+        # Step 2: A multi-level .npy pattern on the grid and a regular 1 degree .npz pattern of the latitude
+        npy_pattern_file = os.path.join(OUTPUT_GRIB_PATH, 'test_pattern.npy')
+        npz_pattern_file = os.path.join(OUTPUT_GRIB_PATH, 'test_pattern.npz')
+        os.makedirs(OUTPUT_GRIB_PATH, exist_ok=True)
+        pattern = np.random.default_rng(0).normal(size=(len(LEVELS), geometry.n_points))
+        np.save(npy_pattern_file, pattern)
+        lats, lons = np.arange(90., -90.5, -1.), np.arange(0., 360., 1.)
+        np.savez(npz_pattern_file, msl=np.repeat(lats, lons.size), lats=lats, lons=lons)
+
+        # Step 3: Add 2 * pattern to t at 500 and 850 hPa
+        perturbed_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_pattern_perturbed.grib')
+        self.assertTrue(perturb_by_pattern(self.test_grib_file, npy_pattern_file, {'t': [500, 850]}, alpha=2., output_grib_file=perturbed_grib_file))
+
+        grbs = pygrib.open(perturbed_grib_file)
+        for grb in grbs:
+            grb.expand_grid(False)
+            if grb.dataTime == 0 and grb.shortName == 't' and grb.level in [500, 850]:
+                expected_data = apply_thresholds(original_data[('t', grb.level)] + 2. * pattern[LEVELS.index(grb.level)], 't')
+                np.testing.assert_array_almost_equal(grb.values, expected_data, decimal=1)
+        grbs.close()
+
+        # Step 4: The regular pattern is regridded by nearest neighbour, a grib pattern on the same grid is used as is
+        regridded = load_pattern(npz_pattern_file, 'msl', 0, geometry)
+        self.assertTrue(np.all(np.abs(regridded - geometry.lats) <= 0.5))
+        np.testing.assert_array_equal(load_pattern(self.test_grib_file, 'msl', 0, geometry), original_data[('msl', 0)])
+
+        # Step 5: The row of a multi-level .npz pattern is read once and reused by the next times of the field
+        levels_pattern_file = os.path.join(OUTPUT_GRIB_PATH, 'test_pattern_levels.npz')
+        np.savez(levels_pattern_file, t=pattern)
+        loaded = load_pattern(levels_pattern_file, 't', 850, geometry)
+        np.testing.assert_array_equal(loaded, pattern[LEVELS.index(850)])
+        self.assertIs(load_pattern(levels_pattern_file, 't', 850, geometry), loaded)
+
+        # Clean up
+        os.remove(perturbed_grib_file)
+        os.remove(npy_pattern_file)
+        os.remove(npz_pattern_file)
+        os.remove(levels_pattern_file)
+
+    def test_perturb_column(self):
+        # Step 1: Perturb t on every level of a region with an amplitude profile
+        profile = np.linspace(0., 1., len(LEVELS))
+        perturbed_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_column_perturbed.grib')
+        self.assertTrue(perturb_column(self.test_grib_file, 't', levels="all", profile=list(profile), zmul=1.01, zadd=2., lat_s=30., lat_n=60., lon_w=0., lon_e=40., output_grib_file=perturbed_grib_file))
+
+        # Step 2: Every level is the regional perturbation scaled by its amplitude
+        grbs = pygrib.open(self.test_grib_file)
+        grbs_perturbed = pygrib.open(perturbed_grib_file)
+        for grb, grb_perturbed in zip(grbs, grbs_perturbed):
+            grb.expand_grid(False)
+            grb_perturbed.expand_grid(False)
+            if grb.shortName == 't':
+                amplitude = profile[LEVELS.index(grb.level)]
+                expected_data = perturb_region_values(grb.values, get_grid_geometry(grb), 't', 30., 60., 0., 40., zmul=1. + amplitude * 0.01, zadd=2. * amplitude)
+                np.testing.assert_array_almost_equal(grb_perturbed.values, expected_data, decimal=1)
+            else:
+                self.assertEqual(grb_perturbed.tostring(), grb.tostring())
+        grbs.close()
+        grbs_perturbed.close()
+
+        # Step 3: By default the column of z is its LEVELS (not the orography) over the whole grid
+        self.assertTrue(perturb_column(self.test_grib_file, 'z', zadd=10., output_grib_file=perturbed_grib_file))
+        grbs = pygrib.open(self.test_grib_file)
+        grbs_perturbed = pygrib.open(perturbed_grib_file)
+        for grb, grb_perturbed in zip(grbs, grbs_perturbed):
+            if grb.shortName == 'z' and grb.level in LEVELS:
+                np.testing.assert_array_almost_equal(grb_perturbed.values, grb.values + 10., decimal=1)
+            else:
+                self.assertEqual(grb_perturbed.tostring(), grb.tostring())
+        grbs.close()
+        grbs_perturbed.close()
+
+        # Step 4: A surface variable has no column of all the levels
+        self.assertFalse(perturb_column(self.test_grib_file, 'msl', zadd=10., output_grib_file=perturbed_grib_file))
+
+        # Clean up
+        os.remove(perturbed_grib_file)
+
+    def test_apply_thresholds(self):
+        # Step 1: Only the modified points of a float32 field are thresholded, without changing its type
+        data = np.array([-5., 250., 271., 273., 280., -1.], dtype=np.float32)
+        with instrumentation.run():
+            result = apply_thresholds(data, 't', indices=np.array([0, 2, 3]))
+            self.assertEqual(instrumentation.counters["points_clipped"], 3)
+        self.assertIs(result, data)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_array_equal(result, np.array([0., 250., 274.5, 274.5, 280., -1.], dtype=np.float32))
+
+        # Step 2: Physical bounds of the other variables, on a stack of fields
+        data = np.array([[-0.5, 0.5, 1.5], [0.2, 2., -3.]])
+        np.testing.assert_array_equal(apply_thresholds(data, 'lsm'), [[0., 0.5, 1.], [0.2, 1., 0.]])
+
+        # Step 3: User rules replace the rules of the variables they list
+        rules = {'msl': [{'min': 95000., 'max': 105000.}, {'range': [100000., 100100.], 'value': 100000.}]}
+        data = np.array([90000., 100050., 110000., 101000.])
+        np.testing.assert_array_equal(apply_thresholds(data, 'msl', rules=rules), [95000., 100000., 105000., 101000.])
+        np.testing.assert_array_equal(apply_thresholds(np.array([271.]), 't', rules={'t': []}), [271.])
+
+    def test_grib_index(self):
+        # Step 1: Extract the messages keys in file order
+        grbs = pygrib.open(self.test_grib_file)
+        original_keys = [(grb.shortName, grb.level, grb.dataTime) for grb in grbs]
+        grbs.close()
+
+        # Step 2: Build the index and check it locates every message
+        grib_index = get_grib_index(self.test_grib_file, rebuild=True)
+        self.assertEqual([(m["shortName"], m["level"], m["dataTime"]) for m in grib_index.messages], original_keys)
+        self.assertTrue(os.path.exists(f"{self.test_grib_file}.idx"))
+        self.assertEqual(validate_grib_file(self.test_grib_file, use_index=True), validate_grib_file(self.test_grib_file))
+
+        # Step 3: Read a message through the index and compare it with pygrib
+        grbs = pygrib.open(self.test_grib_file)
+        for grb in grbs:
+            if grb.shortName == 't' and grb.level == 500:
+                grb.expand_grid(False)
+                original_data = grb.values
+                data_time = grb.dataTime
+                break
+        grbs.close()
+
+        entries = grib_index.select('t', 500, data_time)
+        self.assertEqual(len(entries), 1)
+        grb = grib_index.read_message(entries[0])
+        grb.expand_grid(False)
+        np.testing.assert_array_equal(grb.values, original_data)
+
+    def test_copy_through_matches_sequential(self):
+        # Step 1: Perturb the same field with and without the message index
+        sequential_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_perturbed_sequential.grib')
+        indexed_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_perturbed_indexed.grib')
+
+        self.assertTrue(perturbation_by_factor(self.test_grib_file, 't', 500, 1.1, output_grib_file=sequential_grib_file))
+        self.assertTrue(perturbation_by_factor(self.test_grib_file, 't', 500, 1.1, output_grib_file=indexed_grib_file, use_index=True))
+
+        # Step 2: Untouched messages are copied byte for byte, so both outputs are identical
+        with open(sequential_grib_file, 'rb') as f1, open(indexed_grib_file, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        # Clean up
+        os.remove(sequential_grib_file)
+        os.remove(indexed_grib_file)
+
+    def test_grid_geometry(self):
+        # Step 1: Compute the latitudes and longitudes of two messages with pygrib
+        grbs = pygrib.open(self.test_grib_file)
+        grb_t = grbs.select(shortName='t', level=500)[0]
+        grb_msl = grbs.select(shortName='msl', level=0)[0]
+        grb_t.expand_grid(False)
+        original_data, original_lats, original_lons = grb_t.data()
+
+        # Step 2: Both messages share the same cached geometry
+        geometry = get_grid_geometry(grb_t)
+        self.assertIs(get_grid_geometry(grb_msl), geometry)
+        grbs.close()
+
+        np.testing.assert_array_equal(geometry.lats, original_lats.reshape(-1))
+        np.testing.assert_array_equal(geometry.lons, original_lons.reshape(-1))
+        np.testing.assert_array_equal(geometry.unique_lats, np.unique(original_lats))
+        self.assertEqual(geometry.n_points, original_data.size)
+        self.assertEqual(geometry.row_offsets[-1], original_data.size)
+
+    def test_spatial_index(self):
+        grbs = pygrib.open(self.test_grib_file)
+        grb = grbs.message(1)
+        geometry = get_grid_geometry(grb)
+        grbs.close()
+
+        lats, lons = geometry.lats, geometry.lons
+
+        # Boxes match the full-array boolean masks
+        for lat_s, lat_n, lon_w, lon_e in [(40, 60, 0, 10), (-33.3, 61.2, 13.7, 211.1), (77, 90, 0, 360)]:
+            mask = (lats >= lat_s) & (lats <= lat_n) & (lons >= lon_w) & (lons <= lon_e)
+            np.testing.assert_array_equal(box_indices(geometry, lat_s, lat_n, lon_w, lon_e), np.nonzero(mask)[0])
+
+        # A rectangular polygon selects the same points as the box
+        np.testing.assert_array_equal(
+            polygon_indices(geometry, [40, 40, 60, 60], [10, 50, 50, 10]),
+            box_indices(geometry, 40, 60, 10, 50))
+
+        # Radius and nearest point match a brute-force great-circle search
+        lat, lon = 50, 10
+        a = np.sin(np.radians(lats - lat) / 2) ** 2 + \
+            np.cos(np.radians(lats)) * np.cos(np.radians(lat)) * np.sin(np.radians(lons - lon) / 2) ** 2
+        distance = 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+        np.testing.assert_array_equal(radius_indices(geometry, lat, lon, 1000.), np.nonzero(distance <= 1000.)[0])
+        self.assertEqual(nearest_index(geometry, lat, lon)[0], np.argmin(distance))
+
+        # The taper of a cosine box at the 0 meridian continues west of it, without a hard edge
+        indices, weights = cosine_box_weights(geometry, 40., 60., 0., 20., 10.)
+        lon_distance = np.minimum(np.maximum(lons - 20., 0.), 360. - lons)
+        lat_distance = np.maximum(np.maximum(40. - lats, lats - 60.), 0.)
+        expected = 0.25 * (1 + np.cos(np.pi * np.clip(lon_distance / 10., 0., 1.))) * (1 + np.cos(np.pi * np.clip(lat_distance / 10., 0., 1.)))
+        np.testing.assert_array_equal(indices, np.nonzero(expected > 0)[0])
+        np.testing.assert_array_almost_equal(weights, expected[indices])
+        self.assertTrue(np.any((lons[indices] > 350.) & (weights > 0.5)))
+
+    def test_perturbation_plan(self):
+        # Step 1: Chain two perturbations, one CLI call each
+        chained_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_chained_step_1.grib')
+        chained_grib_file_2 = os.path.join(OUTPUT_GRIB_PATH, 'test_chained_step_2.grib')
+        self.assertTrue(perturbation_by_factor(self.test_grib_file, 't', 500, 1.1, output_grib_file=chained_grib_file))
+        self.assertTrue(perturb_regionally(chained_grib_file, 'msl', 0, zmul=1.1, zadd=1, lat_s=40, lat_n=60, lon_w=0, lon_e=10, output_grib_file=chained_grib_file_2))
+
+        # Step 2: Apply the same perturbations as a single plan
+        plan_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_plan_perturbed.grib')
+        plan = {"operations": [
+            {"kind": "factor", "variable": "t", "level": 500, "factor": 1.1},
+            {"kind": "regional", "variable": "msl", "level": 0, "lat_min": 40, "lat_max": 60, "lon_min": 0, "lon_max": 10, "zmul": 1.1, "zadd": 1},
+        ]}
+        self.assertTrue(apply_perturbation_plan(self.test_grib_file, plan, output_grib_file=plan_grib_file))
+
+        # Step 3: Both files hold the same fields
+        grbs_chained = pygrib.open(chained_grib_file_2)
+        grbs_plan = pygrib.open(plan_grib_file)
+        for grb_chained, grb_plan in zip(grbs_chained, grbs_plan):
+            self.assertEqual((grb_chained.shortName, grb_chained.level, grb_chained.dataTime), (grb_plan.shortName, grb_plan.level, grb_plan.dataTime))
+            grb_chained.expand_grid(False)
+            grb_plan.expand_grid(False)
+            np.testing.assert_array_almost_equal(grb_plan.values, grb_chained.values, decimal=3)
+        grbs_chained.close()
+        grbs_plan.close()
+
+        # Step 4: Factor operations scale the whole field without thresholding, they reject thresholds
+        thresholds = {"t": [{"max": 250.}]}
+        with self.assertRaises(ValueError):
+            apply_perturbation_plan(self.test_grib_file, [dict(plan["operations"][0], thresholds=thresholds)], output_grib_file=plan_grib_file)
+
+        # Step 5: A smooth operation cannot take the pattern shape, whose amplitude array a plan cannot hold
+        with self.assertRaises(ValueError):
+            apply_perturbation_plan(self.test_grib_file, [{"kind": "smooth", "variable": "msl", "level": 0, "shape": "pattern", "zadd": 1}], output_grib_file=plan_grib_file)
+
+        # Step 6: A regional operation without longitudes perturbs its whole latitude band
+        band_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_plan_band_perturbed.grib')
+        band = [{"kind": "regional", "variable": "msl", "level": 0, "lat_min": 40, "lat_max": 60, "zadd": 1}]
+        self.assertTrue(apply_perturbation_plan(self.test_grib_file, band, output_grib_file=band_grib_file))
+        grbs = pygrib.open(self.test_grib_file)
+        grbs_band = pygrib.open(band_grib_file)
+        for grb, grb_band in zip(grbs, grbs_band):
+            if grb.shortName == 'msl':
+                grb.expand_grid(False)
+                grb_band.expand_grid(False)
+                in_band = (get_grid_geometry(grb).lats >= 40) & (get_grid_geometry(grb).lats <= 60)
+                np.testing.assert_array_almost_equal(grb_band.values - grb.values, np.where(in_band, 1., 0.), decimal=2)
+        grbs.close()
+        grbs_band.close()
+
+        # Clean up
+        os.remove(chained_grib_file)
+        os.remove(chained_grib_file_2)
+        os.remove(plan_grib_file)
+        os.remove(band_grib_file)
+
+    def test_parallel_encoding(self):
+        # Step 1: Perturb every level of t and z, encoded in the calling process and in a pool
+        plan = [{"kind": "factor", "variable": variable, "level": level, "factor": 1.01} for variable in ['t', 'z'] for level in LEVELS]
+        serial_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_plan_serial.grib')
+        parallel_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_plan_parallel.grib')
+        self.assertTrue(apply_perturbation_plan(self.test_grib_file, plan, output_grib_file=serial_grib_file, jobs=1))
+        self.assertTrue(apply_perturbation_plan(self.test_grib_file, plan, output_grib_file=parallel_grib_file, jobs=3))
+
+        # Step 2: The writer keeps the message order, both files are identical
+        with open(serial_grib_file, 'rb') as f_serial, open(parallel_grib_file, 'rb') as f_parallel:
+            self.assertEqual(f_serial.read(), f_parallel.read())
+
+        # Step 3: The factor list takes the same path
+        list_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_list_parallel.grib')
+        self.assertTrue(perturbation_by_factor_list(self.test_grib_file, {'t': {level: 1.01 for level in LEVELS}, 'z': {level: 1.01 for level in LEVELS}}, output_grib_file=list_grib_file, jobs=3))
+        with open(serial_grib_file, 'rb') as f_serial, open(list_grib_file, 'rb') as f_list:
+            self.assertEqual(f_serial.read(), f_list.read())
+
+        # Clean up
+        os.remove(serial_grib_file)
+        os.remove(parallel_grib_file)
+        os.remove(list_grib_file)
+
+    def test_plan_consistency(self):
+        # Step 1: Raise z at 500 hPa with a smooth bump, cool t at 850 hPa and raise msl, with the consistency stage
+        plan = {"consistency": "all", "operations": [
+            {"kind": "smooth", "variable": "z", "level": 500, "shape": "gaussian", "lat": 50, "lon": 20, "sigma_km": 1000, "zadd": 2000, "data_time": 0},
+            {"kind": "regional", "variable": "t", "level": 850, "lat_min": 30, "lat_max": 60, "lon_min": 0, "lon_max": 40, "zmul": 1, "zadd": -15, "data_time": 0},
+            {"kind": "regional", "variable": "msl", "level": 0, "lat_min": 30, "lat_max": 60, "lon_min": 0, "lon_max": 40, "zmul": 1, "zadd": 1000, "data_time": 0},
+        ]}
+        perturbed_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_plan_consistency.grib')
+        self.assertTrue(apply_perturbation_plan(self.test_grib_file, plan, output_grib_file=perturbed_grib_file))
+
+        original, perturbed = {}, {}
+        for (grib_file, fields) in [(self.test_grib_file, original), (perturbed_grib_file, perturbed)]:
+            grbs = pygrib.open(grib_file)
+            for grb in grbs:
+                grb.expand_grid(False)
+                if grb.dataTime == 0 and (grb.shortName, grb.level) in [('u', 500), ('v', 500), ('q', 850), ('t', 850), ('sp', 0), ('msl', 0), ('u', 300)]:
+                    fields[(grb.shortName, grb.level)] = grb.values
+                    geometry = get_grid_geometry(grb)
+            grbs.close()
+
+        # Step 2: The geostrophic wind turns clockwise around the z maximum, and not near the equator
+        du = perturbed[('u', 500)] - original[('u', 500)]
+        north, south = nearest_index(geometry, 60., 20.)[0], nearest_index(geometry, 40., 20.)[0]
+        self.assertGreater(du[north], 0.)
+        self.assertLess(du[south], 0.)
+        np.testing.assert_array_almost_equal(du[np.abs(geometry.lats) < 10.], 0., decimal=2)
+        np.testing.assert_array_almost_equal(perturbed[('u', 300)], original[('u', 300)], decimal=3)
+
+        # Step 3: In the cooled region q is below saturation, and sp follows msl
+        region = box_indices(geometry, 30., 60., 0., 40., snap=True)
+        q_sat = saturation_specific_humidity(perturbed[('t', 850)][region], 85000.)
+        self.assertTrue(np.all(perturbed[('q', 850)][region] <= q_sat + 1e-5))
+        np.testing.assert_allclose(perturbed[('sp', 0)][region] / original[('sp', 0)][region], perturbed[('msl', 0)][region] / original[('msl', 0)][region], rtol=1e-4)
+
+        # Step 4: A base file rewritten on disk gets its source fields read again
+        base_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_plan_consistency_base.grib')
+        shutil.copyfile(self.test_grib_file, base_grib_file)
+        plan = {"consistency": ["surface_pressure"], "operations": [plan["operations"][2]]}
+        self.assertTrue(apply_perturbation_plan(base_grib_file, plan, output_grib_file=perturbed_grib_file))
+        shutil.copyfile(perturbed_grib_file, base_grib_file)
+        self.assertTrue(apply_perturbation_plan(base_grib_file, plan, output_grib_file=perturbed_grib_file))
+
+        fields = {}
+        for grib_file in [base_grib_file, perturbed_grib_file]:
+            with pygrib.open(grib_file) as grbs:
+                for grb in grbs:
+                    if grb.dataTime == 0 and grb.shortName in ['sp', 'msl']:
+                        grb.expand_grid(False)
+                        fields[(grib_file, grb.shortName)] = grb.values[region]
+        np.testing.assert_allclose(
+            fields[(perturbed_grib_file, 'sp')] / fields[(base_grib_file, 'sp')],
+            fields[(perturbed_grib_file, 'msl')] / fields[(base_grib_file, 'msl')], rtol=1e-4)
+
+        # Clean up
+        os.remove(perturbed_grib_file)
+        os.remove(base_grib_file)
+
+    def test_generate_ensemble(self):
+        # Step 1: A random ensemble is reproducible through its seed
+        random_ensemble = {"random": {"members": 4, "seed": 3, "parameters": {"zadd": {"distribution": "normal", "std": 100}, "sign": {"distribution": "choice", "values": [-1, 1]}}}}
+        self.assertEqual(ensemble_members(random_ensemble), ensemble_members(random_ensemble))
+        self.assertEqual(len(ensemble_members(random_ensemble)), 4)
+
+        # Step 2: Generate a grid ensemble with a pool of workers
+        ensemble = {
+            "operations": [{"kind": "variable", "variable": "msl", "level": 0, "zmul": 1, "zadd": "$zadd"}],
+            "grid": {"zadd": [0, 100, -100]},
+        }
+        member_grib_files = generate_ensemble(self.test_grib_file, ensemble, output_dir=OUTPUT_GRIB_PATH, jobs=2)
+        self.assertEqual(len(member_grib_files), 3)
+
+        # Step 3: Each member is the base file with its own zadd on msl
+        for (zadd, member_grib_file) in zip([0, 100, -100], member_grib_files):
+            grbs_base = pygrib.open(self.test_grib_file)
+            grbs_member = pygrib.open(member_grib_file)
+            for grb_base, grb_member in zip(grbs_base, grbs_member):
+                self.assertEqual((grb_base.shortName, grb_base.level, grb_base.dataTime), (grb_member.shortName, grb_member.level, grb_member.dataTime))
+                grb_base.expand_grid(False)
+                grb_member.expand_grid(False)
+                if grb_base.shortName == 'msl':
+                    np.testing.assert_array_almost_equal(grb_member.values, grb_base.values + zadd, decimal=1)
+                else:
+                    self.assertEqual(grb_member.tostring(), grb_base.tostring())
+            grbs_base.close()
+            grbs_member.close()
+
+        # Step 4: The thresholds of the ensemble clip its members as they clip the same plan
+        thresholds = {"msl": [{"max": 300.}]}
+        operation = {"kind": "regional", "variable": "msl", "level": 0, "lat_min": 30, "lat_max": 60, "lon_min": 0, "lon_max": 40, "zadd": "$zadd"}
+        clipped_grib_files = generate_ensemble(self.test_grib_file, {"operations": [operation], "grid": {"zadd": [50]}, "thresholds": thresholds}, output_dir=OUTPUT_GRIB_PATH)
+        plan_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_ensemble_plan.grib')
+        self.assertTrue(apply_perturbation_plan(self.test_grib_file, {"operations": [dict(operation, zadd=50)], "thresholds": thresholds}, output_grib_file=plan_grib_file))
+        with pygrib.open(clipped_grib_files[0]) as grbs_member, pygrib.open(plan_grib_file) as grbs_plan:
+            member, plan = grbs_member.select(shortName='msl')[0], grbs_plan.select(shortName='msl')[0]
+            member.expand_grid(False)
+            plan.expand_grid(False)
+            np.testing.assert_array_equal(member.values, plan.values)
+            self.assertLessEqual(member.values.max(), 300.01)
+
+        # Clean up
+        for member_grib_file in member_grib_files + clipped_grib_files:
+            os.remove(member_grib_file)
+        os.remove(plan_grib_file)
+
+    def test_experiment_registry(self):
+        # Step 1: An experiments directory with init files, predictions and perturbation configs
+        experiments_dir = os.path.join(OUTPUT_GRIB_PATH, 'test_experiments')
+        os.makedirs(experiments_dir, exist_ok=True)
+        for name in ['20240302_orig_init.grb', '20240302_orig_init_240h_pred.grb', '20240302_pert_nao_240h_pred.grb', '20240302_pert_nao.grb']:
+            open(os.path.join(experiments_dir, name), 'wb').close()
+        with open(os.path.join(experiments_dir, '20240302_pert_nao_cfg.json'), 'w') as f:
+            json.dump({"grib_file": "20240302_orig_init.grb", "variable": "msl", "level": 0, "lonw_list": [328.]}, f)
+
+        # Step 2: The registry is only read when first queried
+        registry = ExperimentRegistry(experiments_dir)
+        self.assertFalse(os.path.exists(registry.db_file))
+        self.assertEqual(registry.init_dates(), ['20240302'])
+        self.assertEqual(list(registry.grib_files(init_date='20240302', original=True, prediction=False)), ['20240302_orig_init'])
+        self.assertEqual(list(registry.grib_files(perturbed=True, lead_time=240)), ['20240302_pert_nao_240h_pred'])
+        self.assertEqual(registry.experiment_params('20240302_pert_nao_240h_pred')['lonw_list'], [328.])
+        self.assertEqual(list(registry.experiments(variable='msl', level=0)), ['20240302_pert_nao'])
+
+        # Step 3: New configs are registered without rescanning, removed ones are dropped on the next refresh
+        cfg_file = os.path.join(experiments_dir, '20240302_pert_t_cfg.json')
+        with open(cfg_file, 'w') as f:
+            json.dump({"variable": "t", "level": 500}, f)
+        registry.register_cfg(cfg_file, {"variable": "t", "level": 500}, output_grib_file='out.grib', cache_id='abc')
+        self.assertEqual(list(registry.experiments(variable='t')), ['20240302_pert_t'])
+        os.remove(os.path.join(experiments_dir, '20240302_pert_nao_cfg.json'))
+        self.assertEqual(list(ExperimentRegistry(experiments_dir).pert_cfgs()), ['20240302_pert_t_cfg'])
+
+        # Clean up
+        for name in os.listdir(experiments_dir):
+            os.remove(os.path.join(experiments_dir, name))
+        os.rmdir(experiments_dir)
+
+    def test_output_cache(self):
+        # Step 1: The same perturbation of the same file gets the same output, whatever the number types
+        parameters = {"variable": "msl", "level": 0, "zmul": 1, "zadd": 100}
+        cache_id = output_cache_id(self.test_grib_file, "perturbation_of_variable", parameters)
+        self.assertEqual(cache_id, output_cache_id(self.test_grib_file, "perturbation_of_variable", dict(parameters, zmul=1.0)))
+        self.assertNotEqual(cache_id, output_cache_id(self.test_grib_file, "perturbation_of_variable", dict(parameters, zadd=101)))
+
+        # Step 2: A second run finds the output of the first one instead of writing it again
+        output_grib_file = os.path.join(OUTPUT_GRIB_PATH, f"test_msl_0_perturbed_{cache_id}.grib")
+        self.assertTrue(perturbation_of_variable(self.test_grib_file, 'msl', 0, zmul=1, zadd=100))
+        self.assertTrue(os.path.exists(output_grib_file))
+        os.utime(output_grib_file, ns=(0, 0))
+        self.assertTrue(perturbation_of_variable(self.test_grib_file, 'msl', 0, zmul=1., zadd=100.))
+        self.assertGreater(os.stat(output_grib_file).st_mtime_ns, 0)
+
+        # Step 3: A run perturbing nothing leaves no output, so that its rerun fails again
+        missing_id = output_cache_id(self.test_grib_file, "perturbation_of_variable", dict(parameters, variable="missing"))
+        self.assertFalse(perturbation_of_variable(self.test_grib_file, 'missing', 0, zmul=1, zadd=100))
+        self.assertFalse(os.path.exists(os.path.join(OUTPUT_GRIB_PATH, f"test_missing_0_perturbed_{missing_id}.grib")))
+        self.assertFalse(perturbation_of_variable(self.test_grib_file, 'missing', 0, zmul=1, zadd=100))
+
+        # Step 4: The least recently used outputs are evicted first
+        eviction_dir = os.path.join(OUTPUT_GRIB_PATH, 'test_eviction')
+        os.makedirs(eviction_dir, exist_ok=True)
+        for (i, name) in enumerate(['a.grib', 'b.grib', 'c.grib']):
+            with open(os.path.join(eviction_dir, name), 'wb') as f:
+                f.write(b'0' * 100)
+            os.utime(os.path.join(eviction_dir, name), ns=(i, [2, 1, 3][i]))
+        removed = evict_outputs(eviction_dir, max_bytes=150, keep=[os.path.join(eviction_dir, 'b.grib')])
+        self.assertEqual([os.path.basename(f) for f in removed], ['a.grib', 'c.grib'])
+
+        # Clean up
+        os.remove(output_grib_file)
+        os.remove(os.path.join(eviction_dir, 'b.grib'))
+        os.rmdir(eviction_dir)
+
+    def test_run_batch(self):
+        # Step 1: A directory of key=value configs and a plan, sharing the test grib file
+        batch_dir = os.path.join(OUTPUT_GRIB_PATH, 'test_batch_configs')
+        os.makedirs(batch_dir, exist_ok=True)
+        with open(os.path.join(batch_dir, 'a_factor.config'), 'w') as f:
+            f.write("# by factor\nvariable=msl\nlevel=0\nfactor=1.1\n")
+        with open(os.path.join(batch_dir, 'b_polygons.config'), 'w') as f:
+            f.write("# polygons\nvariable=msl\nlevel=0\nlonw=0.,20.\nlone=10.,30.\nlats=40.,40.\nlatn=60.,60.\nzmul=1.,1.\nzadd=100.,-100.\n")
+        with open(os.path.join(batch_dir, 'c_plan.json'), 'w') as f:
+            json.dump({"operations": [{"kind": "factor", "variable": "t", "level": 500, "factor": 0.9}]}, f)
+        with open(os.path.join(batch_dir, 'd_unknown.config'), 'w') as f:
+            f.write("# no command\nvariable=msl\n")
+        with open(os.path.join(batch_dir, 'e_ensemble.json'), 'w') as f:
+            json.dump({"operations": [{"kind": "factor", "variable": "msl", "level": 0, "factor": "$missing"}], "grid": {"factor": [1.1]}}, f)
+
+        self.assertEqual(config_command({"variable": "msl", "lat": 50, "lon": 10, "zadd": 1}), "location_perturbation")
+        self.assertEqual(config_operations({"variable": "t", "levels": "500,850", "profile": "0.5,1", "zadd": 2})[0]["zadd"], 1.)
+        polygon = config_operations({"variable": "msl", "lats": "60.", "latn": "90.", "zadd": "100."})[0]
+        self.assertEqual((polygon["lonw"], polygon["lone"]), ([0.], [360.]))
+
+        # Step 2: Run them with a pool of workers, the failing ensemble does not stop the batch
+        rows = run_batch(batch_dir, grib_file=self.test_grib_file, output_dir=OUTPUT_GRIB_PATH, jobs=2)
+        self.assertEqual([row["status"] for row in rows], ["ok", "ok", "ok", "failed", "failed"])
+        self.assertEqual([row["fields_modified"] for row in rows[:3]], [2, 2, 2])
+        for row in rows[:3]:
+            self.assertEqual(row["bytes_written"], os.path.getsize(row["output_grib_file"]))
+
+        # Step 3: The outputs match the single perturbation functions
+        expected_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_batch_expected.grib')
+        self.assertTrue(perturb_by_polygons(self.test_grib_file, 'msl', 0, [0., 20.], [10., 30.], [40., 40.], [60., 60.], [1., 1.], [100., -100.], output_grib_file=expected_grib_file))
+        with open(expected_grib_file, 'rb') as f_expected, open(rows[1]["output_grib_file"], 'rb') as f_batch:
+            self.assertEqual(f_batch.read(), f_expected.read())
+
+        # Clean up
+        os.remove(expected_grib_file)
+        for row in rows[:3]:
+            os.remove(row["output_grib_file"])
+        for config_file in os.listdir(batch_dir):
+            os.remove(os.path.join(batch_dir, config_file))
+        os.rmdir(batch_dir)
+
+    def test_perturbation_server(self):
+        # Step 1: Serve on a Unix socket, with room for about two decoded fields
+        os.makedirs(OUTPUT_GRIB_PATH, exist_ok=True)
+        socket_path = os.path.join(OUTPUT_GRIB_PATH, 'test_perturbation_server.sock')
+        server = PerturbationServer(output_dir=OUTPUT_GRIB_PATH, max_memory_mb=0.05, jobs=2)
+        thread = threading.Thread(target=server.serve, kwargs={"socket_path": socket_path})
+        thread.start()
+        self.assertTrue(server.ready.wait(5))
+
+        try:
+            # Step 2: Concurrent requests in the perturbation_json form and as configs
+            requests = [
+                {"grib_file": self.test_grib_file, "perturbation_json": {"msl": {"0": 1.1}, "t": {"500": 0.9}}},
+                {"grib_file": self.test_grib_file, "variable": "msl", "level": 0, "lat": 50, "lon": 10, "zadd": 100},
+                {"grib_file": self.test_grib_file, "unknown_key": 1},
+            ]
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                responses = list(executor.map(lambda request: send_perturbation_request(request, socket_path=socket_path), requests))
+            self.assertEqual([response["status"] for response in responses], ["ok", "ok", "failed"])
+
+            # Step 3: The same request again streams back the cached output, identical to the plan
+            response, content = send_perturbation_request(dict(requests[0], response="bytes"), socket_path=socket_path)
+            self.assertTrue(response["cached"])
+            expected_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_perturbation_server_expected.grib')
+            self.assertTrue(apply_perturbation_plan(self.test_grib_file, [
+                {"kind": "factor", "variable": "msl", "level": 0, "factor": 1.1},
+                {"kind": "factor", "variable": "t", "level": 500, "factor": 0.9}], output_grib_file=expected_grib_file))
+            with open(expected_grib_file, 'rb') as f:
+                self.assertEqual(content, f.read())
+
+            # Step 4: The decoded fields stay within the memory budget
+            stats = send_perturbation_request({"command": "stats"}, socket_path=socket_path)
+            self.assertLessEqual(stats["bytes"], stats["max_bytes"])
+            self.assertLess(stats["fields"], 4)
+        finally:
+            server.stop()
+            thread.join()
+
+        # Step 5: Two misses on different fields are decoded concurrently, a field being decoded is not decoded twice
+        cache = FieldCache()
+        base = cache.base(self.test_grib_file)
+        barrier = threading.Barrier(2, timeout=5)
+        decode = perturbation_server.read_values
+
+        def read_values_together(grb):
+            if grb.shortName == 't':
+                barrier.wait()
+            return decode(grb)
+
+        perturbation_server.read_values = read_values_together
+        try:
+            keys = [('t', 500, 0), ('t', 850, 0), ('t', 500, 0), ('t', 850, 0)]
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                fields = list(executor.map(lambda key: cache.field(base, key), keys))
+        finally:
+            perturbation_server.read_values = decode
+        self.assertIs(fields[0][0], fields[2][0])
+        self.assertEqual(cache.stats()["misses"], 2)
+
+        # Clean up
+        os.remove(expected_grib_file)
+        for response in responses[:2]:
+            os.remove(response["output_grib_file"])
+
+    def test_run_report(self):
+        # Step 1: Perturb a region of t - 500 through the message index, profiled with cProfile
+        perturbed_grib_file = os.path.join(OUTPUT_GRIB_PATH, 'test_run_report.grib')
+        instrumentation.enable_profiling("cprofile")
+        try:
+            self.assertTrue(perturb_regionally(self.test_grib_file, 't', 500, lat_s=30, lat_n=60, lon_w=0, lon_e=40, zmul=1.01, output_grib_file=perturbed_grib_file, use_index=True))
+        finally:
+            instrumentation.enable_profiling(None)
+
+        # Step 2: The run report is written next to the _cfg.json
+        cfg_file = max(glob.glob(os.path.join(os.path.dirname(self.test_grib_file), "*_regional_t_perturbed_*_cfg.json")), key=os.path.getmtime)
+        report_file = cfg_file.replace("_cfg.json", "_report.json")
+        with open(report_file) as f:
+            report = json.load(f)
+
+        # Step 3: Only the two perturbed messages are decoded and re-encoded, the others are copied
+        n_messages = len(get_grib_index(self.test_grib_file).messages)
+        with pygrib.open(self.test_grib_file) as grbs:
+            geometry = get_grid_geometry(grbs.message(1))
+        self.assertEqual(report["output_grib_file"], perturbed_grib_file)
+        self.assertEqual(report["counters"]["messages_read"], 2)
+        self.assertEqual(report["counters"]["messages_reencoded"], 2)
+        self.assertEqual(report["counters"]["bytes_copied"] + report["counters"]["bytes_written"], os.path.getsize(perturbed_grib_file))
+        self.assertEqual(report["counters"]["points_modified"], 2 * box_indices(geometry, 30, 60, 0, 40, snap=True).size)
+        self.assertLess(report["counters"]["messages_reencoded"], n_messages)
+        self.assertGreater(report["stages"]["encoding"], 0.)
+        self.assertLessEqual(sum(report["stages"].values()), report["wall_time"])
+        self.assertTrue(os.path.exists(report["profile"]["stats_file"]))
+
+        # Clean up
+        os.remove(perturbed_grib_file)
+        os.remove(report["profile"]["stats_file"])
+
+    def test_logging(self):
+        # Step 1: An argument that records the thread it is formatted in
+        formatted_in = list()
+
+        class Argument:
+            def __str__(self):
+                formatted_in.append(threading.current_thread())
+                return "argument"
+
+        stream = io.StringIO()
+        console_stream = instrumentation.console_handler.setStream(stream)
+        level, propagate = logger.level, logger.propagate
+        # only the handler of the logger formats the records (not e.g. those of the test runner)
+        logger.propagate = False
+        try:
+            # Step 2: Below the logger level, nothing is formatted
+            instrumentation.set_level("INFO")
+            logger.debug("perturbing %s", Argument())
+            instrumentation.flush()
+            self.assertEqual(formatted_in, [])
+
+            # Step 3: The records are formatted and written by the listener thread
+            instrumentation.set_level("DEBUG")
+            logger.debug("perturbing %s", Argument())
+            instrumentation.flush()
+        finally:
+            instrumentation.console_handler.setStream(console_stream)
+            logger.setLevel(level)
+            logger.propagate = propagate
+
+        self.assertEqual(len(formatted_in), 1)
+        self.assertIsNot(formatted_in[0], threading.current_thread())
+        self.assertIn("| DEBUG | perturbing argument", stream.getvalue())
+
+    def test_array_store(self):
+        # Step 1: Export the test grib file to a memory-mapped store
+        store_path = os.path.join(OUTPUT_GRIB_PATH, 'test_array_store.arrays')
+        self.assertEqual(grib_to_array_store(self.test_grib_file, store_path=store_path, backend="npy", overwrite=True), store_path)
+        store = open_array_store(store_path)
+        self.assertTrue(store.is_current())
+
+        # Step 2: Every field is stored as float32 (time, points), in the point order of the grib file
+        with pygrib.open(self.test_grib_file) as grbs:
+            for grb in grbs:
+                grb.expand_grid(False)
+                time = store.times.index((grb.dataDate, grb.dataTime, grb.step))
+                np.testing.assert_array_equal(store.field(grb.shortName, grb.level)[time], grb.values.astype(np.float32))
+            geometry = get_grid_geometry(grbs.message(1))
+        self.assertEqual(store.field('t', 500).dtype, np.float32)
+        self.assertIsInstance(store.field('t', 500), np.memmap)
+        np.testing.assert_array_equal(store.lats, geometry.lats)
+        np.testing.assert_array_equal(store.values('t', 500, store.valid_times[1]), store.field('t', 500)[1])
+
+        # Step 3: An up-to-date store is reused, not written again
+        meta_mtime = os.path.getmtime(os.path.join(store_path, "store.json"))
+        grib_to_array_store(self.test_grib_file, store_path=store_path, backend="npy")
+        self.assertEqual(os.path.getmtime(os.path.join(store_path, "store.json")), meta_mtime)
+
+        # Clean up
+        shutil.rmtree(store_path)
+
+    def test_cli_startup(self):
+        # Step 1: Time `perturbations_aifs.py --help` in a fresh interpreter, without its own start-up
+        script = (
+            "import sys, time, runpy\n"
+            "sys.argv = ['perturbations_aifs.py', '--help']\n"
+            "start = time.perf_counter()\n"
+            "try:\n"
+            "    runpy.run_path('perturbations_aifs.py', run_name='__main__')\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(time.perf_counter() - start, 'pygrib' in sys.modules, 'numpy' in sys.modules, file=sys.stderr)\n"
+        )
+        timings = list()
+        for _ in range(3):
+            result = subprocess.run([sys.executable, "-c", script], cwd=ROOT_PATH, capture_output=True, text=True, check=True)
+            self.assertIn("perturbation_by_factor", result.stdout)
+            elapsed, pygrib_imported, numpy_imported = result.stderr.split()[-3:]
+            timings.append(float(elapsed))
+
+        # Step 2: The sub-commands and their heavy dependencies are only imported on dispatch
+        self.assertEqual((pygrib_imported, numpy_imported), ("False", "False"))
+        self.assertLess(min(timings), CLI_STARTUP_BUDGET)
+
 if __name__ == "__main__":
     if TEST_GRIB_FILE:
         unittest.main()
\ No newline at end of file
@@ -1,4 +1,4 @@
-from perturbation_functions import *
+import json
 
 def apply_thresh_to_temp_data(data, variable, thresx=274.5, thresn=270., thresfix=274.5):
     """
@@ -51,58 +51,17 @@ def apply_thresh_to_temp_data(data, variable, thresx=274.5, thresn=270., thresfi
         data[temp_mask] = thresfix
     return data
 
-def load_custom_config(config_file):
-    """
-    Load a custom configuration file into a dictionary.
-
-    This function reads a configuration file, parses key-value pairs, and returns
-    them as a dictionary. It ignores lines that are empty, start with comments,
-    or begin with specific characters indicating non-configuration lines.
-
-    Parameters
-    ----------
-    config_file : str
-        The path to the configuration file to be loaded. The file should contain
-        key-value pairs in the format `key = value`. Lines starting with `#` or
-        `$` in the first line are ignored, as well as any subsequent lines that
-        are empty or start with `#`.
-
-    Returns
-    -------
-    dict
-        A dictionary containing the configuration parameters as key-value pairs.
-
-    Raises
-    ------
-    FileNotFoundError
-        If the specified `config_file` does not exist.
-    PermissionError
-        If there are insufficient permissions to read the `config_file`.
-    ValueError
-        If a line in the configuration file does not contain an `=` separator
-        for key-value pairing.
-    """
-    config_dict = {}
-    with open(config_file, 'r') as f:
-        lines = f.readlines()
-
-        # ignore the first line if it starts with # or $
-        if lines and (lines[0].startswith('#') or lines[0].startswith('$')):
-            lines = lines[1:]
-
-        # parse the remaining lines
-        for line in lines:
-            line = line.strip()
-            
-            # ignore empty lines and in-line comments
-            if line and not line.startswith("#"):
-                key, value = line.split("=", 1)
-                config_dict[key.strip()] = value.strip()
-    return config_dict
-
 def parse_list(value):
     return [float(x) for x in value.split(',')]
 
+def parse_time_pairs(value):
+    return [tuple(int(t) for t in pair.split(':')) for pair in value.split(',')]
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ['1', 'true', 'yes']
+
 def merge_args_with_config(args, config):
     """
     Merge command-line arguments with configuration settings.
@@ -152,6 +111,8 @@ if __name__ == "__main__":
 
     # Main argument to specify a config file
     parser.add_argument('--version', action='version', version='0.1')
+    parser.add_argument('--log_level', type=str.upper, choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help='Level of the logs, DEBUG logs every perturbed message (default INFO)')
+    parser.add_argument('--profile', type=str, choices=["cprofile", "tracemalloc"], help='Profile the run, the profile is added to the run report written next to the _cfg.json')
 
     # Create a subparser object to handle subcommands
     subparsers = parser.add_subparsers(dest='command', help='sub-command help')
@@ -170,6 +131,9 @@ if __name__ == "__main__":
     parser_b.add_argument('--config', type=str, help='Path to the config file (key=value format)')
     parser_b.add_argument('--grib_file', type=str, help='Path to the GRIB file')
     parser_b.add_argument('--phase_shift', type=str, choices=["future", "past", "both"], help='Phase shift method (future, past, both)')
+    parser_b.add_argument('--data_times', type=str, help='Pairs of dataTimes to shift (comma-separated time_a:time_b, default 0:1800)')
+    parser_b.add_argument('--dtype', type=str, choices=["float32", "float64"], help='Type of the values held in memory (default float64, as decoded)')
+    parser_b.add_argument('--max_memory_mb', type=float, help='Memory used to keep values for later messages (with --use_index)')
     parser_b.add_argument('--output_grib_file', type=str, help='Path to the output GRIB file')
 
     # regional perturbation
@@ -220,6 +184,7 @@ if __name__ == "__main__":
     parser_f.add_argument('--latn', type=str, help='Latitude north list (comma-separated)')
     parser_f.add_argument('--zmul', type=str, help='Multiplication factor list (comma-separated)')
     parser_f.add_argument('--zadd', type=str, help='Addition factor list (comma-separated)')
+    parser_f.add_argument('--overlap', type=str, choices=["last", "sum", "max"], help='How overlapping polygons combine (default last)')
     parser_f.add_argument('--output_grib_file', type=str, help='Path to the output GRIB file')
 
     # perturbation_by_list
@@ -228,41 +193,156 @@ if __name__ == "__main__":
     parser_g.add_argument('--grib_file', type=str, help='Path to the GRIB file')
     parser_g.add_argument('--perturbation_json', type=str, help='Variables and levels to perturb by factor')
     parser_g.add_argument('--output_grib_file', type=str, help='Path to the output GRIB file')
+    parser_g.add_argument('--jobs', type=int, help='Number of processes encoding the perturbed messages')
+
+    # smooth perturbation
+    parser_j = subparsers.add_parser('smooth_perturbation', help='perturb variable and level with a smooth gaussian or cosine-tapered amplitude')
+    parser_j.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_j.add_argument('--grib_file', type=str, help='Path to the GRIB file')
+    parser_j.add_argument('--variable', type=str, help='Variable to perturb')
+    parser_j.add_argument('--level', type=int, help='Level of the variable')
+    parser_j.add_argument('--shape', type=str, choices=["gaussian", "cosine_box"], help='Shape of the amplitude (default gaussian)')
+    parser_j.add_argument('--lat', type=float, help='Latitude of the centre of the gaussian')
+    parser_j.add_argument('--lon', type=float, help='Longitude of the centre of the gaussian')
+    parser_j.add_argument('--sigma_km', type=float, help='Standard deviation of the gaussian in km')
+    parser_j.add_argument('--lat_min', type=float, help='Minimum latitude of the cosine box')
+    parser_j.add_argument('--lat_max', type=float, help='Maximum latitude of the cosine box')
+    parser_j.add_argument('--lon_min', type=float, help='Minimum longitude of the cosine box')
+    parser_j.add_argument('--lon_max', type=float, help='Maximum longitude of the cosine box')
+    parser_j.add_argument('--taper_deg', type=float, help='Width of the cosine taper around the box in degrees')
+    parser_j.add_argument('--zmul', type=float, help='Multiplication factor where the amplitude is 1')
+    parser_j.add_argument('--zadd', type=float, help='Addition factor where the amplitude is 1')
+    parser_j.add_argument('--output_grib_file', type=str, help='Path to the output GRIB file')
+
+    # pattern perturbation
+    parser_k = subparsers.add_parser('pattern_perturbation', help='add a scaled anomaly/EOF pattern (.npy, .npz or GRIB) to variables and levels')
+    parser_k.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_k.add_argument('--grib_file', type=str, help='Path to the GRIB file')
+    parser_k.add_argument('--pattern_file', type=str, help='Path to the pattern (.npy, .npz or GRIB)')
+    parser_k.add_argument('--perturbation_json', type=str, help='Levels of every variable to perturb, e.g. \'{"t": [500, 850]}\'')
+    parser_k.add_argument('--alpha', type=float, help='Scale of the pattern')
+    parser_k.add_argument('--output_grib_file', type=str, help='Path to the output GRIB file')
+
+    # column perturbation
+    parser_l = subparsers.add_parser('column_perturbation', help='regionally perturb a variable on several levels at once with a vertical profile')
+    parser_l.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_l.add_argument('--grib_file', type=str, help='Path to the GRIB file')
+    parser_l.add_argument('--variable', type=str, help='Variable to perturb')
+    parser_l.add_argument('--levels', type=str, help='Levels of the column (comma-separated) or all')
+    parser_l.add_argument('--profile', type=str, help='Amplitude of every level (comma-separated, default 1)')
+    parser_l.add_argument('--lat_min', type=float, help='Minimum latitude')
+    parser_l.add_argument('--lat_max', type=float, help='Maximum latitude')
+    parser_l.add_argument('--lon_min', type=float, help='Minimum longitude (0 to 360, default 0)')
+    parser_l.add_argument('--lon_max', type=float, help='Maximum longitude (0 to 360, default 360)')
+    parser_l.add_argument('--zmul', type=float, help='Multiplication factor on the levels of amplitude 1')
+    parser_l.add_argument('--zadd', type=float, help='Addition factor on the levels of amplitude 1')
+    parser_l.add_argument('--output_grib_file', type=str, help='Path to the output GRIB file')
+
+    # perturbation_plan
+    parser_h = subparsers.add_parser('perturbation_plan', help='apply all the perturbations listed in a JSON/YAML plan in a single pass')
+    parser_h.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_h.add_argument('--grib_file', type=str, help='Path to the GRIB file (overrides the one of the plan)')
+    parser_h.add_argument('--plan', type=str, help='Path to the perturbation plan (JSON or YAML)')
+    parser_h.add_argument('--output_grib_file', type=str, help='Path to the output GRIB file (overrides the one of the plan)')
+    parser_h.add_argument('--jobs', type=int, help='Number of processes encoding the perturbed messages')
+    parser_h.add_argument('--consistency', type=str, help='Adjust the dependent fields: all or comma-separated rules (geostrophic_wind, humidity, dewpoint, surface_pressure)')
+
+    # perturbation_ensemble
+    parser_i = subparsers.add_parser('perturbation_ensemble', help='write the members of an ensemble of perturbations, reading the base grib file once')
+    parser_i.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_i.add_argument('--grib_file', type=str, help='Path to the base GRIB file (overrides the one of the ensemble)')
+    parser_i.add_argument('--ensemble', type=str, help='Path to the ensemble definition (JSON or YAML)')
+    parser_i.add_argument('--output_dir', type=str, help='Directory of the member GRIB files')
+    parser_i.add_argument('--jobs', type=int, help='Number of processes writing members')
+
+    # batch
+    parser_m = subparsers.add_parser('batch', help='run a directory or glob of configs, reading every input grib file once')
+    parser_m.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_m.add_argument('--configs', type=str, nargs='+', help='Config files, directories or glob patterns (.config, .json, .yaml)')
+    parser_m.add_argument('--grib_file', type=str, help='Path to the GRIB file of the configs without grib_file')
+    parser_m.add_argument('--output_dir', type=str, help='Directory of the outputs of the configs without output_grib_file')
+    parser_m.add_argument('--jobs', type=int, help='Number of processes writing outputs')
+
+    # serve
+    parser_n = subparsers.add_parser('serve', help='serve perturbation requests (JSON lines) keeping the base grib files warm in memory')
+    parser_n.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_n.add_argument('--host', type=str, help='Localhost address to listen on (default 127.0.0.1)')
+    parser_n.add_argument('--port', type=int, help='Port to listen on (default 8765)')
+    parser_n.add_argument('--socket', type=str, help='Unix socket to listen on instead of host:port')
+    parser_n.add_argument('--output_dir', type=str, help='Directory of the outputs of the requests without output_grib_file')
+    parser_n.add_argument('--max_memory_mb', type=float, help='Memory of the decoded fields kept warm (default 4096)')
+    parser_n.add_argument('--max_files', type=int, help='Number of base grib files kept warm (default 8)')
+    parser_n.add_argument('--jobs', type=int, help='Number of requests handled concurrently')
+    parser_n.add_argument('--preload', type=str, nargs='+', help='GRIB files whose fields are all decoded before serving')
+
+    # array_store
+    parser_o = subparsers.add_parser('array_store', help='export the fields of a GRIB file to a chunked array store (zarr or memory-mapped npy)')
+    parser_o.add_argument('--config', type=str, help='Path to the config file (key=value format)')
+    parser_o.add_argument('--grib_file', type=str, help='Path to the GRIB file (init or prediction)')
+    parser_o.add_argument('--store_path', type=str, help='Directory of the store (default next to the GRIB file)')
+    parser_o.add_argument('--backend', type=str, choices=["auto", "zarr", "npy"], help='zarr (compressed, needs zarr) or npy (memory-mapped), auto by default')
+    parser_o.add_argument('--dtype', type=str, choices=["float32", "float64"], help='Type of the stored values (default float32)')
+    parser_o.add_argument('--overwrite', action='store_true', default=None, help='Rewrite the store even if it is up to date')
+
+    # every perturbation can locate the messages through the grib file index
+    for _parser in [parser_a, parser_b, parser_c, parser_d, parser_e, parser_f, parser_g, parser_j, parser_k, parser_l]:
+        _parser.add_argument('--use_index', action='store_true', default=None, help='Use (and build if needed) the message index stored next to the GRIB file')
 
     args = parser.parse_args()
 
     # Parse the config file if it exists and merge it with command-line args
+    # (only the sub-command run imports its perturbation functions, and with them pygrib and numpy)
+    from perturbation_functions.custom_config import load_custom_config
     config = load_custom_config(args.config) if args.config else {}
 
     final_args = merge_args_with_config(args, config)
     print(final_args)
 
+    if final_args.get("log_level"):
+        from logger import instrumentation
+        instrumentation.set_level(final_args["log_level"])
+
+    if final_args.get("profile"):
+        from logger import instrumentation
+        instrumentation.enable_profiling(final_args["profile"])
+
     if args.command == "perturbation_by_factor":
+        from perturbation_functions import perturbation_by_factor
         # final_args = merge_args_with_config(args, config)
         perturbation_by_factor(
             grib_file=final_args["grib_file"],
             variable=final_args["variable"],
             level=final_args["level"],
             perturbation_factor=final_args["factor"],
-            output_grib_file=final_args.get("output_grib_file")
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False))
         )
     elif args.command == "perturbation_by_list":
+        from perturbation_functions import perturbation_by_factor_list
         # final_args = merge_args_with_config(args, config)
         perturbation_dict = json.loads(final_args.get("perturbation_json"))
 
         perturbation_by_factor_list(
             grib_file=final_args["grib_file"],
             perturbation_dict=perturbation_dict,
-            output_grib_file=final_args.get("output_grib_file")
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False)),
+            jobs=int(final_args.get("jobs", 1))
         )
     elif args.command == "perturbation_phase":
+        from perturbation_functions import perturbation_phase
         # final_args = merge_args_with_config(args, config)
         perturbation_phase(
             grib_file=final_args["grib_file"],
             phase_shift=final_args.get("phase_shift", "both"),
-            output_grib_file=final_args.get("output_grib_file")
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False)),
+            data_times=parse_time_pairs(final_args["data_times"]) if final_args.get("data_times") else None,
+            dtype=final_args.get("dtype"),
+            max_memory_mb=float(final_args["max_memory_mb"]) if final_args.get("max_memory_mb") is not None else None
         )
     elif args.command == "regional_perturbation":
+        from perturbation_functions import perturb_regionally
         # final_args = merge_args_with_config(args, config)
         perturb_regionally(
             grib_file=final_args["grib_file"],
@@ -274,9 +354,11 @@ if __name__ == "__main__":
             lon_e=final_args["lon_max"],
             zmul=final_args.get("zmul", 1),
             zadd=final_args.get("zadd", 0),
-            output_grib_file=final_args.get("output_grib_file")
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False))
         )
     elif args.command == "location_perturbation":
+        from perturbation_functions import perturb_specific_location
         # final_args = merge_args_with_config(args, config)
         perturb_specific_location(
             grib_file=final_args["grib_file"],
@@ -286,9 +368,11 @@ if __name__ == "__main__":
             lon=final_args["lon"],
             zmul=final_args.get("zmul", 1),
             zadd=final_args.get("zadd", 0),
-            output_grib_file=final_args.get("output_grib_file")
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False))
         )
     elif args.command == "perturbation_of_variable":
+        from perturbation_functions import perturbation_of_variable
         # final_args = merge_args_with_config(args, config)
         perturbation_of_variable(
             grib_file=final_args["grib_file"],
@@ -296,9 +380,11 @@ if __name__ == "__main__":
             level=final_args["level"],
             zmul=final_args.get("zmul", 1),
             zadd=final_args.get("zadd", 0),
-            output_grib_file=final_args.get("output_grib_file")
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False))
         )
     elif args.command == "perturbation_by_polygons":
+        from perturbation_functions import perturb_by_polygons
         perturb_by_polygons(
             grib_file=final_args['grib_file'],
             variable=final_args['variable'],
@@ -309,7 +395,112 @@ if __name__ == "__main__":
             latn_list=parse_list(final_args['latn']),
             zmul_list=parse_list(final_args['zmul']),
             zadd_list=parse_list(final_args['zadd']),
-            output_grib_file=final_args.get('output_grib_file')
+            output_grib_file=final_args.get('output_grib_file'),
+            use_index=parse_bool(final_args.get('use_index', False)),
+            overlap=final_args.get('overlap', 'last')
         )    
+    elif args.command == "smooth_perturbation":
+        from perturbation_functions import perturb_smoothly
+        perturb_smoothly(
+            grib_file=final_args["grib_file"],
+            variable=final_args["variable"],
+            level=int(final_args["level"]),
+            shape=final_args.get("shape", "gaussian"),
+            zmul=float(final_args.get("zmul", 1)),
+            zadd=float(final_args.get("zadd", 0)),
+            lat=final_args.get("lat"),
+            lon=final_args.get("lon"),
+            sigma_km=float(final_args.get("sigma_km", 500.)),
+            lat_s=final_args.get("lat_min"),
+            lat_n=final_args.get("lat_max"),
+            lon_w=final_args.get("lon_min"),
+            lon_e=final_args.get("lon_max"),
+            taper_deg=float(final_args.get("taper_deg", 5.)),
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False))
+        )
+    elif args.command == "pattern_perturbation":
+        from perturbation_functions import perturb_by_pattern
+        perturb_by_pattern(
+            grib_file=final_args["grib_file"],
+            pattern_file=final_args["pattern_file"],
+            perturbation_dict=json.loads(final_args["perturbation_json"]),
+            alpha=float(final_args.get("alpha", 1.)),
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False))
+        )
+    elif args.command == "column_perturbation":
+        from perturbation_functions import perturb_column
+        from grib_files.grib_file_config import LAT_MIN_LIM, LAT_MAX_LIM, GRID_LON_MIN, GRID_LON_MAX
+        levels = final_args.get("levels", "all")
+        perturb_column(
+            grib_file=final_args["grib_file"],
+            variable=final_args["variable"],
+            levels=levels if levels == "all" else [int(level) for level in parse_list(levels)],
+            profile=parse_list(final_args["profile"]) if final_args.get("profile") else None,
+            zmul=float(final_args.get("zmul", 1)),
+            zadd=float(final_args.get("zadd", 0)),
+            lat_s=float(final_args.get("lat_min", LAT_MIN_LIM)),
+            lat_n=float(final_args.get("lat_max", LAT_MAX_LIM)),
+            lon_w=float(final_args.get("lon_min", GRID_LON_MIN)),
+            lon_e=float(final_args.get("lon_max", GRID_LON_MAX)),
+            output_grib_file=final_args.get("output_grib_file"),
+            use_index=parse_bool(final_args.get("use_index", False))
+        )
+    elif args.command == "perturbation_plan":
+        from perturbation_functions import apply_perturbation_plan, load_perturbation_plan
+        plan = load_perturbation_plan(final_args["plan"])
+
+        apply_perturbation_plan(
+            grib_file=final_args.get("grib_file", plan.get("grib_file")),
+            plan=plan,
+            output_grib_file=final_args.get("output_grib_file", plan.get("output_grib_file")),
+            jobs=int(final_args.get("jobs", plan.get("jobs", 1))),
+            consistency=final_args.get("consistency")
+        )
+    elif args.command == "perturbation_ensemble":
+        from perturbation_functions import generate_ensemble, load_ensemble
+        ensemble = load_ensemble(final_args["ensemble"])
+
+        generate_ensemble(
+            grib_file=final_args.get("grib_file", ensemble.get("grib_file")),
+            ensemble=ensemble,
+            output_dir=final_args.get("output_dir", ensemble.get("output_dir")),
+            jobs=int(final_args.get("jobs", 1))
+        )
+    elif args.command == "batch":
+        from perturbation_functions import run_batch
+        configs = final_args["configs"]
+
+        run_batch(
+            configs=configs.split(",") if isinstance(configs, str) else configs,
+            grib_file=final_args.get("grib_file"),
+            output_dir=final_args.get("output_dir"),
+            jobs=int(final_args.get("jobs", 1))
+        )
+    elif args.command == "serve":
+        from perturbation_functions import serve_perturbations
+        preload = final_args.get("preload", [])
+
+        serve_perturbations(
+            host=final_args.get("host", "127.0.0.1"),
+            port=int(final_args.get("port", 8765)),
+            socket_path=final_args.get("socket"),
+            output_dir=final_args.get("output_dir"),
+            max_memory_mb=float(final_args.get("max_memory_mb", 4096.)),
+            max_files=int(final_args.get("max_files", 8)),
+            jobs=int(final_args.get("jobs", 4)),
+            preload=preload.split(",") if isinstance(preload, str) else preload
+        )
+    elif args.command == "array_store":
+        from perturbation_functions import grib_to_array_store
+
+        grib_to_array_store(
+            final_args["grib_file"],
+            store_path=final_args.get("store_path"),
+            backend=final_args.get("backend", "auto"),
+            dtype=final_args.get("dtype", "float32"),
+            overwrite=parse_bool(final_args.get("overwrite", False))
+        )
     else:
         parser.print_help()
\ No newline at end of file